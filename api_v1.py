@@ -0,0 +1,274 @@
+# api_v1.py
+"""
+Versioned, read-only JSON API.
+
+    GET /api/v1/dispenses     dispense lines, newest first
+    GET /api/v1/receipts      receive transactions, newest first
+    GET /api/v1/medications   medications by name
+    GET /api/v1/cube          dispensing totals from the materialized cube (cube.py)
+    GET /api/v1/medication-cache   this worker's medication cache statistics (med_cache.py)
+
+Query parameters (all optional):
+
+    fields=a,b,c          only these fields (MongoDB projection – nothing
+                          else leaves the database); default: all public fields
+    limit=100             page size, max 1000
+    after=<next>          keyset cursor from the previous page's `next`
+    start_date, end_date  YYYY-MM-DD on the transaction timestamp
+    med_name              exact medication (dispenses, receipts)
+    schedule              'controlled' / 'not controlled' (medications)
+    format=ndjson         stream every matching document as one JSON object
+                          per line (also chosen by Accept: application/x-ndjson);
+                          `limit` then caps the stream (no maximum) instead of a page
+
+The cube takes instead
+
+    by=month,company      dimensions to keep (all others are rolled up)
+    <dimension>=a,b       slice: month, company, med_name, diagnosis, age_group, gender
+    from=YYYY-MM, to=YYYY-MM   month range
+    measures=quantity     any of quantity, lines, transactions (default all)
+
+Paging is by keyset (timestamp or name, then _id), never skip(), so a page
+costs the same at any depth.  Reads go through db.reporting_db(), like
+reports.  Uses the browser session – an integration script logs in via
+/login first.
+
+    from api_v1 import init_api
+    init_api(app)
+"""
+
+import os
+import json
+import base64
+from datetime import datetime, timedelta
+from bson import ObjectId
+from flask import Blueprint, Response, request, session, jsonify, stream_with_context
+from pymongo.errors import ServerSelectionTimeoutError
+from db import reporting_db
+from archive import find_transactions
+from cube import query_cube, DIMENSIONS as CUBE_DIMENSIONS, MEASURES as CUBE_MEASURES
+from med_cache import stats as medication_cache_stats
+
+MAX_LIMIT = 1000
+DEFAULT_LIMIT = 100
+NDJSON = 'application/x-ndjson'
+
+# resource -> collection, base query, sort key (with direction), public fields
+RESOURCES = {
+    'dispenses': {
+        'collection': 'transactions',
+        'query': {'type': 'dispense'},
+        'sort': ('timestamp', -1),
+        'fields': ('transaction_id', 'patient', 'company', 'position', 'age_group', 'gender',
+                   'sick_leave_days', 'diagnoses', 'prescriber', 'dispenser', 'user', 'date',
+                   'med_name', 'quantity', 'batch', 'timestamp'),
+    },
+    'receipts': {
+        'collection': 'transactions',
+        'query': {'type': 'receive'},
+        'sort': ('timestamp', -1),
+        'fields': ('med_name', 'quantity', 'batch', 'price', 'expiry_date', 'schedule',
+                   'stock_receiver', 'order_number', 'supplier', 'invoice_number', 'user', 'timestamp'),
+    },
+    'medications': {
+        'collection': 'medications',
+        'query': {},
+        'sort': ('name', 1),
+        'fields': ('name', 'balance', 'batch', 'price', 'expiry_date', 'schedule',
+                   'stock_receiver', 'order_number', 'supplier', 'invoice_number'),
+    },
+}
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+
+class BadRequest(ValueError):
+    pass
+
+
+# --------------------------------------------------------------------------- #
+# Helpers
+# --------------------------------------------------------------------------- #
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat() + 'Z'
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, list):
+        return [_json_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _json_value(v) for k, v in value.items()}
+    return value
+
+
+def _encode_cursor(sort_value, _id):
+    if isinstance(sort_value, datetime):
+        sort_value = {'$date': sort_value.isoformat()}
+    raw = json.dumps([sort_value, str(_id)]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_value, _id = json.loads(raw)
+        if isinstance(sort_value, dict):
+            sort_value = datetime.fromisoformat(sort_value['$date'])
+    except (ValueError, TypeError, KeyError):
+        raise BadRequest('invalid cursor')
+    return sort_value, ObjectId(_id) if ObjectId.is_valid(_id) else _id
+
+
+def _projection(resource):
+    """(mongo projection, output fields) from `fields=`."""
+    public = resource['fields']
+    requested = request.args.get('fields')
+    if requested:
+        fields = [f.strip() for f in requested.split(',') if f.strip()]
+        unknown = [f for f in fields if f not in public]
+        if unknown:
+            raise BadRequest(f"unknown field(s): {', '.join(unknown)}; available: {', '.join(public)}")
+    else:
+        fields = list(public)
+    sort_field = resource['sort'][0]
+    # The sort key is always fetched (the cursor needs it) but only returned if asked for
+    projection = dict.fromkeys(set(fields) | {sort_field}, 1)
+    return projection, fields
+
+
+def _query(name, resource):
+    query = dict(resource['query'])
+    if name in ('dispenses', 'receipts'):
+        window = {}
+        try:
+            if request.args.get('start_date'):
+                window['$gte'] = datetime.strptime(request.args['start_date'], '%Y-%m-%d')
+            if request.args.get('end_date'):
+                window['$lt'] = datetime.strptime(request.args['end_date'], '%Y-%m-%d') + timedelta(days=1)
+        except ValueError:
+            raise BadRequest('dates must be YYYY-MM-DD')
+        if window:
+            query['timestamp'] = window
+        if request.args.get('med_name'):
+            query['med_name'] = request.args['med_name']
+    elif request.args.get('schedule'):
+        query['schedule'] = request.args['schedule']
+    after = request.args.get('after')
+    if after:
+        field, direction = resource['sort']
+        value, last_id = _decode_cursor(after)
+        op = '$lt' if direction < 0 else '$gt'
+        query = {'$and': [query, {'$or': [{field: {op: value}}, {field: value, '_id': {op: last_id}}]}]}
+    return query
+
+
+def _limit(default, maximum=MAX_LIMIT):
+    try:
+        limit = max(int(request.args.get('limit', default)), 1)
+    except ValueError:
+        raise BadRequest('limit must be an integer')
+    return min(limit, maximum) if maximum else limit
+
+
+def _row(doc, fields):
+    row = {'id': str(doc['_id'])}
+    for field in fields:
+        row[field] = _json_value(doc.get(field))
+    return row
+
+
+def _wants_ndjson():
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best == NDJSON
+
+
+# --------------------------------------------------------------------------- #
+# Endpoints
+# --------------------------------------------------------------------------- #
+@api.before_request
+def _require_login():
+    if 'user' not in session:
+        return jsonify({'error': 'Authentication required', 'login': '/login'}), 401
+
+
+@api.errorhandler(BadRequest)
+def _bad_request(error):
+    return jsonify({'error': str(error)}), 400
+
+
+@api.errorhandler(ServerSelectionTimeoutError)
+def _database_unavailable(error):
+    return jsonify({'error': 'Database unavailable'}), 503
+
+
+@api.route('/cube', methods=['GET'])
+def cube():
+    def listed(name):
+        return [v.strip() for v in (request.args.get(name) or '').split(',') if v.strip()]
+
+    by = listed('by')
+    filters = {dim: listed(dim) for dim in CUBE_DIMENSIONS if listed(dim)}
+    months = {}
+    for arg in ('from', 'to'):
+        value = request.args.get(arg)
+        if value:
+            try:
+                datetime.strptime(value, '%Y-%m')
+            except ValueError:
+                raise BadRequest(f'{arg} must be YYYY-MM')
+            months[arg] = value
+    try:
+        rows = query_cube(reporting_db(), by, filters, months.get('from'), months.get('to'),
+                          listed('measures') or CUBE_MEASURES)
+    except ValueError as e:
+        raise BadRequest(str(e))
+    return jsonify({'by': by, 'filters': filters, 'data': rows})
+
+
+@api.route('/medication-cache', methods=['GET'])
+def medication_cache():
+    return jsonify({'pid': os.getpid(), **medication_cache_stats()})
+
+
+@api.route('/<name>', methods=['GET'])
+def list_resource(name):
+    resource = RESOURCES.get(name)
+    if resource is None:
+        return jsonify({'error': 'Not Found'}), 404
+    projection, fields = _projection(resource)
+    query = _query(name, resource)
+    field, direction = resource['sort']
+    sort = [(field, direction), ('_id', direction)]
+    coll = reporting_db()[resource['collection']]
+
+    def find(limit):
+        if resource['collection'] == 'transactions':
+            # hot + archive when the period reaches back past the archive cutoff
+            base = query['$and'][0] if '$and' in query else query
+            start = base.get('timestamp', {}).get('$gte')
+            return find_transactions(coll, query, projection, sort, limit, start=start)
+        return coll.find(query, projection).sort(sort).limit(limit)
+
+    if _wants_ndjson():
+        cap = _limit(0, maximum=None) if request.args.get('limit') else 0     # 0 = everything
+        cursor = find(cap).batch_size(1000)
+
+        def stream():
+            for doc in cursor:
+                yield json.dumps(_row(doc, fields), separators=(',', ':')) + '\n'
+        return Response(stream_with_context(stream()), mimetype=NDJSON)
+
+    limit = _limit(DEFAULT_LIMIT)
+    docs = list(find(limit + 1))
+    more = len(docs) > limit
+    docs = docs[:limit]
+    return jsonify({
+        'data': [_row(doc, fields) for doc in docs],
+        'limit': limit,
+        'next': _encode_cursor(docs[-1].get(field), docs[-1]['_id']) if more else None,
+    })
+
+
+def init_api(flask_app):
+    flask_app.register_blueprint(api)
@@ -1,9 +1,11 @@
 import os
-import requests
-from flask import Flask, request, render_template_string, jsonify, redirect, url_for, session, flash
-from functools import wraps
-from pymongo import MongoClient
-from pymongo.errors import ServerSelectionTimeoutError
+import time
+import threading
+from urllib.parse import unquote
+from flask import Flask, request, render_template, jsonify, redirect, url_for, session, flash, make_response
+from functools import wraps, partial
+import pymongo
+from pymongo.errors import ServerSelectionTimeoutError, PyMongoError
 from datetime import datetime, timedelta, timezone
 from uuid import uuid4
 from collections import defaultdict
@@ -11,11 +13,44 @@ from dotenv import load_dotenv
 from werkzeug.security import generate_password_hash, check_password_hash
 load_dotenv() # Loads .env into os.environ
 from error_logger import init_error_logging
+from db_metrics import init_db_metrics
+from db_breaker import init_db_breaker
+from api_v1 import init_api
+from db import get_client, reporting_db, REPORT_MAX_TIME_MS, REPORT_JOB_MAX_TIME_MS
+from schema import parse_expiry, expiry_of, expiry_range_filter
+import numpy as np
+from stock_engine import (movements_by_med, movement_columns, balances_as_of, stock_status, expiry_column, reorder,
+                          planning_column, planning_update, near_expiry_overrides, widest_near_expiry, as_number,
+                          PLANNING_FIELDS, PLANNING_PROJECTION, DEFAULT_NEAR_EXPIRY_DAYS)
+from forecast import daily_forecast, suggested_order
+from morbidity import (morbidity, parse_params as parse_morbidity_params, cache_search as morbidity_cache_search,
+                       PERIODS as MORBIDITY_PERIODS, DIMENSIONS as MORBIDITY_DIMENSIONS)
+from sick_leave import sick_leave, parse_params as parse_sick_leave_params, cache_search as sick_leave_cache_search
+from lots import add_lot, adjust_lots, remove_from_lot, consume_fefo, expiring_lots, has_lots, lot_totals, batches_of
+from lots import recall, recall_patients, recall_stock
+from lots import release as release_lots
+from report_cache import get_report_cache, invalidate_reports
+from dashboard import count_dispense, count_receive, uncount_dispense_lines
+from dashboard import snapshot as dashboard_snapshot
+from cube import add_dispense, remove_dispense
+from archive import find_transactions
+from catalog import DiagnosisIndex, freeze as freeze_catalog
+from cache_versions import init_cache_versions
+from med_cache import get_medication, forget as forget_medications
+from invoice_import import parse_invoice, apply_invoice, already_received, InvoiceError
+from invoice_import import SHARED_FIELDS as INVOICE_SHARED_FIELDS
+from report_jobs import submit_report_job, get_report_job, job_status
 from bson import ObjectId
 from bson.errors import InvalidId
-app = Flask(__name__)
-init_error_logging(app) # <-- this activates everything
+app = Flask(__name__) # routes register here; logging, metrics, breaker, API, cache versions and audit are attached by create_app()
 app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
+# Compiled page templates, one per *_TEMPLATE source – render_template_string() parses the source on every call
+_compiled_templates = {}
+def render_page(source, **context):
+    template = _compiled_templates.get(source)
+    if template is None:
+        template = _compiled_templates.setdefault(source, app.jinja_env.from_string(source))
+    return render_template(template, **context)
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
 # Diagnosis options
 DIAGNOSES_OPTIONS = [
@@ -86,10 +121,31 @@ DIAGNOSES_OPTIONS = [
     'Drug induced kidney injury', 'Urethral stricture/Urinary outlet obstruction', 'Kidney stone',
     'Bladder stone', 'Warts', 'DM', 'Hyperglycaemia', 'Hypoglycaemia', 'DKA', 'HHS'
 ]
-# MongoDB connection function (lazy initialization for fork-safety)
+DIAGNOSIS_INDEX = DiagnosisIndex(DIAGNOSES_OPTIONS) # read-only, shared by the workers with GUNICORN_PRELOAD (catalog.py)
+# MongoDB connection function (one shared, fork-safe client per worker process – see db.py)
 def get_mongo_client():
-    monguri = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
-    return MongoClient(monguri, serverSelectionTimeoutMS=120000)
+    return get_client()
+# Projections – every list / lookup query names the fields its template or code uses
+DISPENSE_LIST_FIELDS = {'_id': 0, 'transaction_id': 1, 'patient': 1, 'company': 1, 'position': 1, 'age_group': 1,
+                        'gender': 1, 'sick_leave_days': 1, 'diagnoses': 1, 'prescriber': 1, 'dispenser': 1,
+                        'user': 1, 'date': 1, 'med_name': 1, 'quantity': 1, 'timestamp': 1}
+DISPENSE_EDIT_FIELDS = {'_id': 0, 'patient': 1, 'company': 1, 'position': 1, 'age_group': 1, 'gender': 1,
+                        'sick_leave_days': 1, 'diagnoses': 1, 'prescriber': 1, 'dispenser': 1, 'date': 1,
+                        'med_name': 1, 'quantity': 1}
+DISPENSE_RESTORE_FIELDS = {'_id': 0, 'med_name': 1, 'quantity': 1, 'lots': 1, 'timestamp': 1, 'transaction_id': 1,
+                           'company': 1, 'diagnoses': 1, 'age_group': 1, 'gender': 1}
+RECEIVE_LIST_FIELDS = {'med_name': 1, 'quantity': 1, 'batch': 1, 'price': 1, 'expiry_date': 1, 'stock_receiver': 1,
+                       'order_number': 1, 'supplier': 1, 'invoice_number': 1, 'user': 1, 'timestamp': 1}
+RECEIVE_EDIT_FIELDS = {'type': 1, 'med_name': 1, 'quantity': 1, 'batch': 1, 'price': 1, 'expiry_date': 1, 'schedule': 1,
+                       'stock_receiver': 1, 'order_number': 1, 'supplier': 1, 'invoice_number': 1, 'timestamp': 1}
+MED_EDIT_FIELDS = {'_id': 0, 'name': 1, 'balance': 1, 'batch': 1, 'price': 1, 'expiry_date': 1, 'schedule': 1,
+                   'stock_receiver': 1, 'order_number': 1, 'supplier': 1, 'invoice_number': 1, **PLANNING_PROJECTION}
+STOCK_MED_FIELDS = {'_id': 0, 'name': 1, 'balance': 1, 'batch': 1, 'price': 1, 'expiry_date': 1, 'expiry': 1}
+CONTROLLED_TX_FIELDS = {'_id': 0, 'type': 1, 'med_name': 1, 'quantity': 1, 'timestamp': 1, 'date': 1, 'patient': 1,
+                        'company': 1, 'position': 1, 'diagnoses': 1, 'prescriber': 1, 'dispenser': 1, 'user': 1,
+                        'stock_receiver': 1, 'order_number': 1, 'supplier': 1, 'invoice_number': 1, 'batch': 1}
+USER_LOGIN_FIELDS = {'_id': 0, 'password_hash': 1, 'name': 1, 'role': 1}
+EXISTS_ONLY = {'_id': 1}
 # Login required decorator
 def login_required(f):
     @wraps(f)
@@ -107,6 +163,7 @@ def get_nav_links():
         add_med_link = '<a href="/add-medication">Add Medication</a> | ' if is_admin else ''
         return f"""
         <p class="nav-links"><strong>Navigate:</strong>
+            <a href="/">Dashboard</a> |
             <a href="/dispense">Dispensing</a> |
             <a href="/receive">Receiving</a> |
             {add_med_link}
@@ -1322,6 +1379,48 @@ RECEIVE_TEMPLATE = CSS_STYLE + """
     <input type="hidden" name="search"     value="{{ search     or '' }}">
 </form>
 
+{% if not rx_data %}
+<hr>
+
+{# ------------------------------------------------- #}
+{#  INVOICE UPLOAD (whole delivery at once)          #}
+{# ------------------------------------------------- #}
+<h2>Receive a Supplier Invoice (CSV)</h2>
+<p>One row per line with the columns <code>med_name, quantity, batch, price, expiry, schedule</code>
+   (expiry as YYYY-MM-DD, schedule "controlled" or "not controlled").</p>
+
+<form method="POST" action="{{ url_for('receive_invoice') }}" enctype="multipart/form-data" class="invoice-form">
+    <div class="common-section">
+        <div>
+            <label>Invoice CSV:</label>
+            <input name="invoice_file" type="file" accept=".csv,text/csv" required>
+        </div>
+        <div>
+            <label>Stock Receiver:</label>
+            <input name="stock_receiver" required>
+        </div>
+        <div>
+            <label>Order Number:</label>
+            <input name="order_number" required>
+        </div>
+        <div>
+            <label>Supplier:</label>
+            <input name="supplier" required>
+        </div>
+        <div>
+            <label>Invoice Number:</label>
+            <input name="invoice_number" required>
+        </div>
+        <div>
+            <label><input name="allow_duplicate" type="checkbox" value="1"> Invoice was received before – book it again</label>
+        </div>
+    </div>
+    <div class="form-buttons">
+        <input type="submit" value="Receive Invoice">
+    </div>
+</form>
+{% endif %}
+
 <hr>
 
 {# ------------------------------------------------- #}
@@ -1699,6 +1798,49 @@ document.addEventListener('DOMContentLoaded', () => {
 });
 </script>
 """
+RECEIVE_INVOICE_TEMPLATE = CSS_STYLE + """
+<h1>Receiving</h1>
+<p>LD-HSE/NMC/HRD/6.1.3.3</p>
+{{ nav_links|safe }}
+
+{% if message %}
+<p class="message {% if 'successfully' in message|lower %}success{% else %}error{% endif %}">
+    {{ message }}
+</p>
+{% endif %}
+
+{% if shared %}
+<p>Supplier: <strong>{{ shared.supplier }}</strong> – Invoice: <strong>{{ shared.invoice_number }}</strong>
+   – Order: <strong>{{ shared.order_number }}</strong> – Received by: <strong>{{ shared.stock_receiver }}</strong></p>
+{% endif %}
+
+{% if rows %}
+<table>
+    <thead>
+        <tr>
+            <th>Line</th>
+            <th>Medication</th>
+            <th>Quantity</th>
+            <th>Batch</th>
+            <th>Result</th>
+        </tr>
+    </thead>
+    <tbody>
+    {% for r in rows %}
+        <tr>
+            <td>{{ r.line }}</td>
+            <td>{{ r.med_name }}</td>
+            <td>{{ r.quantity }}</td>
+            <td>{{ r.batch }}</td>
+            <td class="{% if r.error %}error{% endif %}">{{ r.error or r.status }}</td>
+        </tr>
+    {% endfor %}
+    </tbody>
+</table>
+{% endif %}
+
+<p><a href="{{ url_for('receive') }}">Back to Receiving</a></p>
+"""
 ADD_MED_TEMPLATE = CSS_STYLE + """
 <h1>Add New Medication</h1>
 <p>LD-HSE/NMC/HRD/6.1.3.3</p>
@@ -2079,6 +2221,18 @@ EDIT_MED_TEMPLATE = CSS_STYLE + """
                 <option value="not controlled" {% if med_data and med_data.schedule == 'not controlled' %}selected{% endif %}>Not Controlled</option>
             </select>
         </div>
+        <div>
+            <label>Lead Time (days, blank = {{ planning_defaults.lead_time_days }}):</label>
+            <input name="lead_time_days" type="number" min="0" value="{{ med_data.lead_time_days if med_data and med_data.lead_time_days is not none else '' }}">
+        </div>
+        <div>
+            <label>Review Period (days, blank = {{ planning_defaults.review_period_days }}):</label>
+            <input name="review_period_days" type="number" min="0" value="{{ med_data.review_period_days if med_data and med_data.review_period_days is not none else '' }}">
+        </div>
+        <div>
+            <label>Near-Expiry Warning (days, blank = {{ planning_defaults.near_expiry_days }}):</label>
+            <input name="near_expiry_days" type="number" min="0" value="{{ med_data.near_expiry_days if med_data and med_data.near_expiry_days is not none else '' }}">
+        </div>
     </div>
     <div class="form-buttons">
         <input type="submit" value="Update Medication">
@@ -2109,8 +2263,22 @@ REPORTS_TEMPLATE = CSS_STYLE + """
     <label>Start Date (YYYY-MM-DD, if applicable):</label><input name="start_date" type="date"><br>
     <label>End Date (YYYY-MM-DD, if applicable):</label><input name="end_date" type="date"><br>
     <label>Search (optional):</label><input name="search" type="text" placeholder="Filter results by relevant fields"><br>
+    <label><input name="background" type="checkbox" value="1"> Run in background (large reports)</label><br>
     <input type="submit" value="Generate Report">
 </form>
+<p><a href="{{ url_for('morbidity_report') }}">Morbidity report (diagnoses by period, company, age group, gender)</a> |
+   <a href="{{ url_for('sick_leave_report') }}">Sick leave report (days by company, month, diagnosis)</a></p>
+{% if cache_info %}
+<form method="POST" action="{{ url_for('reports') }}" class="filter-form">
+    <p>Cached result – computed {{ cache_info.computed_at.strftime('%Y-%m-%d %H:%M:%S') }} UTC in {{ cache_info.compute_ms }} ms.</p>
+    <input type="hidden" name="report_type" value="{{ report_type }}">
+    <input type="hidden" name="start_date" value="{{ start_date or '' }}">
+    <input type="hidden" name="end_date" value="{{ end_date or '' }}">
+    <input type="hidden" name="search" value="{{ search or '' }}">
+    <input type="hidden" name="refresh" value="1">
+    <input type="submit" value="Recompute">
+</form>
+{% endif %}
 {% if report_type in ['stock_on_hand', 'expired_list', 'near_expired_list', 'out_of_stock_list'] and stock_data %}
 <form method="POST" action="{{ url_for('reports') }}" class="filter-form">
     <input type="hidden" name="report_type" value="{{ report_type }}">
@@ -2194,6 +2362,9 @@ REPORTS_TEMPLATE = CSS_STYLE + """
             <th>Received</th>
             <th>Current Balance</th>
             <th>Amount to Order</th>
+            <th>Forecast / Day</th>
+            <th>Forecast Demand</th>
+            <th>Suggested Order</th>
         </tr>
     </thead>
     <tbody>
@@ -2205,9 +2376,12 @@ REPORTS_TEMPLATE = CSS_STYLE + """
             <td>{{ row.received }}</td>
             <td>{{ row.current_balance }}</td>
             <td>{{ row.amount_to_order }}</td>
+            <td>{{ row.forecast_daily }}</td>
+            <td>{{ row.forecast_demand }}</td>
+            <td>{{ row.suggested_order }}</td>
         </tr>
     {% else %}
-        <tr><td colspan="6">No data for this period.</td></tr>
+        <tr><td colspan="9">No data for this period.</td></tr>
     {% endfor %}
     </tbody>
 </table>
@@ -2332,6 +2506,264 @@ REPORTS_TEMPLATE = CSS_STYLE + """
 <p>No controlled drugs found or no data for this period.</p>
 {% endif %}
 """
+# Background report job (progress page, polls /api/report-jobs/<id>)
+REPORT_JOB_TEMPLATE = CSS_STYLE + """
+<h1>Inventory Reports</h1>
+{{ nav_links|safe }}
+<h2>Generating report in the background…</h2>
+<p>Report: <strong>{{ job.report_type }}</strong> – status: <span id="job-status">{{ job.status }}</span></p>
+<p><progress id="job-progress" max="{{ job.progress.total or 1 }}" value="{{ job.progress.done or 0 }}"></progress>
+   <span id="job-count">{{ job.progress.done or 0 }} / {{ job.progress.total or '?' }}</span></p>
+<p>You can leave this page open – it will show the report as soon as it is ready.</p>
+<p><a href="{{ url_for('reports') }}">Back to Menu</a></p>
+<script>
+(function poll() {
+    fetch("{{ url_for('report_job_status', job_id=job.job_id) }}", {headers: {'Accept': 'application/json'}})
+        .then(r => r.json())
+        .then(job => {
+            if (job.status === 'done' || job.status === 'failed' || job.error) {
+                window.location.reload();
+                return;
+            }
+            document.getElementById('job-status').textContent = job.status;
+            if (job.progress && job.progress.total) {
+                const bar = document.getElementById('job-progress');
+                bar.max = job.progress.total;
+                bar.value = job.progress.done;
+                document.getElementById('job-count').textContent = job.progress.done + ' / ' + job.progress.total;
+            }
+            setTimeout(poll, 1500);
+        })
+        .catch(() => setTimeout(poll, 3000));
+})();
+</script>
+"""
+MORBIDITY_TEMPLATE = CSS_STYLE + """
+<h1>Morbidity Report</h1>
+<p>LD-HSE/NMC/HRD/6.1.3.3</p>
+{{ nav_links|safe }}
+{% if message %}
+    <p class="message error">{{ message }}</p>
+{% endif %}
+<form method="GET" action="{{ url_for('morbidity_report') }}" class="filter-form">
+    <div class="filter-section">
+        <div>
+            <label>Start Date:</label>
+            <input name="start_date" type="date" value="{{ params.start_date if params else '' }}">
+        </div>
+        <div>
+            <label>End Date:</label>
+            <input name="end_date" type="date" value="{{ params.end_date if params else '' }}">
+        </div>
+        <div>
+            <label>Period:</label>
+            <select name="period">
+                {% for p in periods %}
+                <option value="{{ p }}" {% if params and params.period == p %}selected{% endif %}>{{ p|capitalize }}</option>
+                {% endfor %}
+            </select>
+        </div>
+        <div>
+            <label>Break down by:</label>
+            <select name="by">
+                <option value="">-- None --</option>
+                {% for d in dimensions %}
+                <option value="{{ d }}" {% if params and params.by == d %}selected{% endif %}>{{ d|replace('_', ' ')|capitalize }}</option>
+                {% endfor %}
+            </select>
+        </div>
+        <div>
+            <label>Top:</label>
+            <input name="top" type="number" min="1" max="100" value="{{ params.top if params else 10 }}">
+        </div>
+        <div>
+            <label>Diagnosis:</label>
+            <input name="diagnosis" type="text" value="{{ params.diagnosis or '' if params else '' }}" placeholder="Drill down into one diagnosis">
+        </div>
+        {% for d in dimensions %}
+        <div>
+            <label>{{ d|replace('_', ' ')|capitalize }} is:</label>
+            <input name="{{ d }}" type="text" value="{{ params.filters.get(d, '') if params else '' }}" placeholder="Any">
+        </div>
+        {% endfor %}
+        <div class="button-div">
+            <input type="submit" value="Refine">
+            <a href="{{ url_for('reports') }}">Back to Menu</a>
+        </div>
+    </div>
+</form>
+{% if result %}
+<h2>{% if params.diagnosis %}{{ params.diagnosis }}: {% endif %}Cases from {{ params.start_date }} to {{ params.end_date }}</h2>
+<p>{{ result.visits }} visits, {{ result.cases }} diagnosis cases.
+   {% if cache_info %}<small>Cached result – computed {{ cache_info.computed_at.strftime('%Y-%m-%d %H:%M:%S') }} UTC in {{ cache_info.compute_ms }} ms.</small>{% endif %}</p>
+{% if not params.diagnosis %}
+<h3>Top {{ params.top }} diagnoses</h3>
+<table>
+    <thead>
+        <tr><th>#</th><th>Diagnosis</th><th>Cases</th></tr>
+    </thead>
+    <tbody>
+    {% for name, cases in result.top %}
+        <tr>
+            <td>{{ loop.index }}</td>
+            <td><a href="{{ drill(diagnosis=name) }}">{{ name }}</a></td>
+            <td>{{ cases }}</td>
+        </tr>
+    {% else %}
+        <tr><td colspan="3">No dispenses with diagnoses in this period.</td></tr>
+    {% endfor %}
+    </tbody>
+</table>
+{% endif %}
+{% if result.rows %}
+<h3>By {{ params.period }}{% if params.by %} and {{ params.by|replace('_', ' ') }}{% endif %}</h3>
+<table>
+    <thead>
+        <tr>
+            <th>Diagnosis</th>
+            {% if params.by %}<th>{{ params.by|replace('_', ' ')|capitalize }}</th>{% endif %}
+            <th>Total</th>
+            {% for p in result.periods %}<th>{{ p }}</th>{% endfor %}
+        </tr>
+    </thead>
+    <tbody>
+    {% for row in result.rows %}
+        <tr>
+            <td><a href="{{ drill(diagnosis=row.diagnosis) }}">{{ row.diagnosis }}</a></td>
+            {% if params.by %}<td><a href="{{ drill(**{params.by: row.value or ''}) }}">{{ row.value or '—' }}</a></td>{% endif %}
+            <td>{{ row.cases }}</td>
+            {% for p in result.periods %}<td>{{ row.by_period.get(p, 0) }}</td>{% endfor %}
+        </tr>
+    {% endfor %}
+    </tbody>
+</table>
+{% endif %}
+{% endif %}
+"""
+SICK_LEAVE_TEMPLATE = CSS_STYLE + """
+<h1>Sick Leave Report</h1>
+<p>LD-HSE/NMC/HRD/6.1.3.3</p>
+{{ nav_links|safe }}
+{% if message %}
+    <p class="message error">{{ message }}</p>
+{% endif %}
+<form method="GET" action="{{ url_for('sick_leave_report') }}" class="filter-form">
+    <div class="filter-section">
+        <div>
+            <label>Start Date:</label>
+            <input name="start_date" type="date" value="{{ params.start_date if params else '' }}">
+        </div>
+        <div>
+            <label>End Date:</label>
+            <input name="end_date" type="date" value="{{ params.end_date if params else '' }}">
+        </div>
+        <div>
+            <label>Company:</label>
+            <input name="company" type="text" value="{{ params.company or '' if params else '' }}" placeholder="All companies">
+        </div>
+        <div>
+            <label>Primary Diagnosis:</label>
+            <input name="diagnosis" type="text" value="{{ params.diagnosis or '' if params else '' }}" placeholder="All diagnoses">
+        </div>
+        <div class="button-div">
+            <input type="submit" value="Refine">
+            <a href="{{ url_for('reports') }}">Back to Menu</a>
+        </div>
+    </div>
+</form>
+{% if result %}
+<h2>Sick Leave from {{ params.start_date }} to {{ params.end_date }}</h2>
+<p>{{ result.total.days }} days of sick leave over {{ result.total.leave_visits }} of {{ result.total.visits }} visits
+   (each visit counted once, under its primary diagnosis).
+   {% if cache_info %}<small>Cached result – computed {{ cache_info.computed_at.strftime('%Y-%m-%d %H:%M:%S') }} UTC in {{ cache_info.compute_ms }} ms.</small>{% endif %}</p>
+<h3>By company</h3>
+<table>
+    <thead>
+        <tr><th>Company</th><th>Visits</th><th>Visits with Sick Leave</th><th>Sick Leave Days</th></tr>
+    </thead>
+    <tbody>
+    {% for company, totals in result.companies|dictsort %}
+        <tr>
+            <td>{{ company or '—' }}</td>
+            <td>{{ totals.visits }}</td>
+            <td>{{ totals.leave_visits }}</td>
+            <td>{{ totals.days }}</td>
+        </tr>
+    {% else %}
+        <tr><td colspan="4">No dispenses in this period.</td></tr>
+    {% endfor %}
+    </tbody>
+</table>
+{% if result.rows %}
+<h3>By company, month and diagnosis</h3>
+<table>
+    <thead>
+        <tr><th>Company</th><th>Month</th><th>Primary Diagnosis</th><th>Visits</th><th>Visits with Sick Leave</th><th>Sick Leave Days</th></tr>
+    </thead>
+    <tbody>
+    {% for row in result.rows %}
+        <tr>
+            <td>{{ row.company or '—' }}</td>
+            <td>{{ row.month }}</td>
+            <td>{{ row.diagnosis }}</td>
+            <td>{{ row.visits }}</td>
+            <td>{{ row.leave_visits }}</td>
+            <td>{{ row.days }}</td>
+        </tr>
+        {% if loop.last or loop.nextitem.company != row.company or loop.nextitem.month != row.month %}
+        {% set subtotal = result.subtotals[(row.company, row.month)] %}
+        <tr>
+            <td colspan="3"><strong>{{ row.company or '—' }} – {{ row.month }} total</strong></td>
+            <td><strong>{{ subtotal.visits }}</strong></td>
+            <td><strong>{{ subtotal.leave_visits }}</strong></td>
+            <td><strong>{{ subtotal.days }}</strong></td>
+        </tr>
+        {% endif %}
+    {% endfor %}
+    </tbody>
+</table>
+{% endif %}
+{% endif %}
+"""
+DASHBOARD_TEMPLATE = CSS_STYLE + """
+<h1>Pharmacy Dashboard</h1>
+{{ nav_links|safe }}
+
+{% if message %}
+<p class="message error">{{ message }}</p>
+{% endif %}
+
+{% if figures %}
+{% set today = figures.today %}
+{% set yesterday = figures.yesterday %}
+<h2>Today ({{ figures.day }} UTC)</h2>
+<table>
+    <thead>
+        <tr><th></th><th>Today</th><th>Yesterday</th></tr>
+    </thead>
+    <tbody>
+        <tr><td>Dispense transactions</td><td>{{ today.dispenses or 0 }}</td><td>{{ yesterday.dispenses or 0 }}</td></tr>
+        <tr><td>Lines dispensed</td><td>{{ today.dispense_lines or 0 }}</td><td>{{ yesterday.dispense_lines or 0 }}</td></tr>
+        <tr><td>Units dispensed</td><td>{{ today.units_dispensed or 0 }}</td><td>{{ yesterday.units_dispensed or 0 }}</td></tr>
+        <tr><td>Lines received</td><td>{{ today.receive_lines or 0 }}</td><td>{{ yesterday.receive_lines or 0 }}</td></tr>
+        <tr><td>Controlled drug movements (lines)</td><td>{{ today.controlled_lines or 0 }}</td><td>{{ yesterday.controlled_lines or 0 }}</td></tr>
+        <tr><td>Controlled units in / out</td>
+            <td>{{ today.controlled_units_in or 0 }} / {{ today.controlled_units_out or 0 }}</td>
+            <td>{{ yesterday.controlled_units_in or 0 }} / {{ yesterday.controlled_units_out or 0 }}</td></tr>
+    </tbody>
+</table>
+
+<h2>Stock</h2>
+<table>
+    <tbody>
+        <tr><td>Medications</td><td>{{ figures.medications }}</td></tr>
+        <tr><td>Out of stock</td><td>{{ figures.out_of_stock }}</td></tr>
+        <tr><td>Expiring within {{ near_expiry_days }} days (or the medication's own window)</td><td>{{ figures.near_expiry }}</td></tr>
+    </tbody>
+</table>
+<p><small>As of {{ figures.generated_at.strftime('%H:%M:%S') }} UTC – details under <a href="/reports">Reports</a>.</small></p>
+{% endif %}
+"""
 # Login Template
 LOGIN_TEMPLATE = CSS_STYLE + """
 <h1>Pharmacy App Login</h1>
@@ -2402,7 +2834,14 @@ REGISTER_TEMPLATE = CSS_STYLE + """
 @app.route('/', methods=['GET'])
 @login_required
 def home():
-    return redirect('/reports')
+    try:
+        figures = dashboard_snapshot(get_mongo_client()['pharmacy_db'])
+        return render_page(DASHBOARD_TEMPLATE, nav_links=get_nav_links(), figures=figures,
+                                      near_expiry_days=DEFAULT_NEAR_EXPIRY_DAYS, message=None)
+    except ServerSelectionTimeoutError:
+        return render_page(DASHBOARD_TEMPLATE, nav_links=get_nav_links(), figures=None,
+                                      near_expiry_days=DEFAULT_NEAR_EXPIRY_DAYS,
+                                      message="Database connection failed. Please try again later."), 500
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -2416,7 +2855,7 @@ def login():
             client = get_mongo_client()
             db = client['pharmacy_db']
             users = db['users']
-            user_doc = users.find_one({'username': username})
+            user_doc = users.find_one({'username': username}, USER_LOGIN_FIELDS)
             if user_doc and check_password_hash(user_doc['password_hash'], password):
                 session['user'] = {
                     'login': username,
@@ -2428,12 +2867,10 @@ def login():
                 session['error'] = 'Invalid username or password.'
         except ServerSelectionTimeoutError:
             session['error'] = 'Database connection failed. Please try again later.'
-        finally:
-            client.close()
         return redirect('/login')
   
     error = session.pop('error', None)
-    return render_template_string(LOGIN_TEMPLATE, error=error)
+    return render_page(LOGIN_TEMPLATE, error=error)
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -2463,7 +2900,7 @@ def register():
                 client = get_mongo_client()
                 db = client['pharmacy_db']
                 users = db['users']
-                if users.find_one({'username': username}):
+                if users.find_one({'username': username}, EXISTS_ONLY):
                     session['error'] = 'Username already exists.'
                     return redirect('/register')
               
@@ -2479,16 +2916,14 @@ def register():
                 return redirect('/login')
             except ServerSelectionTimeoutError:
                 session['error'] = 'Database connection failed. Please try again later.'
-            finally:
-                client.close()
             return redirect('/register')
   
     error = session.pop('error', None)
     message = session.pop('message', None)
     if 'admin_access' not in session:
-        return render_template_string(REGISTER_PASSWORD_TEMPLATE, error=error)
+        return render_page(REGISTER_PASSWORD_TEMPLATE, error=error)
     else:
-        return render_template_string(REGISTER_TEMPLATE, error=error, message=message)
+        return render_page(REGISTER_TEMPLATE, error=error, message=message)
 @app.route('/logout', methods=['GET'])
 def logout():
     session.pop('user', None)
@@ -2531,15 +2966,15 @@ def dispense():
                 {'diagnoses.0': {'$regex': search, '$options': 'i'}},
             ]
             base_query['$or'] = or_query
-        tx_list = list(transactions.find(base_query).sort('timestamp', -1))
+        tx_list = list(transactions.find(base_query, DISPENSE_LIST_FIELDS).sort('timestamp', -1))
         tx_data = None
         edit_id = request.args.get('edit')
         if edit_id:
-            tx = transactions.find_one({'transaction_id': edit_id, 'type': 'dispense'})
-            if tx:
-                common = {k: v for k, v in tx.items() if k not in ['_id', 'med_name', 'quantity', 'type', 'timestamp', 'transaction_id', 'user']}
-                meds_cursor = transactions.find({'transaction_id': edit_id, 'type': 'dispense'}, {'med_name': 1, 'quantity': 1})
-                meds = [(m['med_name'], m['quantity']) for m in meds_cursor]
+            # One query for all lines: the shared form fields come from the first line
+            lines = list(transactions.find({'transaction_id': edit_id, 'type': 'dispense'}, DISPENSE_EDIT_FIELDS))
+            if lines:
+                common = {k: v for k, v in lines[0].items() if k not in ['med_name', 'quantity']}
+                meds = [(m['med_name'], m['quantity']) for m in lines]
                 common['meds'] = meds
                 common['diags'] = common.get('diagnoses', [])
                 common['transaction_id'] = edit_id
@@ -2548,12 +2983,16 @@ def dispense():
             transaction_id = request.form.get('transaction_id')
             if transaction_id:
                 # Edit mode
-                old_meds = list(transactions.find({'transaction_id': transaction_id}))
+                old_meds = list(transactions.find({'transaction_id': transaction_id}, DISPENSE_RESTORE_FIELDS))
                 for old_tx in old_meds:
                     med_name = old_tx['med_name']
                     old_qty = old_tx['quantity']
                     medications.update_one({'name': med_name}, {'$inc': {'balance': old_qty}})
+                    release_lots(db, old_tx.get('lots'))
                 transactions.delete_many({'transaction_id': transaction_id})
+                invalidate_reports('dispense', [t['med_name'] for t in old_meds], [t['timestamp'] for t in old_meds])
+                uncount_dispense_lines(db, old_meds)
+                remove_dispense(db, old_meds)
                 tx_id = transaction_id
                 message_prefix = 'Updated'
             else:
@@ -2590,19 +3029,26 @@ def dispense():
                         success = True
                         error_msgs = []
                         dispensed_meds = []
+                        dispensed_lines = []
+                        dispensed_docs = []
+                        controlled_names = set()
                         for med_name, quantity in zip(med_names, quantities):
-                            med = medications.find_one({'name': med_name})
+                            # Existence / schedule / batch from the medication cache; the balance only in MongoDB
+                            med = get_medication(db, med_name)
                             if not med:
                                 error_msgs.append(f'Medication "{med_name}" not found.')
                                 success = False
                                 continue
-                            elif med.get('balance', 0) < quantity:
-                                error_msgs.append(f'Insufficient stock for "{med_name}".')
-                                success = False
-                                continue
                             else:
-                                medications.update_one({'name': med_name}, {'$inc': {'balance': -quantity}})
-                                transactions.insert_one({
+                                # Guarded decrement: the stock check and the update are one atomic operation
+                                taken = medications.update_one({'name': med_name, 'balance': {'$gte': quantity}}, {'$inc': {'balance': -quantity}})
+                                if taken.modified_count == 0:
+                                    error_msgs.append(f'Insufficient stock for "{med_name}".')
+                                    success = False
+                                    continue
+                                # First-expiry-first-out draw from the lots (one bulk update)
+                                allocations = consume_fefo(db, med_name, quantity, fallback_batch=med.get('batch'))
+                                line = {
                                     'type': 'dispense',
                                     'transaction_id': tx_id,
                                     'patient': patient,
@@ -2618,20 +3064,29 @@ def dispense():
                                     'date': date_str,
                                     'med_name': med_name,
                                     'quantity': quantity,
+                                    'lots': [{'lot_id': a['lot_id'], 'batch': a['batch'], 'quantity': a['quantity']} for a in allocations],
+                                    'batch': batches_of(allocations),
                                     'timestamp': datetime.utcnow()
-                                })
+                                }
+                                transactions.insert_one(line)
+                                dispensed_docs.append(line)
                                 dispensed_meds.append(med_name)
+                                dispensed_lines.append((med_name, quantity))
+                                if med.get('schedule') == 'controlled':
+                                    controlled_names.add(med_name)
+                        if dispensed_meds:
+                            invalidate_reports('dispense', dispensed_meds)
+                            count_dispense(db, dispensed_lines, controlled_names)
+                            add_dispense(db, dispensed_docs)
                         if success and dispensed_meds:
                             message = f'{message_prefix} successfully: {", ".join(dispensed_meds)}'
                         else:
                             message = '; '.join(error_msgs) if error_msgs else f'No medications {message_prefix.lower()}.'
             except ValueError as e:
                 message = f'Invalid input: {str(e)}'
-        return render_template_string(DISPENSE_TEMPLATE, tx_list=tx_list, nav_links=get_nav_links(), message=message, start_date=start_date, end_date=end_date, search=search, tx_data=tx_data)
+        return render_page(DISPENSE_TEMPLATE, tx_list=tx_list, nav_links=get_nav_links(), message=message, start_date=start_date, end_date=end_date, search=search, tx_data=tx_data)
     except ServerSelectionTimeoutError:
-        return render_template_string(DISPENSE_TEMPLATE, tx_list=[], nav_links=get_nav_links(), message="Database connection failed. Please try again later.", start_date='', end_date='', search='', tx_data=None), 500
-    finally:
-        client.close()
+        return render_page(DISPENSE_TEMPLATE, tx_list=[], nav_links=get_nav_links(), message="Database connection failed. Please try again later.", start_date='', end_date='', search='', tx_data=None), 500
 @app.route('/receive', methods=['GET', 'POST'])
 @login_required
 def receive():
@@ -2666,11 +3121,11 @@ def receive():
                 {'expiry_date': {'$regex': search, '$options': 'i'}},
             ]
             base_query['$or'] = or_query
-        tx_list = list(transactions.find(base_query).sort('timestamp', -1))
+        tx_list = list(transactions.find(base_query, RECEIVE_LIST_FIELDS).sort('timestamp', -1))
         rx_data = None
         edit_id = request.args.get('edit')
         if edit_id and edit_id != 'new':
-            rx = transactions.find_one({'_id': edit_id, 'type': 'receive'})
+            rx = transactions.find_one({'_id': edit_id, 'type': 'receive'}, RECEIVE_EDIT_FIELDS)
             if rx:
                 rx_data = rx
                 rx_data['receive_id'] = str(rx['_id'])
@@ -2686,13 +3141,14 @@ def receive():
                 order_number = request.form['order_number']
                 supplier = request.form['supplier']
                 invoice_number = request.form['invoice_number']
-                medications.update_one(
+                result = medications.update_one(
                     {'name': med_name},
                     {'$inc': {'balance': quantity},
                      '$set': {
                          'batch': batch,
                          'price': price,
                          'expiry_date': expiry_date,
+                         'expiry': parse_expiry(expiry_date),
                          'schedule': schedule,
                          'stock_receiver': stock_receiver,
                          'order_number': order_number,
@@ -2708,6 +3164,7 @@ def receive():
                     'batch': batch,
                     'price': price,
                     'expiry_date': expiry_date,
+                    'expiry': parse_expiry(expiry_date),
                     'schedule': schedule,
                     'stock_receiver': stock_receiver,
                     'order_number': order_number,
@@ -2716,10 +3173,16 @@ def receive():
                     'user': current_user,
                     'timestamp': datetime.utcnow()
                 })
+                add_lot(db, med_name, batch, expiry_date, quantity, price)
+                forget_medications([med_name])
+                invalidate_reports('receive', [med_name])
+                count_receive(db, [(med_name, quantity)], {med_name} if schedule == 'controlled' else set())
+                if result.upserted_id is not None:
+                    invalidate_reports('medication', [med_name])
                 message = 'Received successfully!'
             except ValueError as e:
                 message = f'Invalid input: {str(e)}'
-        return render_template_string(
+        return render_page(
             RECEIVE_TEMPLATE,
             tx_list=tx_list,
             nav_links=get_nav_links(),
@@ -2730,9 +3193,56 @@ def receive():
             rx_data=rx_data
         )
     except ServerSelectionTimeoutError:
-        return render_template_string(RECEIVE_TEMPLATE, tx_list=[], nav_links=get_nav_links(), message="Database connection failed.", start_date='', end_date='', search=''), 500
-    finally:
-        client.close()
+        return render_page(RECEIVE_TEMPLATE, tx_list=[], nav_links=get_nav_links(), message="Database connection failed.", start_date='', end_date='', search=''), 500
+@app.route('/receive/invoice', methods=['POST'])
+@login_required
+def receive_invoice():
+    shared = {field: (request.form.get(field) or '').strip() for field in INVOICE_SHARED_FIELDS}
+    rows = []
+    try:
+        upload = request.files.get('invoice_file')
+        if not upload or not upload.filename:
+            raise InvoiceError('Please choose an invoice CSV file.')
+        missing = [field.replace('_', ' ') for field, value in shared.items() if not value]
+        if missing:
+            raise InvoiceError(f"Please fill in: {', '.join(missing)}.")
+        raw = upload.read()
+        try:
+            text = raw.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            text = raw.decode('latin-1')
+        lines = parse_invoice(text)
+        invalid = [entry for entry in lines if entry['error']]
+        if invalid:
+            # Validate everything first – a partly booked invoice is harder to fix than a rejected one
+            rows = [dict(entry['data'] or {k: entry['raw'].get(k) for k in ('med_name', 'quantity', 'batch')},
+                         line=entry['line'], error=entry['error'], status='valid (not received)')
+                    for entry in lines]
+            message = f'{len(invalid)} of {len(lines)} line(s) are invalid – nothing was received. Fix the file and upload it again.'
+            return render_page(RECEIVE_INVOICE_TEMPLATE, nav_links=get_nav_links(), message=message,
+                                          rows=rows, shared=shared), 400
+        db = get_mongo_client()['pharmacy_db']
+        if already_received(db, shared['supplier'], shared['invoice_number']) and not request.form.get('allow_duplicate'):
+            raise InvoiceError(f"Invoice {shared['invoice_number']} from {shared['supplier']} has already been received. "
+                               'Tick "book it again" if this is a second delivery.')
+        rows, created = apply_invoice(db, lines, shared, session['user']['name'])
+        forget_medications({entry['data']['med_name'] for entry in lines})
+        invalidate_reports('receive', [entry['data']['med_name'] for entry in lines])
+        count_receive(db, [(entry['data']['med_name'], entry['data']['quantity']) for entry in lines],
+                      {entry['data']['med_name'] for entry in lines if entry['data']['schedule'] == 'controlled'})
+        if created:
+            invalidate_reports('medication', created)
+        units = sum(entry['data']['quantity'] for entry in lines)
+        message = f'Invoice received successfully: {len(lines)} line(s), {units} unit(s).'
+        return render_page(RECEIVE_INVOICE_TEMPLATE, nav_links=get_nav_links(), message=message,
+                                      rows=rows, shared=shared)
+    except InvoiceError as e:
+        return render_page(RECEIVE_INVOICE_TEMPLATE, nav_links=get_nav_links(), message=str(e),
+                                      rows=rows, shared=shared), 400
+    except ServerSelectionTimeoutError:
+        return render_page(RECEIVE_INVOICE_TEMPLATE, nav_links=get_nav_links(),
+                                      message='Database connection failed. Nothing was received.',
+                                      rows=[], shared=shared), 500
 @app.route('/add-medication', methods=['GET', 'POST'])
 @login_required
 def add_medication():
@@ -2758,15 +3268,16 @@ def add_medication():
                 order_number = request.form['order_number']
                 supplier = request.form['supplier']
                 invoice_number = request.form['invoice_number']
-                if medications.find_one({'name': med_name}):
+                if get_medication(db, med_name):
                     message = f'Medication "{med_name}" already exists. Use Receiving to add stock.'
-                    return render_template_string(ADD_MED_TEMPLATE, nav_links=get_nav_links(), message=message)
+                    return render_page(ADD_MED_TEMPLATE, nav_links=get_nav_links(), message=message)
                 medications.insert_one({
                     'name': med_name,
                     'balance': initial_balance,
                     'batch': batch,
                     'price': price,
                     'expiry_date': expiry_date,
+                    'expiry': parse_expiry(expiry_date),
                     'schedule': schedule,
                     'stock_receiver': stock_receiver,
                     'order_number': order_number,
@@ -2780,6 +3291,7 @@ def add_medication():
                     'batch': batch,
                     'price': price,
                     'expiry_date': expiry_date,
+                    'expiry': parse_expiry(expiry_date),
                     'schedule': schedule,
                     'stock_receiver': stock_receiver,
                     'order_number': order_number,
@@ -2788,16 +3300,19 @@ def add_medication():
                     'user': current_user,
                     'timestamp': datetime.utcnow()
                 })
+                add_lot(db, med_name, batch, expiry_date, initial_balance, price)
+                forget_medications([med_name])
+                invalidate_reports('receive', [med_name])
+                invalidate_reports('medication', [med_name])
+                count_receive(db, [(med_name, initial_balance)], {med_name} if schedule == 'controlled' else set())
                 message = 'Medication added successfully!'
-                return render_template_string(ADD_MED_TEMPLATE, nav_links=get_nav_links(), message=message)
+                return render_page(ADD_MED_TEMPLATE, nav_links=get_nav_links(), message=message)
             except ValueError as e:
                 message = f'Invalid input: {str(e)}'
-                return render_template_string(ADD_MED_TEMPLATE, nav_links=get_nav_links(), message=message)
-        return render_template_string(ADD_MED_TEMPLATE, nav_links=get_nav_links(), message=message)
+                return render_page(ADD_MED_TEMPLATE, nav_links=get_nav_links(), message=message)
+        return render_page(ADD_MED_TEMPLATE, nav_links=get_nav_links(), message=message)
     except ServerSelectionTimeoutError:
-        return render_template_string(ADD_MED_TEMPLATE, nav_links=get_nav_links(), message="Database connection failed. Please try again later."), 500
-    finally:
-        client.close()
+        return render_page(ADD_MED_TEMPLATE, nav_links=get_nav_links(), message="Database connection failed. Please try again later."), 500
 @app.route('/edit-medication/<med_name>', methods=['GET', 'POST'])
 @login_required
 def edit_medication(med_name):
@@ -2811,11 +3326,11 @@ def edit_medication(med_name):
         message = None
         med_data = None
         # URL decode med_name if necessary
-        med_name = requests.utils.unquote(med_name)
-        med = medications.find_one({'name': med_name})
+        med_name = unquote(med_name)
+        med = medications.find_one({'name': med_name}, MED_EDIT_FIELDS)
         if not med:
             message = f'Medication "{med_name}" not found.'
-            return render_template_string(EDIT_MED_TEMPLATE, nav_links=get_nav_links(), message=message, med_data=None, med_name=med_name)
+            return render_page(EDIT_MED_TEMPLATE, nav_links=get_nav_links(), planning_defaults=PLANNING_FIELDS, message=message, med_data=None, med_name=med_name)
         med_data = med
         if request.method == 'POST':
             try:
@@ -2824,30 +3339,34 @@ def edit_medication(med_name):
                 price = float(request.form['price'])
                 expiry_date = request.form['expiry_date']
                 schedule = request.form['schedule']
-                # Update the medication
-                medications.update_one(
-                    {'name': med_name},
-                    {'$set': {
-                        'balance': balance,
-                        'batch': batch,
-                        'price': price,
-                        'expiry_date': expiry_date,
-                        'schedule': schedule
-                    }}
-                )
+                planning, cleared = planning_update(request.form)
+                update = {'$set': {
+                    'balance': balance,
+                    'batch': batch,
+                    'price': price,
+                    'expiry_date': expiry_date,
+                    'expiry': parse_expiry(expiry_date),
+                    'schedule': schedule,
+                    **planning
+                }}
+                if cleared:
+                    update['$unset'] = cleared
+                # Update the medication, and its lots so FEFO and the expiry reports see the edit
+                medications.update_one({'name': med_name}, update)
+                adjust_lots(db, med_name, batch, expiry_date, price, balance - med.get('balance', 0))
+                forget_medications([med_name])
+                invalidate_reports('medication', [med_name])
                 message = 'Medication updated successfully!'
                 # Refresh med_data after update
-                med_data = medications.find_one({'name': med_name})
-                return render_template_string(EDIT_MED_TEMPLATE, nav_links=get_nav_links(), message=message, med_data=med_data, med_name=med_name)
+                med_data = medications.find_one({'name': med_name}, MED_EDIT_FIELDS)
+                return render_page(EDIT_MED_TEMPLATE, nav_links=get_nav_links(), planning_defaults=PLANNING_FIELDS, message=message, med_data=med_data, med_name=med_name)
             except ValueError as e:
                 message = f'Invalid input: {str(e)}'
-                return render_template_string(EDIT_MED_TEMPLATE, nav_links=get_nav_links(), message=message, med_data=med_data, med_name=med_name)
-        return render_template_string(EDIT_MED_TEMPLATE, nav_links=get_nav_links(), message=message, med_data=med_data, med_name=med_name)
+                return render_page(EDIT_MED_TEMPLATE, nav_links=get_nav_links(), planning_defaults=PLANNING_FIELDS, message=message, med_data=med_data, med_name=med_name)
+        return render_page(EDIT_MED_TEMPLATE, nav_links=get_nav_links(), planning_defaults=PLANNING_FIELDS, message=message, med_data=med_data, med_name=med_name)
     except ServerSelectionTimeoutError:
         message = "Database connection failed. Please try again later."
-        return render_template_string(EDIT_MED_TEMPLATE, nav_links=get_nav_links(), message=message, med_data=None, med_name=med_name), 500
-    finally:
-        client.close()
+        return render_page(EDIT_MED_TEMPLATE, nav_links=get_nav_links(), planning_defaults=PLANNING_FIELDS, message=message, med_data=None, med_name=med_name), 500
 @app.route('/delete-medication', methods=['POST'])
 @login_required
 def delete_medication():
@@ -2862,29 +3381,268 @@ def delete_medication():
         client = get_mongo_client()
         db = client['pharmacy_db']
         medications = db['medications']
-        med = medications.find_one({'name': med_name})
+        med = medications.find_one({'name': med_name}, EXISTS_ONLY)
         if not med:
             session['message'] = f'Medication "{med_name}" not found.'
             return redirect('/reports')
         result = medications.delete_one({'name': med_name})
         if result.deleted_count > 0:
+            forget_medications([med_name])
+            invalidate_reports('medication', [med_name])
             session['message'] = f'Medication "{med_name}" deleted successfully.'
         else:
             session['message'] = f'Failed to delete "{med_name}".'
     except Exception as e:
         session['message'] = f'Error deleting medication: {str(e)}'
-    finally:
-        client.close()
     return redirect('/reports')
+# Report computation (shared by /reports and the report cache)
+STOCK_REPORT_TYPES = ['stock_on_hand', 'expired_list', 'near_expired_list', 'out_of_stock_list']
+def matches_search(tx, search_str):
+    if not search_str:
+        return True
+    search_lower = search_str.lower()
+    check_fields = ['patient', 'med_name', 'company', 'position', 'prescriber', 'dispenser', 'stock_receiver', 'order_number', 'supplier', 'invoice_number', 'batch', 'user']
+    for field in check_fields:
+        val = tx.get(field, '')
+        val_str = str(val).lower()
+        if search_lower in val_str:
+            return True
+    # Handle diagnoses
+    diagnoses = tx.get('diagnoses', [])
+    if isinstance(diagnoses, list):
+        diag_str = ' '.join(str(d).lower() for d in diagnoses)
+        if search_lower in diag_str:
+            return True
+    return False
+def compute_report(db, report_type, start_date=None, end_date=None, search=None, progress=None):
+    """Run one report and return the template fields it fills in.
+    `progress(done, total)` is called as medications are processed (background jobs).
+    Raises ValueError when a required date is missing or malformed."""
+    if progress is None:
+        progress = lambda done, total: None
+    medications = db['medications']
+    transactions = db['transactions']
+    report_data = []
+    receive_list = []
+    stock_data = []
+    controlled_register = []
+    report_title = None
+    start_dt = None
+    end_dt = None
+    # Parse dates if provided
+    if start_date:
+        start_dt = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    if end_date:
+        end_dt = datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc) + timedelta(days=1) - timedelta(seconds=1)
+    # now process the report
+    lot_rows = None
+    if report_type in ('expired_list', 'near_expired_list') and has_lots(db):
+        # Lot-level expiry lists: one row per batch with stock left, via an indexed range on lots.expiry.
+        # Stock outside any lot (received before `migrations.py lots`, fallback batches) is listed
+        # with the medication's own expiry below.
+        if not end_date:
+            raise ValueError('End date is required for this report type.')
+        report_date = datetime.strptime(end_date, '%Y-%m-%d').date()
+        overrides = near_expiry_overrides(medications)
+        if report_type == 'expired_list':
+            lots = expiring_lots(db, before=report_date, search=search)
+            status = 'expired'
+            report_title = f'Expired Drugs List as of {end_date}'
+        else:
+            # Widest threshold in the query, each medication's own threshold applied below
+            lots = expiring_lots(db, from_date=report_date,
+                                 through=report_date + timedelta(days=widest_near_expiry(overrides)), search=search)
+            days = np.array([overrides.get(lot['med_name'], DEFAULT_NEAR_EXPIRY_DAYS) for lot in lots], dtype=np.int64)
+            keep = expiry_column([lot['expiry'] for lot in lots]) <= np.datetime64(report_date, 'D') + days.astype('timedelta64[D]')
+            lots = [lot for lot, kept in zip(lots, keep.tolist()) if kept]
+            status = 'close-to-expire'
+            report_title = f'Near Expired Drug List as of {end_date}'
+        lot_rows = [{
+            'name': lot['med_name'],
+            'balance': lot['quantity'],
+            'expiry_date': lot.get('expiry_date') or lot['expiry'].strftime('%Y-%m-%d'),
+            'batch': lot.get('batch') or 'N/A',
+            'price': lot.get('price') or 0.0,
+            'status': status,
+        } for lot in lots]
+    if report_type in STOCK_REPORT_TYPES:
+        if not end_date:
+            raise ValueError('End date is required for this report type.')
+        report_date = datetime.strptime(end_date, '%Y-%m-%d').date()
+        now_dt = datetime.now(timezone.utc)
+        med_filter = {'name': {'$regex': search or '', '$options': 'i'}} if search else {}
+        # Expiry lists only need medications inside the expiry window (indexed range on `expiry`)
+        if report_type == 'expired_list':
+            med_filter.update(expiry_range_filter(lt=report_date))
+        elif report_type == 'near_expired_list':
+            widest = widest_near_expiry(near_expiry_overrides(medications))
+            med_filter.update(expiry_range_filter(gte=report_date, lte=report_date + timedelta(days=widest)))
+        all_meds = list(medications.find(med_filter, dict(STOCK_MED_FIELDS, near_expiry_days=1)).sort('name', 1))
+        names = [med['name'] for med in all_meds]
+        # Movements after the report date for the whole catalog in one $group, then column arithmetic
+        movements = movements_by_med(transactions, {'$gt': end_dt, '$lte': now_dt}, names if med_filter else None)
+        dispensed_after, received_after = movement_columns(names, movements)
+        current = np.fromiter((med.get('balance', 0) for med in all_meds), dtype=np.int64, count=len(all_meds))
+        balances = balances_as_of(current, dispensed_after, received_after)
+        if lot_rows is not None:
+            # Only the part of each balance no lot accounts for carries the medication's expiry
+            in_lots = lot_totals(db, names)
+            balances = np.maximum(0, balances - np.fromiter((in_lots.get(n, 0) for n in names),
+                                                            dtype=np.int64, count=len(names)))
+        statuses = stock_status(balances, expiry_column([expiry_of(med) for med in all_meds]), report_date,
+                                planning_column(all_meds, 'near_expiry_days'))
+        wanted = {'expired_list': 'expired', 'near_expired_list': 'close-to-expire',
+                  'out_of_stock_list': 'out-of-stock'}.get(report_type)
+        selected = np.flatnonzero(statuses == wanted) if wanted else np.arange(len(all_meds))
+        stock_data = []
+        for i in selected.tolist():
+            med_copy = dict(all_meds[i])
+            med_copy.pop('near_expiry_days', None)
+            # Handle missing or empty batch: set to 'N/A'
+            if not med_copy.get('batch'):
+                med_copy['batch'] = 'N/A'
+            med_copy['balance'] = int(balances[i])
+            med_copy['status'] = str(statuses[i])
+            stock_data.append(med_copy)
+        if lot_rows is not None:
+            stock_data = sorted(lot_rows + stock_data, key=lambda row: (row['name'], str(row.get('expiry_date') or '')))
+        progress(len(all_meds), len(all_meds))
+        date_str = end_date # Use the input string for title
+        if report_type == 'stock_on_hand':
+            report_title = f'Stock on Hand as of {date_str}'
+        elif report_type == 'expired_list':
+            report_title = f'Expired Drugs List as of {date_str}'
+        elif report_type == 'near_expired_list':
+            report_title = f'Near Expired Drug List as of {date_str}'
+        elif report_type == 'out_of_stock_list':
+            report_title = f'Out of Stock List as of {date_str}'
+    elif report_type == 'inventory':
+        if not start_date or not end_date:
+            raise ValueError('Start and end dates are required for this report type.')
+        med_filter = {'name': {'$regex': search or '', '$options': 'i'}} if search else {}
+        meds = list(medications.find(med_filter, {'_id': 0, 'name': 1, 'balance': 1, **PLANNING_PROJECTION}).sort('name', 1))
+        names = [med['name'] for med in meds]
+        days_in_period = max(1, (end_dt.date() - start_dt.date()).days + 1)
+        # One $group for the whole catalog instead of one aggregation per medication
+        movements = movements_by_med(transactions, {'$gte': start_dt, '$lte': end_dt}, names if med_filter else None)
+        dispensed, received = movement_columns(names, movements)
+        current = np.fromiter((med.get('balance', 0) for med in meds), dtype=np.int64, count=len(meds))
+        beginning = np.maximum(0, current - received + dispensed)
+        lead, review = planning_column(meds, 'lead_time_days'), planning_column(meds, 'review_period_days')
+        _, amount_to_order = reorder(current, dispensed, days_in_period, lead, review)
+        # Forecast from the cached consumption model (folds in only the days since its last update)
+        daily = daily_forecast(db, names)
+        demand, suggested = suggested_order(current, daily, lead + review)
+        report_data = [{
+            'med_name': name,
+            'beginning_balance': b,
+            'dispensed': d,
+            'received': r,
+            'current_balance': c,
+            'amount_to_order': as_number(a),
+            'forecast_daily': round(f, 2),
+            'forecast_demand': as_number(fd),
+            'suggested_order': so,
+        } for name, b, d, r, c, a, f, fd, so in zip(names, beginning.tolist(), dispensed.tolist(), received.tolist(),
+                                                    current.tolist(), amount_to_order.tolist(), daily.tolist(),
+                                                    demand.tolist(), suggested.tolist())]
+        progress(len(meds), len(meds))
+    elif report_type == 'receive_list':
+        base_query = {'type': 'receive'}
+        if start_date and end_date:
+            base_query['timestamp'] = {'$gte': start_dt, '$lte': end_dt}
+        if search:
+            or_query = [
+                {'med_name': {'$regex': search, '$options': 'i'}},
+                {'batch': {'$regex': search, '$options': 'i'}},
+                {'supplier': {'$regex': search, '$options': 'i'}},
+                {'stock_receiver': {'$regex': search, '$options': 'i'}},
+                {'order_number': {'$regex': search, '$options': 'i'}},
+                {'invoice_number': {'$regex': search, '$options': 'i'}},
+                {'expiry_date': {'$regex': search, '$options': 'i'}},
+            ]
+            base_query['$or'] = or_query
+        # Add limit
+        receive_list = list(find_transactions(transactions, base_query, dict(RECEIVE_LIST_FIELDS, _id=0),
+                                              [('timestamp', 1)], 10000, start=start_dt if start_date else None))
+    elif report_type == 'controlled_drug_register':
+        if not start_date or not end_date:
+            raise ValueError('Start and end dates are required for this report type.')
+        # Names and balances in one query (covered by the (schedule, name, balance) index)
+        controlled_balances = {m['name']: m.get('balance', 0) for m in
+                               medications.find({'schedule': 'controlled'}, {'_id': 0, 'name': 1, 'balance': 1})}
+        controlled_meds = list(controlled_balances)
+        if controlled_meds:
+            # Fetch all relevant transactions in period with limit
+            period_query = {
+                'med_name': {'$in': controlled_meds},
+                'type': {'$in': ['receive', 'dispense']},
+                'timestamp': {'$gte': start_dt, '$lte': end_dt}
+            }
+            all_tx = list(find_transactions(transactions, period_query, CONTROLLED_TX_FIELDS,
+                                            [('timestamp', 1)], 10000, start=start_dt))
+            tx_by_med = defaultdict(list)
+            for tx in all_tx:
+                tx_by_med[tx['med_name']].append(tx)
+            for i, med_name in enumerate(sorted(controlled_meds)):
+                progress(i, len(controlled_meds))
+                current_balance = controlled_balances[med_name]
+                try:
+                    med_txs = tx_by_med[med_name]
+                    received_in_period = sum(tx['quantity'] for tx in med_txs if tx['type'] == 'receive')
+                    dispensed_in_period = sum(tx['quantity'] for tx in med_txs if tx['type'] == 'dispense')
+                    beginning_balance = current_balance - received_in_period + dispensed_in_period
+                    beginning_balance = max(0, beginning_balance)
+                    ending_balance = current_balance
+                    # Compute running balances
+                    running_current_balance = beginning_balance
+                    running_entries = []
+                    for tx in med_txs:
+                        qty = tx['quantity']
+                        if tx['type'] == 'receive':
+                            running_current_balance += qty
+                        else:
+                            running_current_balance -= qty
+                        tx_copy = tx.copy()
+                        tx_copy['balance_after'] = running_current_balance
+                        running_entries.append(tx_copy)
+                    # Filter transactions
+                    filtered_entries = [e for e in running_entries if matches_search(e, search)]
+                    controlled_register.append({
+                        'med_name': med_name,
+                        'beginning_balance': beginning_balance,
+                        'ending_balance': ending_balance,
+                        'received': received_in_period,
+                        'dispensed': dispensed_in_period,
+                        'transactions': filtered_entries
+                    })
+                except Exception as query_err:
+                    app.logger.error(f"Query failed for controlled med {med_name}: {query_err}")
+                    # Skip this med to avoid crashing
+                    continue
+    return {
+        'report_data': report_data,
+        'receive_list': receive_list,
+        'stock_data': stock_data,
+        'controlled_register': controlled_register,
+        'report_title': report_title,
+    }
+def compute_and_cache_report(db, report_type, start_date=None, end_date=None, search=None, progress=None,
+                             budget_ms=REPORT_MAX_TIME_MS):
+    cache = get_report_cache()
+    generation = cache.generation()     # a write during the computation keeps the result out of the cache
+    started = time.perf_counter()
+    # One deadline for every query of the report (sent to the server as maxTimeMS)
+    with pymongo.timeout(budget_ms / 1000.0 if budget_ms else None):
+        result = compute_report(db, report_type, start_date, end_date, search, progress)
+    compute_ms = (time.perf_counter() - started) * 1000.0
+    cache.put(report_type, start_date, end_date, search, result, compute_ms, generation)
+    return result
 @app.route('/reports', methods=['GET', 'POST'])
 @login_required
 def reports():
     is_admin = session['user'].get('role') == 'admin'
     try:
-        client = get_mongo_client()
-        db = client['pharmacy_db']
-        medications = db['medications']
-        transactions = db['transactions']
         report_data = []
         receive_list = []
         stock_data = []
@@ -2896,26 +3654,7 @@ def reports():
         message = session.pop('message', None)
         search = None
         report_title = None
-        start_dt = None
-        end_dt = None
-        def matches_search(tx, search_str):
-            if not search_str:
-                return True
-            search_lower = search_str.lower()
-            check_fields = ['patient', 'med_name', 'company', 'position', 'prescriber', 'dispenser', 'stock_receiver', 'order_number', 'supplier', 'invoice_number', 'batch', 'user']
-            for field in check_fields:
-                val = tx.get(field, '')
-                val_str = str(val).lower()
-                if search_lower in val_str:
-                    return True
-            # Handle diagnoses
-            diagnoses = tx.get('diagnoses', [])
-            if isinstance(diagnoses, list):
-                diag_str = ' '.join(str(d).lower() for d in diagnoses)
-                if search_lower in diag_str:
-                    return True
-            return False
-        stock_report_types = ['stock_on_hand', 'expired_list', 'near_expired_list', 'out_of_stock_list']
+        cache_info = None
         if request.method == 'POST':
             report_type = request.form.get('report_type')
             start_date = request.form.get('start_date')
@@ -2923,249 +3662,38 @@ def reports():
             search = request.form.get('search')
             if report_type:
                 try:
-                    # Parse dates if provided
-                    if start_date:
-                        start_dt = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
-                    if end_date:
-                        end_dt = datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc) + timedelta(days=1) - timedelta(seconds=1)
-                    # now process the report
-                    if report_type in stock_report_types:
-                        if not end_date:
-                            raise ValueError('End date is required for this report type.')
-                        report_date = datetime.strptime(end_date, '%Y-%m-%d').date()
-                        threshold_date = report_date + timedelta(days=30)
-                        now_dt = datetime.now(timezone.utc)
-                        med_filter = {'name': {'$regex': search or '', '$options': 'i'}} if search else {}
-                        all_meds = list(medications.find(med_filter, {'_id': 0}).sort('name', 1))
-                        stock_data = []
-                        for med in all_meds:
-                            med_name = med['name']
-                            current_balance = med.get('balance', 0)
-                            try:
-                                # Period transactions after the report date (from end_dt+ to now)
-                                period_pipeline = [
-                                    {'$match': {
-                                        'med_name': med_name,
-                                        'timestamp': {'$gt': end_dt, '$lte': now_dt}
-                                    }},
-                                    {'$group': {
-                                        '_id': None,
-                                        'dispensed': {
-                                            '$sum': {
-                                                '$cond': [
-                                                    {'$eq': ['$type', 'dispense']},
-                                                    '$quantity',
-                                                    0
-                                                ]
-                                            }
-                                        },
-                                        'received': {
-                                            '$sum': {
-                                                '$cond': [
-                                                    {'$eq': ['$type', 'receive']},
-                                                    '$quantity',
-                                                    0
-                                                ]
-                                            }
-                                        }
-                                    }}
-                                ]
-                                period_result = list(transactions.aggregate(period_pipeline))
-                                dispensed_after = period_result[0].get('dispensed', 0) if period_result else 0
-                                received_after = period_result[0].get('received', 0) if period_result else 0
-                                balance_at_date = current_balance - received_after + dispensed_after
-                                balance_at_date = max(0, balance_at_date)
-                            except Exception as query_err:
-                                app.logger.error(f"Query failed for med {med_name}: {query_err}")
-                                # Fallback to current balance
-                                balance_at_date = current_balance
-                            expiry_str = med.get('expiry_date')
-                            expiry_dt = None
-                            if expiry_str:
-                                try:
-                                    if 'T' in expiry_str:
-                                        # Full ISO datetime: Extract date part only
-                                        date_part = expiry_str.split('T')[0]
-                                        expiry_dt = datetime.strptime(date_part, '%Y-%m-%d').date()
-                                    else:
-                                        # Date-only string
-                                        expiry_dt = datetime.strptime(expiry_str, '%Y-%m-%d').date()
-                                except ValueError as e:
-                                    app.logger.warning(f"Invalid expiry_date '{expiry_str}' for med '{med.get('name', 'unknown')}': {e} - Treating as no expiry.")
-                                    expiry_dt = None
-                            # Handle missing or empty batch: set to 'N/A'
-                            batch_val = med.get('batch')
-                            if not batch_val: # Covers None, empty string, or falsy
-                                med['batch'] = 'N/A'
-                            if balance_at_date == 0:
-                                status = 'out-of-stock'
-                            else:
-                                if expiry_dt is None:
-                                    status = 'normal' # Include even without expiry
-                                elif expiry_dt < report_date:
-                                    status = 'expired'
-                                elif expiry_dt <= threshold_date:
-                                    status = 'close-to-expire'
-                                else:
-                                    status = 'normal'
-                            med_copy = med.copy()
-                            med_copy['balance'] = balance_at_date
-                            med_copy['status'] = status
-                            stock_data.append(med_copy)
-                        date_str = end_date # Use the input string for title
-                        if report_type == 'stock_on_hand':
-                            report_title = f'Stock on Hand as of {date_str}'
-                        elif report_type == 'expired_list':
-                            stock_data = [m for m in stock_data if m['status'] == 'expired']
-                            report_title = f'Expired Drugs List as of {date_str}'
-                        elif report_type == 'near_expired_list':
-                            stock_data = [m for m in stock_data if m['status'] == 'close-to-expire']
-                            report_title = f'Near Expired Drug List as of {date_str}'
-                        elif report_type == 'out_of_stock_list':
-                            stock_data = [m for m in stock_data if m['status'] == 'out-of-stock']
-                            report_title = f'Out of Stock List as of {date_str}'
-                    elif report_type == 'inventory':
-                        if not start_date or not end_date:
-                            raise ValueError('Start and end dates are required for this report type.')
-                        med_filter = {'name': {'$regex': search or '', '$options': 'i'}} if search else {}
-                        meds = list(medications.find(med_filter, {'_id': 0, 'name': 1, 'balance': 1}).sort('name', 1).limit(300)) # Temp limit for testing
-                        start_date_obj = start_dt.date()
-                        end_date_obj = end_dt.date()
-                        days_in_period = max(1, (end_date_obj - start_date_obj).days + 1)
-                        for med in meds:
-                            med_name = med['name']
-                            try:
-                                # Period transactions (simple $cond per type)
-                                period_pipeline = [
-                                    {'$match': {
-                                        'med_name': med_name,
-                                        'timestamp': {'$gte': start_dt, '$lte': end_dt}
-                                    }},
-                                    {'$group': {
-                                        '_id': None,
-                                        'dispensed': {
-                                            '$sum': {
-                                                '$cond': [
-                                                    {'$eq': ['$type', 'dispense']},
-                                                    '$quantity',
-                                                    0
-                                                ]
-                                            }
-                                        },
-                                        'received': {
-                                            '$sum': {
-                                                '$cond': [
-                                                    {'$eq': ['$type', 'receive']},
-                                                    '$quantity',
-                                                    0
-                                                ]
-                                            }
-                                        }
-                                    }}
-                                ]
-                                period_result = list(transactions.aggregate(period_pipeline))
-                                dispensed = period_result[0].get('dispensed', 0) if period_result else 0
-                                received = period_result[0].get('received', 0) if period_result else 0
-                                current_balance = med.get('balance', 0)
-                                beginning_balance = current_balance - received + dispensed
-                                beginning_balance = max(0, beginning_balance)
-                                average_daily = dispensed / days_in_period
-                                average_monthly = average_daily * 30
-                                lead_time_stock = average_daily * 14
-                                amount_to_order = max(0, average_monthly - current_balance + lead_time_stock)
-                                report_data.append({
-                                    'med_name': med_name,
-                                    'beginning_balance': beginning_balance,
-                                    'dispensed': dispensed,
-                                    'received': received,
-                                    'current_balance': current_balance,
-                                    'amount_to_order': int(amount_to_order) if amount_to_order.is_integer() else round(amount_to_order, 2)
-                                })
-                            except Exception as query_err:
-                                app.logger.error(f"Query failed for med {med_name}: {query_err}")
-                                # Fallback to 0s to avoid crashing the whole report
-                                current_balance = med.get('balance', 0)
-                                report_data.append({
-                                    'med_name': med_name,
-                                    'beginning_balance': current_balance,
-                                    'dispensed': 0,
-                                    'received': 0,
-                                    'current_balance': current_balance,
-                                    'amount_to_order': 0
-                                })
-                    elif report_type == 'receive_list':
-                        base_query = {'type': 'receive'}
-                        if start_date and end_date:
-                            base_query['timestamp'] = {'$gte': start_dt, '$lte': end_dt}
-                        if search:
-                            or_query = [
-                                {'med_name': {'$regex': search, '$options': 'i'}},
-                                {'batch': {'$regex': search, '$options': 'i'}},
-                                {'supplier': {'$regex': search, '$options': 'i'}},
-                                {'stock_receiver': {'$regex': search, '$options': 'i'}},
-                                {'order_number': {'$regex': search, '$options': 'i'}},
-                                {'invoice_number': {'$regex': search, '$options': 'i'}},
-                                {'expiry_date': {'$regex': search, '$options': 'i'}},
-                            ]
-                            base_query['$or'] = or_query
-                        # Add limit
-                        receive_list = list(transactions.find(base_query).sort('timestamp', 1).limit(10000))
-                    elif report_type == 'controlled_drug_register':
-                        if not start_date or not end_date:
-                            raise ValueError('Start and end dates are required for this report type.')
-                        controlled_meds_cursor = medications.find({'schedule': 'controlled'}, {'_id': 0, 'name': 1})
-                        controlled_meds = [m['name'] for m in controlled_meds_cursor]
-                        if controlled_meds:
-                            # Fetch all relevant transactions in period with limit
-                            period_query = {
-                                'med_name': {'$in': controlled_meds},
-                                'type': {'$in': ['receive', 'dispense']},
-                                'timestamp': {'$gte': start_dt, '$lte': end_dt}
-                            }
-                            all_tx = list(transactions.find(period_query).sort('timestamp', 1).limit(10000))
-                            tx_by_med = defaultdict(list)
-                            for tx in all_tx:
-                                tx_by_med[tx['med_name']].append(tx)
-                            for med_name in sorted(controlled_meds):
-                                med = medications.find_one({'name': med_name})
-                                if not med:
-                                    continue
-                                current_balance = med.get('balance', 0)
-                                try:
-                                    med_txs = tx_by_med[med_name]
-                                    received_in_period = sum(tx['quantity'] for tx in med_txs if tx['type'] == 'receive')
-                                    dispensed_in_period = sum(tx['quantity'] for tx in med_txs if tx['type'] == 'dispense')
-                                    beginning_balance = current_balance - received_in_period + dispensed_in_period
-                                    beginning_balance = max(0, beginning_balance)
-                                    ending_balance = current_balance
-                                    # Compute running balances
-                                    running_current_balance = beginning_balance
-                                    running_entries = []
-                                    for tx in med_txs:
-                                        qty = tx['quantity']
-                                        if tx['type'] == 'receive':
-                                            running_current_balance += qty
-                                        else:
-                                            running_current_balance -= qty
-                                        tx_copy = tx.copy()
-                                        tx_copy['balance_after'] = running_current_balance
-                                        running_entries.append(tx_copy)
-                                    # Filter transactions
-                                    filtered_entries = [e for e in running_entries if matches_search(e, search)]
-                                    controlled_register.append({
-                                        'med_name': med_name,
-                                        'beginning_balance': beginning_balance,
-                                        'ending_balance': ending_balance,
-                                        'received': received_in_period,
-                                        'dispensed': dispensed_in_period,
-                                        'transactions': filtered_entries
-                                    })
-                                except Exception as query_err:
-                                    app.logger.error(f"Query failed for controlled med {med_name}: {query_err}")
-                                    # Skip this med to avoid crashing
-                                    continue
-                except ValueError as e:
-                    message = f'Invalid input: {str(e)}'
+                    cache = get_report_cache()
+                    cached = None if request.form.get('refresh') else cache.get(report_type, start_date, end_date, search)
+                    if cached:
+                        result = cached['payload']
+                        cache_info = cached
+                    elif request.form.get('background'):
+                        # Long reports: enqueue and let the job page poll for the result
+                        job_id = submit_report_job(get_mongo_client,
+                                                   partial(compute_and_cache_report, budget_ms=REPORT_JOB_MAX_TIME_MS),
+                                                   report_type, start_date, end_date, search,
+                                                   session['user']['name'])
+                        return redirect(url_for('report_job', job_id=job_id))
+                    else:
+                        # Only a cache miss needs the database, so cached reports stay readable during an outage.
+                        # Reports may read from a secondary (REPORT_READ_PREFERENCE) – writes never happen here.
+                        db = reporting_db(get_mongo_client())
+                        result = compute_and_cache_report(db, report_type, start_date, end_date, search)
+                    report_data = result['report_data']
+                    receive_list = result['receive_list']
+                    stock_data = result['stock_data']
+                    controlled_register = result['controlled_register']
+                    report_title = result['report_title']
+                except (ValueError, PyMongoError) as e:
+                    if isinstance(e, ServerSelectionTimeoutError):
+                        raise
+                    if isinstance(e, ValueError):
+                        message = f'Invalid input: {str(e)}'
+                    elif e.timeout:
+                        message = (f'The report took longer than {REPORT_MAX_TIME_MS // 1000} seconds and was stopped. '
+                                   'Narrow the date range or search, or tick "Run in background".')
+                    else:
+                        raise
                     report_type = None
                     start_date = None
                     end_date = None
@@ -3188,7 +3716,7 @@ def reports():
                 controlled_register = []
                 total_transactions = 0
                 report_title = None
-        return render_template_string(
+        response = make_response(render_page(
             REPORTS_TEMPLATE,
             report_type=report_type,
             report_data=report_data,
@@ -3202,10 +3730,16 @@ def reports():
             message=message,
             search=search,
             report_title=report_title,
-            is_admin=is_admin
-        )
+            is_admin=is_admin,
+            cache_info=cache_info
+        ))
+        if report_type:
+            response.headers['X-Report-Cache'] = 'hit' if cache_info else 'miss'
+            if cache_info:
+                response.headers['X-Report-Computed-At'] = cache_info['computed_at'].isoformat() + 'Z'
+        return response
     except ServerSelectionTimeoutError:
-        return render_template_string(
+        return render_page(
             REPORTS_TEMPLATE,
             nav_links=get_nav_links(),
             message="Database connection failed. Please try again later.",
@@ -3219,10 +3753,181 @@ def reports():
             total_transactions=0,
             search=None,
             report_title=None,
-            is_admin=is_admin
+            is_admin=is_admin,
+            cache_info=None
         ), 500
-    finally:
-        client.close()
+@app.route('/reports/jobs/<job_id>', methods=['GET'])
+@login_required
+def report_job(job_id):
+    is_admin = session['user'].get('role') == 'admin'
+    try:
+        client = get_mongo_client()
+        job = get_report_job(client, job_id)
+        if not job:
+            session['message'] = 'Report job not found or its result has expired. Please run the report again.'
+            return redirect(url_for('reports'))
+        if job['status'] in ('queued', 'running'):
+            return render_page(REPORT_JOB_TEMPLATE, nav_links=get_nav_links(), job=job_status(job))
+        if job['status'] == 'failed':
+            session['message'] = job.get('error') or 'Report job failed.'
+            return redirect(url_for('reports'))
+        result = job['result']
+        return render_page(
+            REPORTS_TEMPLATE,
+            report_type=job['report_type'],
+            report_data=result['report_data'],
+            receive_list=result['receive_list'],
+            stock_data=result['stock_data'],
+            controlled_register=result['controlled_register'],
+            start_date=job['start_date'],
+            end_date=job['end_date'],
+            total_transactions=0,
+            nav_links=get_nav_links(),
+            message=f"Report generated successfully in the background ({job['compute_ms']} ms).",
+            search=job['search'],
+            report_title=result['report_title'],
+            is_admin=is_admin,
+            cache_info=None
+        )
+    except ServerSelectionTimeoutError:
+        session['message'] = 'Database connection failed. Please try again later.'
+        return redirect(url_for('reports'))
+@app.route('/api/report-jobs/<job_id>', methods=['GET'])
+@login_required
+def report_job_status(job_id):
+    try:
+        client = get_mongo_client()
+        job = get_report_job(client, job_id)
+        if not job:
+            return jsonify({'error': 'Not Found'}), 404
+        return jsonify(job_status(job))
+    except ServerSelectionTimeoutError:
+        return jsonify({'error': 'Database unavailable'}), 503
+@app.route('/reports/morbidity', methods=['GET'])
+@login_required
+def morbidity_report():
+    params = result = cache_info = message = None
+    args = {k: v for k, v in request.args.items() if v}
+    try:
+        params = parse_morbidity_params(request.args)
+        cache = get_report_cache()
+        key = ('morbidity', params['start_date'], params['end_date'], morbidity_cache_search(params))
+        cached = None if request.args.get('refresh') else cache.get(*key)
+        if cached:
+            result = cached['payload']
+            cache_info = cached
+        else:
+            generation = cache.generation()
+            started = time.perf_counter()
+            db = reporting_db(get_mongo_client())
+            with pymongo.timeout(REPORT_MAX_TIME_MS / 1000.0):
+                result = morbidity(db, params['start'], params['end'], params['period'], params['by'],
+                                   params['top'], params['diagnosis'], params['filters'])
+            cache.put(*key, result, (time.perf_counter() - started) * 1000.0, generation)
+    except ValueError as e:
+        message = f'Invalid input: {str(e)}'
+    except PyMongoError as e:
+        if isinstance(e, ServerSelectionTimeoutError) or not e.timeout:
+            message = 'Database connection failed. Please try again later.'
+        else:
+            message = 'The report took too long and was stopped. Narrow the date range or add a filter.'
+    return render_page(
+        MORBIDITY_TEMPLATE,
+        nav_links=get_nav_links(),
+        message=message,
+        params=params,
+        result=result,
+        cache_info=cache_info,
+        periods=MORBIDITY_PERIODS,
+        dimensions=MORBIDITY_DIMENSIONS,
+        drill=lambda **changes: url_for('morbidity_report', **{**args, **changes})
+    )
+@app.route('/reports/sick-leave', methods=['GET'])
+@login_required
+def sick_leave_report():
+    params = result = cache_info = message = None
+    try:
+        params = parse_sick_leave_params(request.args)
+        cache = get_report_cache()
+        key = ('sick_leave', params['start_date'], params['end_date'], sick_leave_cache_search(params))
+        cached = None if request.args.get('refresh') else cache.get(*key)
+        if cached:
+            result = cached['payload']
+            cache_info = cached
+        else:
+            generation = cache.generation()
+            started = time.perf_counter()
+            db = reporting_db(get_mongo_client())
+            with pymongo.timeout(REPORT_MAX_TIME_MS / 1000.0):
+                result = sick_leave(db, params['start'], params['end'], params['company'], params['diagnosis'])
+            cache.put(*key, result, (time.perf_counter() - started) * 1000.0, generation)
+    except ValueError as e:
+        message = f'Invalid input: {str(e)}'
+    except PyMongoError as e:
+        if isinstance(e, ServerSelectionTimeoutError) or not e.timeout:
+            message = 'Database connection failed. Please try again later.'
+        else:
+            message = 'The report took too long and was stopped. Narrow the date range or add a filter.'
+    return render_page(
+        SICK_LEAVE_TEMPLATE,
+        nav_links=get_nav_links(),
+        message=message,
+        params=params,
+        result=result,
+        cache_info=cache_info
+    )
+# Batch recall: who received a batch – /api/recall?batch=B123[&med_name=...][&limit=100][&after=<next>]
+@app.route('/api/recall', methods=['GET'])
+@login_required
+def batch_recall():
+    batch = (request.args.get('batch') or '').strip()
+    med_name = (request.args.get('med_name') or '').strip() or None
+    after = request.args.get('after') or None
+    if not batch:
+        return jsonify({'error': 'batch is required'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), 500)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    try:
+        db = get_mongo_client()['pharmacy_db']
+        lines, next_cursor = recall(db, batch, med_name, after, limit)
+        payload = {
+            'batch': batch,
+            'med_name': med_name,
+            'transactions': [{
+                'transaction_id': line.get('transaction_id'),
+                'patient': line.get('patient'),
+                'company': line.get('company'),
+                'position': line.get('position'),
+                'med_name': line.get('med_name'),
+                'quantity': line.get('quantity'),
+                'batch_quantity': line['batch_quantity'],
+                'batch_inferred': bool(line.get('batch_inferred')),
+                'prescriber': line.get('prescriber'),
+                'dispenser': line.get('dispenser'),
+                'date': line.get('date'),
+                'timestamp': line['timestamp'].isoformat(),
+            } for line in lines],
+            'next': next_cursor,
+        }
+        # The patient summary and remaining stock describe the whole recall – first page only
+        if not after:
+            payload['patients'] = [{
+                'patient': p['_id'].get('patient'),
+                'company': p['_id'].get('company'),
+                'units': p['units'],
+                'lines': p['lines'],
+                'medications': sorted(p['medications']),
+                'first_dispensed': p['first_dispensed'].isoformat(),
+                'last_dispensed': p['last_dispensed'].isoformat(),
+            } for p in recall_patients(db, batch, med_name)]
+            payload['on_hand'] = recall_stock(db, batch, med_name)
+        return jsonify(payload)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    except ServerSelectionTimeoutError:
+        return jsonify({'error': 'Database unavailable'}), 503
 # 2. NEW ROUTE – delete a dispense transaction
 # -------------------------------------------------
 @app.route('/delete-dispense', methods=['POST'])
@@ -3241,7 +3946,7 @@ def delete_dispense():
         transactions = db['transactions']
         medications = db['medications']
         # 1. Get every medication line for this transaction
-        tx_rows = list(transactions.find({'transaction_id': tx_id, 'type': 'dispense'}))
+        tx_rows = list(transactions.find({'transaction_id': tx_id, 'type': 'dispense'}, DISPENSE_RESTORE_FIELDS))
         if not tx_rows:
             flash('Transaction not found.', 'error')
             return redirect(url_for('dispense'))
@@ -3253,13 +3958,15 @@ def delete_dispense():
                 {'name': med_name},
                 {'$inc': {'balance': qty}}
             )
+            release_lots(db, row.get('lots'))
         # 3. Delete all rows belonging to the transaction
         transactions.delete_many({'transaction_id': tx_id})
+        invalidate_reports('dispense', [r['med_name'] for r in tx_rows], [r['timestamp'] for r in tx_rows])
+        uncount_dispense_lines(db, tx_rows)
+        remove_dispense(db, tx_rows)
         flash('Dispense transaction deleted – stock restored.', 'success')
     except Exception as e:
         flash(f'Delete failed: {str(e)}', 'error')
-    finally:
-        client.close()
     # Preserve any filters the user had
     return redirect(url_for('dispense',
                             start_date=request.form.get('start_date'),
@@ -3302,14 +4009,14 @@ def edit_receive(receive_id):
                 {'expiry_date': {'$regex': search, '$options': 'i'}},
             ]
             base_query['$or'] = or_query
-        tx_list = list(transactions.find(base_query).sort('timestamp', -1))
+        tx_list = list(transactions.find(base_query, RECEIVE_LIST_FIELDS).sort('timestamp', -1))
        
         # Fetch existing rx_data (only for valid receive_id)
         rx_data = None
         message = None
         try:
             oid = ObjectId(receive_id)
-            rx = transactions.find_one({'_id': oid, 'type': 'receive'})
+            rx = transactions.find_one({'_id': oid, 'type': 'receive'}, RECEIVE_EDIT_FIELDS)
             if rx:
                 rx_data = rx
                 rx_data['receive_id'] = str(rx['_id'])
@@ -3329,7 +4036,7 @@ def edit_receive(receive_id):
         if request.method == 'POST' and rx_data:  # Only process if rx_data exists
             try:
                 oid = ObjectId(receive_id)
-                old_rx = transactions.find_one({'_id': oid})
+                old_rx = transactions.find_one({'_id': oid}, RECEIVE_EDIT_FIELDS)
                 if not old_rx or old_rx['type'] != 'receive':
                     message = "Transaction not found."
                 else:
@@ -3338,6 +4045,7 @@ def edit_receive(receive_id):
                         {'name': old_rx['med_name']},
                         {'$inc': {'balance': -old_rx['quantity']}}
                     )
+                    remove_from_lot(db, old_rx['med_name'], old_rx.get('batch'), old_rx['quantity'])
                     
                     # Parse new values (unchanged)
                     med_name = request.form['med_name']
@@ -3359,6 +4067,7 @@ def edit_receive(receive_id):
                              'batch': batch,
                              'price': price,
                              'expiry_date': expiry_date,
+                             'expiry': parse_expiry(expiry_date),
                              'schedule': schedule,
                              'stock_receiver': stock_receiver,
                              'order_number': order_number,
@@ -3377,6 +4086,7 @@ def edit_receive(receive_id):
                             'batch': batch,
                             'price': price,
                             'expiry_date': expiry_date,
+                            'expiry': parse_expiry(expiry_date),
                             'schedule': schedule,
                             'stock_receiver': stock_receiver,
                             'order_number': order_number,
@@ -3387,6 +4097,12 @@ def edit_receive(receive_id):
                         }}
                     )
                     
+                    add_lot(db, med_name, batch, expiry_date, quantity, price)
+                    forget_medications([med_name])
+                    invalidate_reports('receive', [old_rx['med_name'], med_name], [old_rx['timestamp'], datetime.utcnow()])
+                    count_receive(db, [(old_rx['med_name'], old_rx['quantity'])], when=old_rx['timestamp'], sign=-1,
+                                  controlled={old_rx['med_name']} if old_rx.get('schedule') == 'controlled' else set())
+                    count_receive(db, [(med_name, quantity)], {med_name} if schedule == 'controlled' else set())
                     # Success: redirect to avoid resubmit, preserve filters
                     return redirect(url_for('receive', 
                                             start_date=start_date or '',
@@ -3395,7 +4111,7 @@ def edit_receive(receive_id):
             except Exception as e:
                 message = f"Update failed: {str(e)}"
         
-        return render_template_string(
+        return render_page(
             RECEIVE_TEMPLATE,
             tx_list=tx_list,
             nav_links=get_nav_links(),
@@ -3407,8 +4123,6 @@ def edit_receive(receive_id):
         )
     except ServerSelectionTimeoutError:
         return "Database connection failed.", 500
-    finally:
-        client.close()
 @app.route('/delete-receive', methods=['POST'])
 @login_required
 def delete_receive():
@@ -3424,7 +4138,7 @@ def delete_receive():
         db = client['pharmacy_db']
         transactions = db['transactions']
         medications = db['medications']
-        rx = transactions.find_one({'_id': receive_id, 'type': 'receive'})
+        rx = transactions.find_one({'_id': receive_id, 'type': 'receive'}, RECEIVE_EDIT_FIELDS)
         if not rx:
             flash('Transaction not found.', 'error')
             return redirect(url_for('receive'))
@@ -3433,13 +4147,15 @@ def delete_receive():
             {'name': rx['med_name']},
             {'$inc': {'balance': -rx['quantity']}}
         )
+        remove_from_lot(db, rx['med_name'], rx.get('batch'), rx['quantity'])
         # Delete transaction
         transactions.delete_one({'_id': receive_id})
+        invalidate_reports('receive', [rx['med_name']], [rx['timestamp']])
+        count_receive(db, [(rx['med_name'], rx['quantity'])], when=rx['timestamp'], sign=-1,
+                      controlled={rx['med_name']} if rx.get('schedule') == 'controlled' else set())
         flash('Receive transaction deleted – stock reduced.', 'success')
     except Exception as e:
         flash(f'Delete failed: {str(e)}', 'error')
-    finally:
-        client.close()
     return redirect(url_for('receive',
                             start_date=request.form.get('start_date'),
                             end_date=request.form.get('end_date'),
@@ -3447,13 +4163,32 @@ def delete_receive():
 @app.route('/api/diagnoses', methods=['GET'])
 @login_required
 def get_diagnosis_suggestions():
-    query = request.args.get('query', '').lower()
-    matching = [d for d in DIAGNOSES_OPTIONS if query in d.lower()][:10]
-    return jsonify(matching)
+    return jsonify(DIAGNOSIS_INDEX.suggest(request.args.get('query', '')))
+# Application factory – gunicorn (gunicorn.conf.py), loadtest.py and bench_startup.py start the app through it.
+# Importing app.py only defines the routes; the subsystems are attached here, once per process.
+_init_lock = threading.Lock()
+def create_app():
+    with _init_lock:
+        if app.extensions.get('pharmacy_initialised'):
+            return app
+        init_error_logging(app) # <-- this activates everything
+        init_db_metrics(app) # per-request MongoDB command counts / Server-Timing
+        init_db_breaker(app) # fail fast (read-only mode) while MongoDB is down
+        init_api(app) # read-only JSON API under /api/v1
+        init_cache_versions(app) # replay other workers' cache invalidations (cache_versions.py)
+        try:
+            from audit_logger import init_audit
+            init_audit(app)
+        except Exception as e:
+            app.logger.error(f"Failed to load audit logger: {e}")
+        app.extensions['pharmacy_initialised'] = True
+    return app
+# Preload mode (GUNICORN_PRELOAD=1): the gunicorn master builds the read-only catalog once, before forking
+def preload_catalog():
+    create_app()
+    for name, source in list(globals().items()):
+        if name.endswith('_TEMPLATE') and isinstance(source, str) and source not in _compiled_templates:
+            _compiled_templates[source] = app.jinja_env.from_string(source)
+    return freeze_catalog()
 if __name__ == '__main__':
-    try:
-        from audit_logger import init_audit
-        init_audit(app)
-    except Exception as e:
-        app.logger.error(f"Failed to load audit logger: {e}")
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
+    create_app().run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
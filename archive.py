@@ -0,0 +1,198 @@
+# archive.py
+"""
+Hot / cold archival of old transactions.
+
+`transactions` grows forever, and every list or search that is not fully
+indexed scans years of history nobody opens.  The archival job moves
+transactions older than ARCHIVE_AFTER_DAYS into `transactions_archive`:
+
+    python archive.py                    # move everything older than the horizon
+    python archive.py --days 365         # other horizon for this run
+
+It works in resumable batches (copy with an idempotent upsert by _id, then
+delete from the hot collection what is still identical to the copy), so it
+can be stopped and re-run at any time.  The archive cutoff is recorded in `archive_state` BEFORE the first
+batch moves, so readers already look on both sides while the job runs.
+
+Balances need no carried-forward figure: the stored medication balance is
+current, and as-of reports roll back only the movements after their date,
+reading the archive when that date is before the cutoff.
+
+Readers go through find_transactions() / aggregate_transactions(): when the
+requested period starts before the cutoff (or has no start), the archive
+is added with `$unionWith`, otherwise only the hot collection is read.
+Newest-first pages (API lists, recall) stay on the hot collection while it
+fills them.
+Workers cache the cutoff for CUTOFF_CACHE_SECONDS; a new cutoff is also
+published under the 'archive' namespace of cache_versions.py, so they pick
+it up before the first batch moves.
+Archived transactions are read-only – they no longer appear on the
+dispense / receive pages and cannot be edited there.
+
+Configuration (environment):
+
+    ARCHIVE_AFTER_DAYS       horizon, default 730 (two years)
+    ARCHIVE_BATCH_SIZE       documents per batch, default 1000
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from pymongo import ReplaceOne, DeleteOne
+from schema import day_start
+from db import get_db
+from cache_versions import publish, subscribe
+
+ARCHIVE = 'transactions_archive'
+STATE = 'archive_state'
+AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '730'))
+BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '1000'))
+CUTOFF_CACHE_SECONDS = 30
+
+logger = logging.getLogger('archive')
+
+_cutoff = {'value': None, 'at': None}
+_cutoff_lock = threading.Lock()
+
+
+# --------------------------------------------------------------------------- #
+# Reading across the boundary
+# --------------------------------------------------------------------------- #
+def archive_cutoff(db):
+    """Everything before this datetime may be in the archive (None = nothing archived).
+
+    Cached per process for CUTOFF_CACHE_SECONDS.
+    """
+    now = time.monotonic()
+    with _cutoff_lock:
+        if _cutoff['at'] is not None and now - _cutoff['at'] < CUTOFF_CACHE_SECONDS:
+            return _cutoff['value']
+    state = db[STATE].find_one({'_id': 'transactions'}, {'cutoff': 1})
+    with _cutoff_lock:
+        _cutoff['value'] = state.get('cutoff') if state else None
+        _cutoff['at'] = now
+    return _cutoff['value']
+
+
+def _forget_cutoff(events):
+    with _cutoff_lock:
+        _cutoff['at'] = None
+
+
+subscribe('archive', _forget_cutoff)
+
+
+def spans_archive(db, start=None):
+    """Does a period starting at `start` (None = from the beginning) reach into the archive?"""
+    cutoff = archive_cutoff(db)
+    if cutoff is None:
+        return False
+    if start is not None and start.tzinfo is not None:
+        start = start.astimezone(timezone.utc).replace(tzinfo=None)     # stored datetimes are naive UTC
+    return start is None or start < cutoff
+
+
+def aggregate_transactions(transactions, pipeline, start=None, **kwargs):
+    """transactions.aggregate() that also reads the archive when the period needs it.
+
+    `pipeline` must begin with its `$match`; the archive gets the same one.
+    """
+    db = transactions.database
+    if spans_archive(db, start):
+        match = pipeline[0]
+        pipeline = [match, {'$unionWith': {'coll': ARCHIVE, 'pipeline': [match]}}] + list(pipeline[1:])
+    return transactions.aggregate(pipeline, **kwargs)
+
+
+def find_transactions(transactions, query, projection=None, sort=None, limit=0, start=None):
+    """transactions.find() over the hot collection, or hot + archive via `$unionWith`.
+
+    A newest-first page (sort on timestamp descending, with a limit) is read
+    from the hot collection alone when it holds a full page after the
+    cutoff; keyset pages only reach the archive once they get there.  In the
+    union each side is sorted and limited first, so it reads one page from
+    each collection's index.
+    """
+    db = transactions.database
+    if not spans_archive(db, start):
+        cursor = transactions.find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        return cursor.limit(limit)
+    if limit and sort and tuple(sort[0]) == ('timestamp', -1):
+        recent = {'$and': [query, {'timestamp': {'$gte': archive_cutoff(db)}}]}
+        if transactions.count_documents(recent, limit=limit) >= limit:
+            return transactions.find(recent, projection).sort(sort).limit(limit)
+    side = [{'$match': query}]
+    if sort:
+        side.append({'$sort': dict(sort)})
+    if limit:
+        side.append({'$limit': limit})
+    if projection:
+        side.append({'$project': projection})
+    pipeline = side + [{'$unionWith': {'coll': ARCHIVE, 'pipeline': side}}]
+    if sort:
+        pipeline.append({'$sort': dict(sort)})
+    if limit:
+        pipeline.append({'$limit': limit})
+    return transactions.aggregate(pipeline, allowDiskUse=True)
+
+
+# --------------------------------------------------------------------------- #
+# Archival job
+# --------------------------------------------------------------------------- #
+def _move_batches(db, cutoff, batch_size):
+    hot, cold = db['transactions'], db[ARCHIVE]
+    moved = 0
+    while True:
+        batch = list(hot.find({'timestamp': {'$lt': cutoff}}).sort('timestamp', 1).limit(batch_size))
+        if not batch:
+            return moved
+        # Upsert by _id: a batch copied before an interruption is simply copied again
+        cold.bulk_write([ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in batch], ordered=False)
+        # Delete only what is still exactly the copy: an edit in between (edit_receive) keeps its
+        # document hot – it is copied again with the next batch, or, when the edit moved it past
+        # the cutoff, its outdated archive copy is dropped
+        deleted = hot.bulk_write([DeleteOne(doc) for doc in batch], ordered=False).deleted_count
+        if deleted < len(batch):
+            edited = [doc['_id'] for doc in hot.find(
+                {'_id': {'$in': [doc['_id'] for doc in batch]}, 'timestamp': {'$gte': cutoff}}, {'_id': 1})]
+            if edited:
+                cold.delete_many({'_id': {'$in': edited}})
+        moved += deleted
+        logger.info("archived %d transactions", moved)
+
+
+def archive_transactions(db, days=AFTER_DAYS, batch_size=BATCH_SIZE, now=None):
+    """Move transactions older than `days` (from UTC midnight) into the archive.
+
+    Returns (documents moved, cutoff).  The cutoff never moves backwards.
+    """
+    cutoff = day_start((now or datetime.utcnow()) - timedelta(days=days))
+    db[STATE].update_one({'_id': 'transactions'},
+                         {'$max': {'cutoff': cutoff}, '$set': {'started_at': datetime.utcnow()}}, upsert=True)
+    cutoff = db[STATE].find_one({'_id': 'transactions'})['cutoff']
+    publish('archive', {'cutoff': cutoff})
+    moved = _move_batches(db, cutoff, batch_size)
+    db[STATE].update_one({'_id': 'transactions'},
+                         {'$set': {'finished_at': datetime.utcnow(), 'last_moved': moved}})
+    logger.info("archive: %d transactions moved before %s", moved, cutoff)
+    return moved, cutoff
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move old transactions into transactions_archive.')
+    parser.add_argument('--days', type=int, default=AFTER_DAYS, help='archive transactions older than this')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+    moved, cutoff = archive_transactions(get_db(), args.days, args.batch_size)
+    print(f"transactions_archive: {moved} transactions moved (cutoff {cutoff:%Y-%m-%d}).")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,25 +5,25 @@
 # perform edits / deletes and store an immutable audit trail.
 # --------------------------------------------------------------
 
-import os
 import uuid
 from datetime import datetime, timezone
 from functools import wraps
-from pymongo import MongoClient
 from pymongo.errors import ServerSelectionTimeoutError
-from flask import request, session, current_app, g
+from flask import request, session, current_app, g, make_response
+from db import get_client
 
 # ------------------------------------------------------------------
 # Configuration – change only if you want a different DB / collection
 # ------------------------------------------------------------------
-MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
 DB_NAME     = 'pharmacy_db'
 COLLECTION  = 'audit_log'      # <-- audit records go here
+LINE_FIELDS = {'_id': 0, 'med_name': 1, 'quantity': 1}
+MED_FIELDS  = ('balance', 'batch', 'price', 'expiry_date', 'schedule')
 # ------------------------------------------------------------------
 
 def get_mongo_client():
-    """Lazy client – safe for forks."""
-    return MongoClient(MONGODB_URI, serverSelectionTimeoutMS=120000)
+    """Shared per-process client (db.py) – safe for forks and threads."""
+    return get_client()
 
 def write_audit(action, target_type, target_id, changes, user):
     """Persist a single audit entry."""
@@ -46,8 +46,6 @@ def write_audit(action, target_type, target_id, changes, user):
         coll.insert_one(doc)
     except ServerSelectionTimeoutError:
         current_app.logger.error("Audit log failed – DB unavailable")
-    finally:
-        client.close()
 
 
 # ------------------------------------------------------------------
@@ -58,40 +56,30 @@ def audit_dispense_edit(original_func):
     @wraps(original_func)
     def wrapper(*args, **kwargs):
         # Detect edit mode
-        if request.form.get('transaction_id'):
+        if request.method == 'POST' and request.form.get('transaction_id'):
             tx_id = request.form['transaction_id']
             # Grab the *old* rows before they are deleted
             client = get_mongo_client()
             db = client[DB_NAME]
-            old_rows = list(db['transactions'].find(
-                {'transaction_id': tx_id, 'type': 'dispense'}
+            old_meds = list(db['transactions'].find(
+                {'transaction_id': tx_id, 'type': 'dispense'}, LINE_FIELDS
             ))
-            client.close()
-
-            old_meds = [
-                {'med_name': r['med_name'], 'quantity': r['quantity']}
-                for r in old_rows
-            ]
 
             # Let the original view run (it will delete + re-insert)
-            response = original_func(*args, **kwargs)
-
-            # After success – record the change
-            user = session['user']['name']
-            write_audit(
-                action='UPDATE',
-                target_type='dispense',
-                target_id=tx_id,
-                changes={'old_meds': old_meds,
-                         'new_meds': [
-                             {'med_name': n, 'quantity': int(q)}
-                             for n, q in zip(
-                                 request.form.getlist('med_names'),
-                                 request.form.getlist('quantities')
-                             ) if n.strip()
-                         ]},
-                user=user
-            )
+            response = make_response(original_func(*args, **kwargs))
+
+            # Only a successful edit is recorded – the new lines as stored, not the raw form
+            if 'Updated successfully' in response.get_data(as_text=True):
+                new_meds = list(db['transactions'].find(
+                    {'transaction_id': tx_id, 'type': 'dispense'}, LINE_FIELDS
+                ))
+                write_audit(
+                    action='UPDATE',
+                    target_type='dispense',
+                    target_id=tx_id,
+                    changes={'old_meds': old_meds, 'new_meds': new_meds},
+                    user=session.get('user', {}).get('name')
+                )
             return response
 
         # Normal (create) path – just continue
@@ -110,27 +98,22 @@ def audit_dispense_delete(original_func):
         # Capture the rows that are about to be removed
         client = get_mongo_client()
         db = client[DB_NAME]
-        rows = list(db['transactions'].find(
-            {'transaction_id': tx_id, 'type': 'dispense'}
+        meds = list(db['transactions'].find(
+            {'transaction_id': tx_id, 'type': 'dispense'}, LINE_FIELDS
         ))
-        client.close()
-
-        meds = [
-            {'med_name': r['med_name'], 'quantity': r['quantity']}
-            for r in rows
-        ]
 
         response = original_func(*args, **kwargs)
 
-        # Log the deletion
-        user = session['user']['name']
-        write_audit(
-            action='DELETE',
-            target_type='dispense',
-            target_id=tx_id,
-            changes={'removed_meds': meds},
-            user=user
-        )
+        # The view answers with a redirect either way: log only if the rows are really gone
+        gone = not db['transactions'].find_one({'transaction_id': tx_id, 'type': 'dispense'}, {'_id': 1})
+        if meds and gone:
+            write_audit(
+                action='DELETE',
+                target_type='dispense',
+                target_id=tx_id,
+                changes={'removed_meds': meds},
+                user=session.get('user', {}).get('name')
+            )
         return response
     return wrapper
 
@@ -139,9 +122,9 @@ def audit_medication_create(original_func):
     """Wraps /add-medication POST."""
     @wraps(original_func)
     def wrapper(*args, **kwargs):
-        response = original_func(*args, **kwargs)
+        response = make_response(original_func(*args, **kwargs))
         if request.method == 'POST' and 'Medication added successfully!' in response.get_data(as_text=True):
-            user = session['user']['name']
+            user = session.get('user', {}).get('name')
             med_name = request.form['med_name']
             write_audit(
                 action='CREATE',
@@ -158,19 +141,20 @@ def audit_medication_update(original_func):
     """Wraps /edit-medication/<med_name> POST."""
     @wraps(original_func)
     def wrapper(*args, **kwargs):
+        if request.method != 'POST':
+            return original_func(*args, **kwargs)
         med_name = kwargs.get('med_name')
         # Capture old values *before* the update
         client = get_mongo_client()
         db = client[DB_NAME]
-        old = db['medications'].find_one({'name': med_name})
-        client.close()
+        old = db['medications'].find_one({'name': med_name}, {'_id': 0, **dict.fromkeys(MED_FIELDS, 1)})
 
-        response = original_func(*args, **kwargs)
+        response = make_response(original_func(*args, **kwargs))
 
-        if request.method == 'POST' and 'Medication updated successfully!' in response.get_data(as_text=True):
-            user = session['user']['name']
+        if old and 'Medication updated successfully!' in response.get_data(as_text=True):
+            user = session.get('user', {}).get('name')
             changes = {}
-            for field in ('balance', 'batch', 'price', 'expiry_date', 'schedule'):
+            for field in MED_FIELDS:
                 old_val = old.get(field)
                 new_val = request.form.get(field)
                 if str(old_val) != new_val:
@@ -197,18 +181,18 @@ def audit_medication_delete(original_func):
         # Snapshot before deletion
         client = get_mongo_client()
         db = client[DB_NAME]
-        med = db['medications'].find_one({'name': med_name})
-        client.close()
+        med = db['medications'].find_one({'name': med_name}, {'_id': 0, **dict.fromkeys(MED_FIELDS, 1)})
 
-        response = original_func(*args, **kwargs)
+        response = make_response(original_func(*args, **kwargs))
 
-        if 'deleted successfully' in response.get_data(as_text=True):
-            user = session['user']['name']
+        # The view redirects either way: log only if the medication is really gone
+        if med and not db['medications'].find_one({'name': med_name}, {'_id': 1}):
+            user = session.get('user', {}).get('name')
             write_audit(
                 action='DELETE',
                 target_type='medication',
                 target_id=med_name,
-                changes={'snapshot': {k: med.get(k) for k in ('balance', 'batch', 'price', 'expiry_date', 'schedule')}},
+                changes={'snapshot': {k: med.get(k) for k in MED_FIELDS}},
                 user=user
             )
         return response
@@ -219,19 +203,17 @@ def audit_medication_delete(original_func):
 # Auto-patch the Flask app when this module is imported
 # ------------------------------------------------------------------
 def init_audit(app):
-    """Call this once after you create the Flask app."""
+    """Call this once after you create the Flask app (create_app() in app.py does)."""
+    views = app.view_functions
     # Dispense – edit part
-    from . import dispense
-    dispense.dispense = audit_dispense_edit(dispense.dispense)
+    views['dispense'] = audit_dispense_edit(views['dispense'])
 
     # Dispense – delete
-    from . import delete_dispense
-    delete_dispense.delete_dispense = audit_dispense_delete(delete_dispense.delete_dispense)
+    views['delete_dispense'] = audit_dispense_delete(views['delete_dispense'])
 
     # Medication CRUD
-    from . import add_medication, edit_medication, delete_medication
-    add_medication.add_medication = audit_medication_create(add_medication.add_medication)
-    edit_medication.edit_medication = audit_medication_update(edit_medication.edit_medication)
-    delete_medication.delete_medication = audit_medication_delete(delete_medication.delete_medication)
+    views['add_medication'] = audit_medication_create(views['add_medication'])
+    views['edit_medication'] = audit_medication_update(views['edit_medication'])
+    views['delete_medication'] = audit_medication_delete(views['delete_medication'])
 
     app.logger.info("Audit logger attached – edits & deletes are now traced.")
@@ -0,0 +1,162 @@
+# bench_reports.py
+"""
+Report / list-view benchmark suite.
+
+For every dataset size it (re)seeds a local MongoDB with seed_pharmacy.py
+and then times, through the Flask test client:
+
+  * every report_type offered by reports()
+  * the /dispense and /receive list views (unfiltered, date range, search)
+
+Results are written as JSON lines (one object per benchmark and size) so
+they can be appended to a file and tracked over time:
+
+    python bench_reports.py --sizes 1000,10000,50000 --repeat 5 --output bench.jsonl
+
+Every line carries the median / min / max wall time plus the MongoDB command
+count and DB time reported by the Server-Timing header (db_metrics.py).
+The report cache (report_cache.py) is switched off, so the timings are
+report computation, not cache lookups.
+
+WARNING: seeding drops the medications, users and transactions collections
+of the target database.  Point --uri at a throw-away instance.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime, timedelta
+from pymongo import MongoClient
+
+import seed_pharmacy
+
+REPORT_TYPES = ['stock_on_hand', 'expired_list', 'near_expired_list', 'out_of_stock_list',
+                'inventory', 'receive_list', 'controlled_drug_register']
+
+_SERVER_TIMING = re.compile(r'db;dur=([\d.]+);desc="(\d+) cmds, (\d+) docs"')
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_cases(today, period_days):
+    """(name, method, url, form) for every timed request."""
+    end = today.strftime('%Y-%m-%d')
+    start = (today - timedelta(days=period_days)).strftime('%Y-%m-%d')
+    cases = []
+    for report_type in REPORT_TYPES:
+        form = {'report_type': report_type, 'start_date': start, 'end_date': end, 'search': ''}
+        cases.append((f'reports.{report_type}', 'POST', '/reports', form))
+    cases.append(('reports.stock_on_hand.search', 'POST', '/reports',
+                  {'report_type': 'stock_on_hand', 'end_date': end, 'search': 'Controlled'}))
+    cases.append(('reports.inventory.search', 'POST', '/reports',
+                  {'report_type': 'inventory', 'start_date': start, 'end_date': end, 'search': '000'}))
+    for view in ('dispense', 'receive'):
+        cases.append((f'{view}.list', 'GET', f'/{view}', None))
+        cases.append((f'{view}.list.date_range', 'GET',
+                      f'/{view}?start_date={start}&end_date={end}', None))
+        cases.append((f'{view}.list.search', 'GET', f'/{view}?search=Synthetic', None))
+    cases.append(('dispense.list.search_company', 'GET', '/dispense?search=Enaex', None))
+    return cases
+
+
+def _login(client):
+    with client.session_transaction() as sess:
+        sess['user'] = {'login': 'bench_admin', 'name': 'Bench Admin', 'role': 'admin'}
+
+
+def time_case(client, method, url, form, repeat):
+    timings, db_ms, db_cmds, db_docs, status = [], [], [], [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        if method == 'POST':
+            response = client.post(url, data=form)
+        else:
+            response = client.get(url)
+        response.get_data()
+        timings.append((time.perf_counter() - started) * 1000.0)
+        status = response.status_code
+        match = _SERVER_TIMING.search(response.headers.get('Server-Timing', ''))
+        if match:
+            db_ms.append(float(match.group(1)))
+            db_cmds.append(int(match.group(2)))
+            db_docs.append(int(match.group(3)))
+    return {
+        'status': status,
+        'runs': repeat,
+        'median_ms': round(statistics.median(timings), 2),
+        'min_ms': round(min(timings), 2),
+        'max_ms': round(max(timings), 2),
+        'db_median_ms': round(statistics.median(db_ms), 2) if db_ms else None,
+        'db_commands': db_cmds[-1] if db_cmds else None,
+        'db_docs': db_docs[-1] if db_docs else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark reports and list views across dataset sizes.')
+    parser.add_argument('--uri', default=os.getenv('MONGODB_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='comma-separated numbers of dispense transactions to seed')
+    parser.add_argument('--medications', type=int, default=500)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--period-days', type=int, default=90, help='report period ending today')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-seed', action='store_true', help='benchmark the existing data as-is')
+    parser.add_argument('--output', help='append JSON lines here instead of stdout')
+    args = parser.parse_args(argv)
+
+    # The app reads MONGODB_URI when it opens a client, so set it before use
+    os.environ['MONGODB_URI'] = args.uri
+    # Every repeat must compute the report – with the report cache on, all but the first would be cache hits
+    os.environ['REPORT_CACHE_BACKEND'] = 'none'
+    from app import create_app
+    app = create_app()
+    app.config['TESTING'] = True
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    mongo = MongoClient(args.uri, serverSelectionTimeoutMS=5000)
+    try:
+        db = mongo[seed_pharmacy.DB_NAME]
+        sizes = [None] if args.no_seed else [int(s) for s in args.sizes.split(',') if s.strip()]
+        meta = {
+            'run_at': datetime.utcnow().isoformat() + 'Z',
+            'git_rev': _git_revision(),
+            'python': platform.python_version(),
+        }
+        for size in sizes:
+            if size is not None:
+                seed_pharmacy.reset(db)
+                seed_pharmacy.seed(db, medications=args.medications, dispenses=size,
+                                   receipts=max(1, size // 8), years=args.years)
+            counts = {
+                'medications': db['medications'].estimated_document_count(),
+                'transactions': db['transactions'].estimated_document_count(),
+            }
+            client = app.test_client()
+            _login(client)
+            for name, method, url, form in build_cases(datetime.utcnow(), args.period_days):
+                result = time_case(client, method, url, form, args.repeat)
+                record = dict(meta, benchmark=name, dispenses=size, **counts, **result)
+                out.write(json.dumps(record) + '\n')
+                out.flush()
+    finally:
+        mongo.close()
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+# bench_startup.py
+"""
+Worker start-up benchmark.
+
+Measures what a new gunicorn worker pays before it serves traffic – on
+every restart, deploy and scale-out:
+
+    import_ms          `import app` (modules, routes, template sources)
+    create_app_ms      create_app(): error logging, DB metrics, breaker, API, audit
+    first_request_ms   first GET /login through the test client (compiles the page template)
+    second_request_ms  the same request again (compiled template reused)
+
+Every run is a fresh interpreter, so nothing is warm.  With --spawn it also
+starts gunicorn (gunicorn.conf.py, app:create_app()) and times process start
+until the first 200 from /login:
+
+    python bench_startup.py --runs 10
+    python bench_startup.py --runs 5 --spawn --workers 4 --output startup.jsonl
+    python bench_startup.py --top-imports 15      # slowest imports (python -X importtime)
+
+--memory starts gunicorn twice, without and with GUNICORN_PRELOAD (the
+shared, frozen catalog – see catalog.py), serves some pages and reads each
+worker's /proc/<pid>/smaps_rollup (Linux): RSS, PSS (shared pages divided
+among the processes mapping them), shared and private kB per worker:
+
+    python bench_startup.py --memory --workers 4
+
+Results are JSON lines (median / min / max per measurement), like
+bench_reports.py.  /login needs no database; MongoDB is only contacted
+lazily, by the first request that uses it.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import statistics
+import subprocess
+import urllib.request
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CHILD = """
+import json, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+flask_app = app.create_app()
+t2 = time.perf_counter()
+client = flask_app.test_client()
+client.get('/login').get_data()
+t3 = time.perf_counter()
+client.get('/login').get_data()
+t4 = time.perf_counter()
+print(json.dumps({'import_ms': (t1 - t0) * 1000.0, 'create_app_ms': (t2 - t1) * 1000.0,
+                  'first_request_ms': (t3 - t2) * 1000.0, 'second_request_ms': (t4 - t3) * 1000.0}))
+"""
+
+_IMPORTTIME = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _summary(values, unit='ms'):
+    return {f'median_{unit}': round(statistics.median(values), 2),
+            f'min_{unit}': round(min(values), 2), f'max_{unit}': round(max(values), 2)}
+
+
+def measure_in_process(runs):
+    """{measurement: [ms per run]}, plus process_ms (interpreter start to exit)."""
+    results = {}
+    for _ in range(runs):
+        started = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', CHILD], cwd=HERE, check=True,
+                             capture_output=True, text=True).stdout
+        elapsed = (time.perf_counter() - started) * 1000.0
+        sample = json.loads(out.strip().splitlines()[-1])
+        sample['process_ms'] = elapsed
+        for name, value in sample.items():
+            results.setdefault(name, []).append(value)
+    return results
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _start_gunicorn(workers, preload=False, timeout=60):
+    """(process, port) once gunicorn answers /login with 200."""
+    port = _free_port()
+    cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+           '--bind', f'127.0.0.1:{port}', '--workers', str(workers), 'app:create_app()']
+    env = dict(os.environ, GUNICORN_PRELOAD='1' if preload else '0')
+    proc = subprocess.Popen(cmd, cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f'gunicorn exited with code {proc.returncode}')
+            if time.monotonic() > deadline:
+                raise RuntimeError('gunicorn did not serve /login in time')
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1) as response:
+                    if response.status == 200:
+                        return proc, port
+            except OSError:
+                time.sleep(0.01)
+    except Exception:
+        _stop(proc)
+        raise
+
+
+def _stop(proc):
+    proc.terminate()
+    proc.wait(timeout=30)
+
+
+def measure_gunicorn(runs, workers):
+    """Milliseconds from starting gunicorn to the first 200 from /login, per run."""
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        proc, _ = _start_gunicorn(workers)
+        timings.append((time.perf_counter() - started) * 1000.0)
+        _stop(proc)
+    return timings
+
+
+def _worker_pids(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def _smaps_rollup(pid):
+    """{field: kB} from /proc/<pid>/smaps_rollup."""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return fields
+
+
+def measure_worker_memory(workers, preload, requests=50, timeout=60):
+    """{'rss', 'pss', 'shared', 'private': [kB per worker]} after serving `requests` pages."""
+    proc, port = _start_gunicorn(workers, preload)
+    try:
+        for _ in range(requests):
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=5) as response:
+                response.read()
+        deadline = time.monotonic() + timeout
+        pids = _worker_pids(proc.pid)
+        while len(pids) < workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+            pids = _worker_pids(proc.pid)
+        memory = {'rss': [], 'pss': [], 'shared': [], 'private': []}
+        for pid in pids:
+            fields = _smaps_rollup(pid)
+            memory['rss'].append(fields.get('Rss', 0))
+            memory['pss'].append(fields.get('Pss', 0))
+            memory['shared'].append(fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0))
+            memory['private'].append(fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0))
+        return memory
+    finally:
+        _stop(proc)
+
+
+def slowest_imports(top):
+    """[(module, cumulative ms)] for the slowest modules app.py imports directly."""
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=HERE, check=True,
+                         capture_output=True, text=True).stderr
+    rows = []
+    for line in err.splitlines():
+        match = _IMPORTTIME.match(line)
+        if not match:
+            continue
+        depth = len(match.group(3)) // 2
+        if depth == 1:                  # imported by the next top-level module in the listing
+            rows.append((match.group(4), int(match.group(2)) / 1000.0))
+        elif depth == 0:
+            if match.group(4) == 'app':
+                rows.append(('app (total)', int(match.group(2)) / 1000.0))
+                return sorted(rows, key=lambda row: -row[1])[:top + 1]
+            rows = []
+    return []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time worker start-up: import, create_app, first request.')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--spawn', action='store_true', help='also time gunicorn start to first response')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers with --spawn / --memory')
+    parser.add_argument('--memory', action='store_true',
+                        help='per-worker RSS / PSS with and without GUNICORN_PRELOAD instead')
+    parser.add_argument('--top-imports', type=int, default=0, help='list the N slowest imports instead')
+    parser.add_argument('--output', help='append JSON lines here instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.top_imports:
+        for module, ms in slowest_imports(args.top_imports):
+            print(f'{ms:9.1f} ms  {module}')
+        return 0
+
+    meta = {
+        'run_at': datetime.utcnow().isoformat() + 'Z',
+        'git_rev': _git_revision(),
+        'python': platform.python_version(),
+        'runs': args.runs,
+    }
+    if args.memory:
+        records = [dict(meta, benchmark=f'memory.worker_{name}', preload=preload, workers=args.workers,
+                        total_kb=sum(values), **_summary(values, 'kb'))
+                   for preload in (False, True)
+                   for name, values in measure_worker_memory(args.workers, preload).items()]
+    else:
+        records = [dict(meta, benchmark=f'startup.{name}', **_summary(values))
+                   for name, values in measure_in_process(args.runs).items()]
+    if args.spawn and not args.memory:
+        records.append(dict(meta, benchmark='startup.gunicorn_first_response', workers=args.workers,
+                            **_summary(measure_gunicorn(args.runs, args.workers))))
+    out = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for record in records:
+            out.write(json.dumps(record) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
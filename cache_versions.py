@@ -0,0 +1,206 @@
+# cache_versions.py
+"""
+Cross-worker cache invalidation through version stamps.
+
+Each gunicorn worker keeps its own in-process caches: the lru report cache,
+the archive cutoff, the fitted forecast.  A write invalidated the copy of
+the worker that handled it, and the other workers went on serving theirs.
+
+`cache_versions` holds one small document per namespace:
+
+    {_id: 'reports', version: 42, events: [the last CACHE_VERSION_EVENTS events], updated_at}
+
+publish(namespace, event) bumps the version and appends the event (what
+was written, e.g. kind / medications / dates) in ONE update.  Every worker
+remembers the last version it has applied.  check() runs before requests,
+at most every CACHE_VERSION_CHECK_MS per worker, and reads only the version
+numbers of all namespaces in ONE query.  For a namespace that moved, it
+fetches the events it missed and hands them to the namespace's subscriber;
+the report cache replays them through its selective invalidation.  A worker
+more than CACHE_VERSION_EVENTS behind gets None and drops the whole
+namespace.
+
+With CACHE_VERSION_WATCH=1 each worker also listens on a change stream on
+cache_versions (replica sets / Atlas only) and applies bumps as they
+happen.  Polling stops while the stream is up and takes over when it drops
+or change streams are not supported.
+
+Configuration (environment):
+
+    CACHE_VERSION_CHECK_MS   minimum interval between checks per worker, default 1000
+    CACHE_VERSION_EVENTS     events kept per namespace, default 100
+    CACHE_VERSION_WATCH      1 = also listen on a change stream, default 0
+"""
+
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+from flask import request
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError, OperationFailure
+from db import get_db
+
+COLLECTION = 'cache_versions'
+CHECK_MS = int(os.getenv('CACHE_VERSION_CHECK_MS', '1000'))
+EVENTS = int(os.getenv('CACHE_VERSION_EVENTS', '100'))
+WATCH = os.getenv('CACHE_VERSION_WATCH', '0').lower() in ('1', 'true', 'yes')
+WATCH_RETRY_SECONDS = 5
+
+logger = logging.getLogger('cache_versions')
+
+_subscribers = {}       # namespace -> apply(events | None)
+_seen = {}              # namespace -> last version applied by this process
+_state = {'checked_at': None, 'watch_pid': None, 'watching': False}
+_lock = threading.Lock()
+
+
+def subscribe(namespace, apply):
+    """Call `apply(events)` for what other workers publish to `namespace`.
+
+    `events` is the list of published events in order, or None when they
+    are no longer all available – drop everything cached for the namespace.
+    """
+    _subscribers[namespace] = apply
+
+
+# --------------------------------------------------------------------------- #
+# Applying versions (callers hold _lock)
+# --------------------------------------------------------------------------- #
+def _missed(doc, seen):
+    """Events after version `seen` in the namespace document, or None if some fell out of the log."""
+    events = doc.get('events') or []
+    behind = doc.get('version', 0) - seen
+    if behind > len(events):
+        return None
+    return events[len(events) - behind:]
+
+
+def _apply(namespace, doc, own=False):
+    """Hand the events of `doc` this process has not applied to the subscriber.
+
+    `own`: `doc` was returned by our own publish(); its last event is already applied.
+    """
+    version = doc.get('version', 0)
+    seen = _seen.get(namespace)
+    if seen is None or version <= seen:
+        # First sight in this process (nothing cached from before), or an older read than one already applied
+        _seen[namespace] = max(version, seen or 0)
+        return
+    events = _missed(doc, seen)
+    if own and events:
+        events = events[:-1]
+    if events is None or events:
+        try:
+            _subscribers[namespace](events)
+        except Exception:
+            logger.exception("cache invalidation for %s failed", namespace)
+    _seen[namespace] = version
+
+
+# --------------------------------------------------------------------------- #
+# Publish / check
+# --------------------------------------------------------------------------- #
+def publish(namespace, event=None):
+    """Record a write in `namespace` for the other workers; returns the new version.
+
+    The caller has already updated its own cache.  A failure is logged, never
+    raised – the write itself has succeeded.
+    """
+    try:
+        doc = get_db()[COLLECTION].find_one_and_update(
+            {'_id': namespace},
+            {'$inc': {'version': 1},
+             '$set': {'updated_at': datetime.utcnow()},
+             '$push': {'events': {'$each': [event or {}], '$slice': -EVENTS}}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+    except PyMongoError as e:
+        logger.warning("cache version bump for %s failed: %s", namespace, e)
+        return None
+    if namespace in _subscribers:
+        with _lock:
+            _apply(namespace, doc, own=True)
+    return doc['version']
+
+
+def check(force=False):
+    """Apply what other workers published since the last check (at most every CHECK_MS)."""
+    if not _subscribers:
+        return
+    if WATCH:
+        _ensure_watch()
+    now = time.monotonic()
+    with _lock:
+        if not force:
+            if _state['watching']:
+                return
+            if _state['checked_at'] is not None and (now - _state['checked_at']) * 1000 < CHECK_MS:
+                return
+        _state['checked_at'] = now
+    try:
+        coll = get_db()[COLLECTION]
+        versions = {doc['_id']: doc.get('version', 0)
+                    for doc in coll.find({'_id': {'$in': list(_subscribers)}}, {'version': 1})}
+        moved = [ns for ns, version in versions.items() if _seen.get(ns) is not None and version > _seen[ns]]
+        docs = list(coll.find({'_id': {'$in': moved}}, {'version': 1, 'events': 1})) if moved else []
+    except PyMongoError as e:
+        logger.warning("cache version check failed: %s", e)
+        return
+    with _lock:
+        for namespace in _subscribers:
+            if namespace not in versions:
+                _seen.setdefault(namespace, 0)      # nothing published yet: the first bump is version 1
+            elif _seen.get(namespace) is None:
+                _seen[namespace] = versions[namespace]
+        for doc in docs:
+            _apply(doc['_id'], doc)
+
+
+# --------------------------------------------------------------------------- #
+# Change stream (CACHE_VERSION_WATCH=1)
+# --------------------------------------------------------------------------- #
+def _watch():
+    coll = get_db()[COLLECTION]
+    while True:
+        try:
+            with coll.watch([{'$match': {'documentKey._id': {'$in': list(_subscribers)}}}],
+                            full_document='updateLookup') as stream:
+                _state['watching'] = True
+                check(force=True)               # catch up on bumps from before the stream opened
+                for change in stream:
+                    doc = change.get('fullDocument')
+                    if doc:
+                        with _lock:
+                            _apply(doc['_id'], doc)
+        except OperationFailure as e:
+            logger.info("cache_versions: change streams unavailable (%s); polling every %d ms", e, CHECK_MS)
+            return
+        except PyMongoError as e:
+            logger.warning("cache_versions change stream failed: %s; polling until it reconnects", e)
+            time.sleep(WATCH_RETRY_SECONDS)
+        finally:
+            _state['watching'] = False
+
+
+def _ensure_watch():
+    """Start the listener once per worker process (never in the gunicorn master)."""
+    pid = os.getpid()
+    with _lock:
+        if _state['watch_pid'] == pid:
+            return
+        _state['watch_pid'] = pid
+        _state['watching'] = False
+    threading.Thread(target=_watch, name='cache-versions-watch', daemon=True).start()
+
+
+# --------------------------------------------------------------------------- #
+# Flask integration
+# --------------------------------------------------------------------------- #
+def init_cache_versions(flask_app):
+    """Check the version stamps before requests (piggybacked, throttled)."""
+
+    @flask_app.before_request
+    def _check_cache_versions():
+        if request.endpoint != 'static':
+            check()
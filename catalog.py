@@ -0,0 +1,62 @@
+# catalog.py
+"""
+Read-only catalog data shared by the gunicorn workers.
+
+The diagnosis list, its search index and the compiled page templates do
+not change while the app runs.  Without preload every worker imports app.py
+and builds its own copy.  With GUNICORN_PRELOAD=1 (gunicorn.conf.py) the
+master builds them once – app.preload_catalog() – and the workers inherit
+the pages through fork().
+
+Sharing only lasts while nobody writes to those pages, and CPython writes
+on every reference-count change and on every garbage-collector pass.  So
+freeze() runs a final collection in the master and then moves every object
+alive into the collector's permanent generation (gc.freeze()): the workers'
+collections never walk them again, and catalog objects stay shared.
+
+The medication names offered by the autocomplete fields are part of the
+page templates, so they are shared with those.
+
+Compare per-worker memory with and without preload:
+
+    python bench_startup.py --memory --workers 4
+"""
+
+import gc
+
+DEFAULT_SUGGESTIONS = 10
+
+
+class DiagnosisIndex:
+    """Immutable, case-insensitive substring search over the diagnosis options.
+
+    The options are lower-cased once when the index is built, not on every
+    keystroke; suggestions keep the order of the list.
+    """
+
+    __slots__ = ('options', '_lowered')
+
+    def __init__(self, options):
+        self.options = tuple(options)
+        self._lowered = tuple(option.lower() for option in self.options)
+
+    def suggest(self, query, limit=DEFAULT_SUGGESTIONS):
+        query = query.lower()
+        matching = []
+        for lowered, option in zip(self._lowered, self.options):
+            if query in lowered:
+                matching.append(option)
+                if len(matching) >= limit:
+                    break
+        return matching
+
+
+def freeze():
+    """Collect, then exclude everything alive from future collections.
+
+    Call in the gunicorn master after the catalog is built and before the
+    workers are forked.  Returns the number of frozen objects.
+    """
+    gc.collect()
+    gc.freeze()
+    return gc.get_freeze_count()
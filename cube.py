@@ -0,0 +1,180 @@
+# cube.py
+"""
+Materialized dispensing cube.
+
+Questions like "amoxycillin dispensed to Enaex staff, by month" used to be
+one-off queries over the raw transactions.  `dispense_cube` holds the
+dispenses pre-aggregated over six dimensions
+
+    month ('YYYY-MM', UTC), company, med_name, diagnosis, age_group, gender
+
+with three measures: quantity (units), lines (medication lines) and
+transactions (visits).  `diagnosis` is the visit's primary (first)
+diagnosis, like the sick-leave report, so every visit lands in exactly one
+cell per medication and all measures add up when a dimension is rolled up.
+
+Each visit is booked twice: once per medication, and once with
+med_name = ALL_MEDS for the visit as a whole.  Rolling up over med_name
+reads the ALL_MEDS cells, so a three-medication visit still counts as one
+transaction.
+
+Dispense writes keep the cube current (add_dispense / remove_dispense, one
+bulk_write per visit); it is rebuilt from the transactions with
+
+    python migrations.py cube
+
+and queried through GET /api/v1/cube (api_v1.py) – never from the raw
+transactions.
+"""
+
+from datetime import datetime
+from pymongo import UpdateOne
+from archive import aggregate_transactions
+
+COLLECTION = 'dispense_cube'
+DIMENSIONS = ('month', 'company', 'med_name', 'diagnosis', 'age_group', 'gender')
+MEASURES = ('quantity', 'lines', 'transactions')
+ALL_MEDS = '*'
+
+BATCH_SIZE = 1000
+
+
+# --------------------------------------------------------------------------- #
+# Incremental maintenance (called by the dispense routes in app.py)
+# --------------------------------------------------------------------------- #
+def _cells(rows):
+    """{cell key tuple: measures} for dispense lines (documents as stored in transactions)."""
+    cells = {}
+    visits = {}
+    for row in rows:
+        visits.setdefault(row.get('transaction_id') or id(row), []).append(row)
+    for lines in visits.values():
+        first = lines[0]
+        diagnoses = first.get('diagnoses') or []
+        base = (first['timestamp'].strftime('%Y-%m'), first.get('company'), None,
+                diagnoses[0] if diagnoses else None, first.get('age_group'), first.get('gender'))
+        per_med = {}
+        for line in lines:
+            per_med.setdefault(line['med_name'], []).append(line['quantity'])
+        per_med[ALL_MEDS] = [line['quantity'] for line in lines]
+        for med_name, quantities in per_med.items():
+            key = base[:2] + (med_name,) + base[3:]
+            cell = cells.setdefault(key, dict.fromkeys(MEASURES, 0))
+            cell['quantity'] += sum(quantities)
+            cell['lines'] += len(quantities)
+            cell['transactions'] += 1
+    return cells
+
+
+def _apply(db, rows, sign):
+    cells = _cells(rows)
+    if not cells:
+        return
+    db[COLLECTION].bulk_write([
+        UpdateOne(dict(zip(DIMENSIONS, key)), {'$inc': {m: sign * v for m, v in measures.items()}}, upsert=True)
+        for key, measures in cells.items()
+    ], ordered=False)
+    if sign < 0:
+        db[COLLECTION].delete_many({'transactions': {'$lte': 0}, 'month': {'$in': list({k[0] for k in cells})}})
+
+
+def add_dispense(db, rows):
+    """Book dispense lines (with transaction_id, med_name, quantity, timestamp and the visit fields)."""
+    _apply(db, rows, 1)
+
+
+def remove_dispense(db, rows):
+    """Take stored dispense lines back out (edit / delete)."""
+    _apply(db, rows, -1)
+
+
+# --------------------------------------------------------------------------- #
+# Rebuild (migrations.py cube)
+# --------------------------------------------------------------------------- #
+def _rebuild_pipeline(match, per_med):
+    visit_key = {'$ifNull': ['$transaction_id', '$_id']}
+    dims = {
+        'month': {'$dateToString': {'format': '%Y-%m', 'date': '$timestamp'}},
+        'company': '$company',
+        'diagnosis': {'$arrayElemAt': ['$diagnoses', 0]},
+        'age_group': '$age_group',
+        'gender': '$gender',
+    }
+    first_group = {'_id': {'visit': visit_key, **({'med_name': '$med_name'} if per_med else {})},
+                   'quantity': {'$sum': '$quantity'}, 'lines': {'$sum': 1},
+                   **{dim: {'$first': expr} for dim, expr in dims.items()}}
+    return [
+        {'$match': match},
+        {'$group': first_group},           # one document per visit (and medication)
+        {'$group': {
+            '_id': {'med_name': '$_id.med_name' if per_med else ALL_MEDS, **{dim: f'${dim}' for dim in dims}},
+            'quantity': {'$sum': '$quantity'},
+            'lines': {'$sum': '$lines'},
+            'transactions': {'$sum': 1},
+        }},
+    ]
+
+
+def rebuild_cube(db, since_month=None):
+    """Recompute the cube from the transactions (all months, or from 'YYYY-MM' on)."""
+    match = {'type': 'dispense'}
+    cube = db[COLLECTION]
+    if since_month:
+        match['timestamp'] = {'$gte': datetime.strptime(since_month, '%Y-%m')}
+        cube.delete_many({'month': {'$gte': since_month}})
+    else:
+        cube.delete_many({})
+    start = match.get('timestamp', {}).get('$gte')
+    cells = 0
+    for per_med in (True, False):
+        docs = []
+        for row in aggregate_transactions(db['transactions'], _rebuild_pipeline(match, per_med), start=start,
+                                          allowDiskUse=True):
+            docs.append({**{dim: row['_id'].get(dim) for dim in DIMENSIONS},
+                         **{m: row[m] for m in MEASURES}})
+            if len(docs) >= BATCH_SIZE:
+                cube.insert_many(docs, ordered=False)
+                cells += len(docs)
+                docs = []
+        if docs:
+            cube.insert_many(docs, ordered=False)
+            cells += len(docs)
+    return cells
+
+
+# --------------------------------------------------------------------------- #
+# Query
+# --------------------------------------------------------------------------- #
+def query_cube(db, by=(), filters=None, month_from=None, month_to=None, measures=MEASURES):
+    """Slice by `filters` ({dimension: [values]}), roll up to the `by` dimensions.
+
+    Returns rows {dimension...: value, measure...: total}, sorted by the
+    `by` dimensions.
+    """
+    filters = filters or {}
+    unknown = [d for d in list(by) + list(filters) if d not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"unknown dimension(s): {', '.join(unknown)}; available: {', '.join(DIMENSIONS)}")
+    unknown = [m for m in measures if m not in MEASURES]
+    if unknown:
+        raise ValueError(f"unknown measure(s): {', '.join(unknown)}; available: {', '.join(MEASURES)}")
+    match = {dim: values[0] if len(values) == 1 else {'$in': list(values)} for dim, values in filters.items()}
+    if 'med_name' not in by and 'med_name' not in filters:
+        match['med_name'] = ALL_MEDS        # visit-level cells: transactions are not double counted
+    else:
+        match.setdefault('med_name', {'$ne': ALL_MEDS})
+    months = {}
+    if month_from:
+        months['$gte'] = month_from
+    if month_to:
+        months['$lte'] = month_to
+    if months:
+        match['month'] = months
+    pipeline = [
+        {'$match': match},
+        {'$group': {'_id': {dim: f'${dim}' for dim in by} or None,
+                    **{m: {'$sum': f'${m}'} for m in measures}}},
+        {'$sort': {f'_id.{dim}': 1 for dim in by} or {'_id': 1}},
+    ]
+    return [{**{dim: (row['_id'] or {}).get(dim) for dim in by}, **{m: row[m] for m in measures}}
+            for row in db[COLLECTION].aggregate(pipeline)]
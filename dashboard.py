@@ -0,0 +1,203 @@
+# dashboard.py
+"""
+Home dashboard figures.
+
+Flows (what happened today) come from `daily_counters`, one document per
+UTC day that every dispense / receive write bumps with a single `$inc`:
+
+    {_id: '2026-10-19', dispenses, dispense_lines, units_dispensed,
+     receive_lines, units_received, controlled_lines,
+     controlled_units_in, controlled_units_out}
+
+Edits and deletes take their old lines back out of the day they were
+booked on, so the counters stay exact.  Stock gauges (out of stock,
+near expiry) are states rather than flows; they are counted from indexes
+(medications.balance, lots.expiry).  Near expiry counts the medications
+today's near-expired report lists: lots, and stock outside any lot under
+the medication's own expiry, each against the medication's near_expiry_days
+or the NEAR_EXPIRY_DAYS default of stock_engine.py.  The assembled snapshot
+is cached in-process for DASHBOARD_CACHE_SECONDS and dropped by local writes.
+
+Counters for existing data are (re)built with
+
+    python migrations.py counters
+
+Configuration (environment):
+
+    DASHBOARD_CACHE_SECONDS   snapshot TTL per worker, default 10
+"""
+
+import os
+import time
+import threading
+from datetime import datetime, timedelta
+from schema import day_start
+from archive import aggregate_transactions
+from lots import lot_totals
+from stock_engine import DEFAULT_NEAR_EXPIRY_DAYS, near_expiry_overrides, widest_near_expiry
+
+COLLECTION = 'daily_counters'
+CACHE_SECONDS = float(os.getenv('DASHBOARD_CACHE_SECONDS', '10'))
+
+_cache = {'snapshot': None, 'at': 0.0}
+_cache_lock = threading.Lock()
+
+
+def day_key(when=None):
+    return (when or datetime.utcnow()).strftime('%Y-%m-%d')
+
+
+def invalidate():
+    with _cache_lock:
+        _cache['snapshot'] = None
+
+
+def _bump(db, when, inc):
+    inc = {k: v for k, v in inc.items() if v}
+    if inc:
+        db[COLLECTION].update_one({'_id': day_key(when)}, {'$inc': inc}, upsert=True)
+    invalidate()
+
+
+def _controlled(db, med_names):
+    return {m['name'] for m in db['medications'].find(
+        {'name': {'$in': list(set(med_names))}, 'schedule': 'controlled'}, {'_id': 0, 'name': 1})}
+
+
+# --------------------------------------------------------------------------- #
+# Write hooks (called by the routes in app.py)
+# --------------------------------------------------------------------------- #
+def count_dispense(db, lines, controlled=None, when=None, sign=1):
+    """Book one dispense transaction: `lines` are (med_name, quantity) pairs.
+
+    `controlled` is the set of controlled medication names (looked up if
+    None).  sign=-1 takes a transaction back out of the day `when`.
+    """
+    if not lines:
+        return
+    if controlled is None:
+        controlled = _controlled(db, [name for name, _ in lines])
+    controlled_lines = [(n, q) for n, q in lines if n in controlled]
+    _bump(db, when, {
+        'dispenses': sign,
+        'dispense_lines': sign * len(lines),
+        'units_dispensed': sign * sum(q for _, q in lines),
+        'controlled_lines': sign * len(controlled_lines),
+        'controlled_units_out': sign * sum(q for _, q in controlled_lines),
+    })
+
+
+def count_receive(db, lines, controlled=None, when=None, sign=1):
+    """Book received lines ((med_name, quantity) pairs) on the day `when`."""
+    if not lines:
+        return
+    if controlled is None:
+        controlled = _controlled(db, [name for name, _ in lines])
+    controlled_lines = [(n, q) for n, q in lines if n in controlled]
+    _bump(db, when, {
+        'receive_lines': sign * len(lines),
+        'units_received': sign * sum(q for _, q in lines),
+        'controlled_lines': sign * len(controlled_lines),
+        'controlled_units_in': sign * sum(q for _, q in controlled_lines),
+    })
+
+
+def uncount_dispense_lines(db, rows):
+    """Take stored dispense lines (with med_name, quantity, timestamp) back out, per booking day."""
+    controlled = _controlled(db, [r['med_name'] for r in rows])
+    by_day = {}
+    for row in rows:
+        by_day.setdefault(day_key(row['timestamp']), []).append((row['med_name'], row['quantity']))
+    for day, lines in by_day.items():
+        count_dispense(db, lines, controlled, datetime.strptime(day, '%Y-%m-%d'), sign=-1)
+
+
+# --------------------------------------------------------------------------- #
+# Snapshot
+# --------------------------------------------------------------------------- #
+def _near_expiry(db, today):
+    """Medications the near-expired report lists today (compute_report in app.py)."""
+    overrides = near_expiry_overrides(db['medications'])
+    window = {'$gte': today, '$lte': today + timedelta(days=widest_near_expiry(overrides))}
+
+    def near(name, expiry):
+        return expiry <= today + timedelta(days=overrides.get(name, DEFAULT_NEAR_EXPIRY_DAYS))
+
+    names = {lot['med_name'] for lot in db['lots'].find({'quantity': {'$gt': 0}, 'expiry': window},
+                                                         {'_id': 0, 'med_name': 1, 'expiry': 1})
+             if near(lot['med_name'], lot['expiry'])}
+    meds = [med for med in db['medications'].find({'balance': {'$gt': 0}, 'expiry': window},
+                                                  {'_id': 0, 'name': 1, 'balance': 1, 'expiry': 1})
+            if near(med['name'], med['expiry'])]
+    in_lots = lot_totals(db, [med['name'] for med in meds]) if meds else {}
+    names.update(med['name'] for med in meds if med['balance'] > in_lots.get(med['name'], 0))
+    return len(names)
+
+
+def _gauges(db):
+    return {
+        'out_of_stock': db['medications'].count_documents({'balance': {'$lte': 0}}),
+        'near_expiry': _near_expiry(db, day_start(datetime.utcnow())),
+        'medications': db['medications'].estimated_document_count(),
+    }
+
+
+def snapshot(db):
+    """Dashboard figures, from the per-process TTL cache when fresh."""
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache['snapshot']
+        if cached is not None and now - _cache['at'] < CACHE_SECONDS:
+            return cached
+    today = day_key()
+    yesterday = day_key(datetime.utcnow() - timedelta(days=1))
+    counters = {doc['_id']: doc for doc in db[COLLECTION].find({'_id': {'$in': [today, yesterday]}})}
+    figures = {
+        'day': today,
+        'today': counters.get(today, {}),
+        'yesterday': counters.get(yesterday, {}),
+        **_gauges(db),
+        'generated_at': datetime.utcnow(),
+    }
+    with _cache_lock:
+        _cache['snapshot'] = figures
+        _cache['at'] = now
+    return figures
+
+
+# --------------------------------------------------------------------------- #
+# Rebuild (migrations.py counters)
+# --------------------------------------------------------------------------- #
+def rebuild_counters(db, since=None):
+    """Recompute daily_counters from the transactions (all days, or from `since`)."""
+    match = {'type': {'$in': ['dispense', 'receive']}}
+    if since is not None:
+        match['timestamp'] = {'$gte': day_start(since)}
+    controlled = [m['name'] for m in db['medications'].find({'schedule': 'controlled'}, {'_id': 0, 'name': 1})]
+    is_controlled = {'$in': ['$med_name', controlled]}
+    is_dispense = {'$eq': ['$type', 'dispense']}
+    rows = aggregate_transactions(db['transactions'], [
+        {'$match': match},
+        {'$group': {
+            '_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$timestamp'}},
+            'transaction_ids': {'$addToSet': {'$cond': [is_dispense, '$transaction_id', '$$REMOVE']}},
+            'dispense_lines': {'$sum': {'$cond': [is_dispense, 1, 0]}},
+            'units_dispensed': {'$sum': {'$cond': [is_dispense, '$quantity', 0]}},
+            'receive_lines': {'$sum': {'$cond': [is_dispense, 0, 1]}},
+            'units_received': {'$sum': {'$cond': [is_dispense, 0, '$quantity']}},
+            'controlled_lines': {'$sum': {'$cond': [is_controlled, 1, 0]}},
+            'controlled_units_out': {'$sum': {'$cond': [{'$and': [is_controlled, is_dispense]}, '$quantity', 0]}},
+            'controlled_units_in': {'$sum': {'$cond': [{'$and': [is_controlled, {'$not': [is_dispense]}]}, '$quantity', 0]}},
+        }},
+    ], start=match.get('timestamp', {}).get('$gte'), allowDiskUse=True)
+    if since is None:
+        db[COLLECTION].delete_many({})
+    else:
+        db[COLLECTION].delete_many({'_id': {'$gte': day_key(since)}})
+    days = 0
+    for row in rows:
+        row['dispenses'] = len(row.pop('transaction_ids'))
+        db[COLLECTION].replace_one({'_id': row['_id']}, row, upsert=True)
+        days += 1
+    invalidate()
+    return days
@@ -0,0 +1,181 @@
+# db.py
+"""
+Shared MongoDB client.
+
+MongoClient is thread-safe and keeps its own connection pool, so every
+request, background job and logger in a worker process shares ONE client
+instead of opening (and tearing down) a client per request.  The client is
+created lazily on first use and re-created after a fork, which keeps it
+safe for gunicorn's pre-fork model and for sync, gthread and gevent workers
+alike.  Never call close() on it from request code.
+
+Connection settings (environment):
+
+    MONGODB_URI                        default mongodb://localhost:27017/
+    MONGO_MAX_POOL_SIZE                connections per worker process, default 50
+    MONGO_MIN_POOL_SIZE                default 0
+    MONGO_SERVER_SELECTION_TIMEOUT_MS  default 5000 (outages are handled by db_breaker.py)
+    MONGO_CONNECT_TIMEOUT_MS           default 20000
+    MONGO_SOCKET_TIMEOUT_MS            default none (no limit)
+    MONGO_WAIT_QUEUE_TIMEOUT_MS        max wait for a pooled connection, default none
+    MONGO_AUTO_INDEX                   create missing indexes on first use (1/0), default 1
+
+Reporting reads (reports(), background report jobs) go through
+reporting_db(), which may read from secondaries so long reports do not
+compete with dispense / receive traffic on the primary.  Everything else
+(dispense, receive, stock writes) keeps the client default: primary reads.
+
+    REPORT_READ_PREFERENCE             primary, primaryPreferred, secondary,
+                                       secondaryPreferred (default) or nearest
+    REPORT_MAX_STALENESS_SECONDS       max replication lag of a secondary used
+                                       for reports, default 120 (min 90, 0 = no limit)
+    REPORT_MAX_TIME_MS                 time budget of an interactive report, default 60000
+    REPORT_JOB_MAX_TIME_MS             time budget of a background report job, default 900000
+"""
+
+import os
+import logging
+import threading
+import pymongo
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from db_metrics import command_listener
+from db_breaker import breaker, heartbeat_listener, PROBE_TIMEOUT_MS
+from schema import ensure_indexes
+
+DB_NAME = 'pharmacy_db'
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+logger = logging.getLogger('db')
+
+
+def _int_env(name, default=None):
+    value = os.getenv(name)
+    return int(value) if value not in (None, '') else default
+
+
+def client_options():
+    """Keyword arguments for MongoClient, read from the environment."""
+    options = {
+        'maxPoolSize': _int_env('MONGO_MAX_POOL_SIZE', 50),
+        'minPoolSize': _int_env('MONGO_MIN_POOL_SIZE', 0),
+        'serverSelectionTimeoutMS': _int_env('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000),
+        'connectTimeoutMS': _int_env('MONGO_CONNECT_TIMEOUT_MS', 20000),
+        'event_listeners': [command_listener, heartbeat_listener],
+    }
+    socket_timeout = _int_env('MONGO_SOCKET_TIMEOUT_MS')
+    if socket_timeout is not None:
+        options['socketTimeoutMS'] = socket_timeout
+    wait_queue_timeout = _int_env('MONGO_WAIT_QUEUE_TIMEOUT_MS')
+    if wait_queue_timeout is not None:
+        options['waitQueueTimeoutMS'] = wait_queue_timeout
+    return options
+
+
+def get_client():
+    """The process-wide MongoClient (created on first use, per process).
+
+    Raises db_breaker.DatabaseUnavailable immediately while the circuit
+    breaker is open instead of waiting for server selection.
+    """
+    client = _shared_client()
+    breaker.check()
+    return client
+
+
+def _shared_client():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                uri = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
+                _client = MongoClient(uri, **client_options())
+                _client_pid = pid
+                if os.getenv('MONGO_AUTO_INDEX', '1') == '1':
+                    _ensure_indexes_in_background(_client)
+    return _client
+
+
+def _probe():
+    """Half-open probe for the circuit breaker: can we ping the server quickly?"""
+    try:
+        with pymongo.timeout(PROBE_TIMEOUT_MS / 1000.0):
+            _shared_client().admin.command('ping')
+        return True
+    except PyMongoError as e:
+        logger.info("MongoDB probe failed: %s", e)
+        return False
+
+
+breaker.probe = _probe
+
+
+def _ensure_indexes_in_background(client):
+    """Create missing indexes without delaying the request that opened the client."""
+    def run():
+        try:
+            ensure_indexes(client[DB_NAME])
+        except PyMongoError as e:
+            logger.warning("Could not ensure MongoDB indexes: %s", e)
+    threading.Thread(target=run, name='ensure-indexes', daemon=True).start()
+
+
+def get_db():
+    return get_client()[DB_NAME]
+
+
+# --------------------------------------------------------------------------- #
+# Reporting reads
+# --------------------------------------------------------------------------- #
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+MIN_MAX_STALENESS_SECONDS = 90      # the server rejects anything lower
+DEFAULT_MAX_STALENESS_SECONDS = 120
+
+REPORT_MAX_TIME_MS = _int_env('REPORT_MAX_TIME_MS', 60000)
+REPORT_JOB_MAX_TIME_MS = _int_env('REPORT_JOB_MAX_TIME_MS', 900000)
+
+
+def report_read_preference():
+    """Read preference for reporting queries, from the environment."""
+    mode = os.getenv('REPORT_READ_PREFERENCE', 'secondaryPreferred')
+    if mode not in READ_PREFERENCES:
+        logger.warning("Unknown REPORT_READ_PREFERENCE %r – using secondaryPreferred.", mode)
+        mode = 'secondaryPreferred'
+    if mode == 'primary':
+        return Primary()
+    staleness = _int_env('REPORT_MAX_STALENESS_SECONDS', DEFAULT_MAX_STALENESS_SECONDS)
+    if not staleness or staleness < 0:
+        staleness = -1
+    elif staleness < MIN_MAX_STALENESS_SECONDS:
+        logger.warning("REPORT_MAX_STALENESS_SECONDS=%d is below the minimum – using %d.",
+                       staleness, MIN_MAX_STALENESS_SECONDS)
+        staleness = MIN_MAX_STALENESS_SECONDS
+    return READ_PREFERENCES[mode](max_staleness=staleness)
+
+
+def report_staleness_seconds():
+    """How far report reads may lag the primary, in seconds (0 when reports read the primary).
+
+    Secondary reads without a bound (REPORT_MAX_STALENESS_SECONDS=0) are taken
+    as the default bound.
+    """
+    preference = report_read_preference()
+    if isinstance(preference, Primary):
+        return 0
+    return preference.max_staleness if preference.max_staleness > 0 else DEFAULT_MAX_STALENESS_SECONDS
+
+
+def reporting_db(client=None):
+    """pharmacy_db handle for report queries (REPORT_READ_PREFERENCE applied)."""
+    return (client or get_client()).get_database(DB_NAME, read_preference=report_read_preference())
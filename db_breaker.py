@@ -0,0 +1,215 @@
+# db_breaker.py
+"""
+Circuit breaker around MongoDB access.
+
+During an outage every request used to wait for server selection (up to
+two minutes) before failing, so workers piled up and the whole site froze.
+The breaker tracks the health of the database and lets requests fail in
+milliseconds instead:
+
+    closed     normal operation; consecutive failures are counted
+    open       MONGO_BREAKER_FAILURES failures in a row: db.get_client()
+               raises DatabaseUnavailable at once – a ServerSelectionTimeoutError,
+               so every route's existing "Database connection failed" path applies
+    half-open  MONGO_BREAKER_RESET_SECONDS after opening, ONE caller pings the
+               server (MONGO_BREAKER_PROBE_TIMEOUT_MS); success closes the
+               breaker, failure keeps it open for another period
+
+Failures and successes come from the driver's heartbeats of the primary
+(HeartbeatListener) and from the probe, so the breaker recovers by itself
+even without traffic.
+
+While the breaker is not closed the app runs read-only: init_db_breaker(app)
+answers writes with an immediate 503, pages that can still be served (cached
+reports) keep working.
+
+Configuration (environment):
+
+    MONGO_BREAKER_FAILURES            consecutive failures that open it, default 3
+    MONGO_BREAKER_RESET_SECONDS       time before a half-open probe, default 10
+    MONGO_BREAKER_PROBE_TIMEOUT_MS    budget of the probe ping, default 1000
+"""
+
+import os
+import time
+import logging
+import threading
+from flask import request, jsonify, render_template_string, make_response
+from pymongo import monitoring
+from pymongo.errors import ServerSelectionTimeoutError
+
+FAILURE_THRESHOLD = int(os.getenv('MONGO_BREAKER_FAILURES', '3'))
+RESET_SECONDS = float(os.getenv('MONGO_BREAKER_RESET_SECONDS', '10'))
+PROBE_TIMEOUT_MS = int(os.getenv('MONGO_BREAKER_PROBE_TIMEOUT_MS', '1000'))
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+# Requests that change nothing even though they are POSTs
+READ_ONLY_ENDPOINTS = {'login', 'logout', 'reports', 'static'}
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+logger = logging.getLogger('db_breaker')
+
+
+class DatabaseUnavailable(ServerSelectionTimeoutError):
+    """Raised instead of waiting for MongoDB while the breaker is open."""
+
+
+# --------------------------------------------------------------------------- #
+# Breaker
+# --------------------------------------------------------------------------- #
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_seconds=RESET_SECONDS, probe=None):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.probe = probe              # () -> bool, set by db.py
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+            return HALF_OPEN
+        return self._state
+
+    @property
+    def is_closed(self):
+        return self._state == CLOSED
+
+    def retry_after(self):
+        """Seconds until the next probe (for Retry-After)."""
+        return max(1, int(self.reset_seconds - (time.monotonic() - self._opened_at) + 0.999))
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logger.warning("MongoDB reachable again – circuit closed.")
+            self._state = CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            if self._state == OPEN:
+                return          # only the probe restarts the open period
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        if self._state != OPEN:
+            logger.warning("MongoDB unavailable after %d failure(s) – circuit open, failing fast for %.0f s.",
+                           self._failures, self.reset_seconds)
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+
+    def check(self):
+        """Return if a database call may go ahead, else raise DatabaseUnavailable.
+
+        Once the open period is over the first caller runs the probe; other
+        callers keep failing fast until it has answered.
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            if self.state == OPEN or self._probing or self.probe is None:
+                raise DatabaseUnavailable('MongoDB is unavailable (circuit open).')
+            self._probing = True
+        try:
+            healthy = self.probe()
+        finally:
+            with self._lock:
+                self._probing = False
+        if healthy:
+            self.record_success()
+            return
+        with self._lock:
+            self._open()
+        raise DatabaseUnavailable('MongoDB is unavailable (probe failed).')
+
+
+breaker = CircuitBreaker()
+
+
+class HeartbeatListener(monitoring.ServerHeartbeatListener):
+    """Feeds the driver's heartbeats of the writable server into the breaker.
+
+    The driver monitors every replica-set member, but only the primary (or a
+    standalone / mongos) can take the writes: a healthy secondary must not
+    keep the breaker closed while the primary is down.  Heartbeats count
+    when they come from a server whose last reply was writable, or from any
+    server while no writable one is known (start-up, election).
+    """
+
+    def __init__(self):
+        self._writable = set()          # addresses whose last successful heartbeat was writable
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        address = event.connection_id
+        with self._lock:
+            if event.reply.is_writable:
+                self._writable.add(address)
+                stepped_down = False
+            else:
+                stepped_down = address in self._writable
+                self._writable.discard(address)
+        if event.reply.is_writable:
+            breaker.record_success()
+        elif stepped_down:
+            breaker.record_failure()    # the primary became a secondary
+
+    def failed(self, event):
+        with self._lock:
+            counts = event.connection_id in self._writable or not self._writable
+        if counts:
+            breaker.record_failure()
+
+
+heartbeat_listener = HeartbeatListener()
+
+
+# --------------------------------------------------------------------------- #
+# Read-only degraded mode
+# --------------------------------------------------------------------------- #
+DEGRADED_HTML = """
+<h1>503 – Database temporarily unavailable</h1>
+<p>The pharmacy database cannot be reached, so changes cannot be saved right now.
+Nothing was recorded – please try again in a moment.</p>
+<p><a href="javascript:window.history.back()">Go back</a></p>
+"""
+
+
+def _unavailable_response():
+    if request.path.startswith('/api/') or request.headers.get('Accept') == 'application/json':
+        response = jsonify({'error': 'Database unavailable', 'read_only': True})
+    else:
+        response = make_response(render_template_string(DEGRADED_HTML))
+    response.status_code = 503
+    response.headers['Retry-After'] = str(breaker.retry_after())
+    return response
+
+
+def init_db_breaker(flask_app):
+    """Refuse writes at once while MongoDB is down; turn fast failures into 503s."""
+
+    @flask_app.before_request
+    def _read_only_while_degraded():
+        if breaker.is_closed or request.method not in WRITE_METHODS:
+            return None
+        if request.endpoint in READ_ONLY_ENDPOINTS:
+            return None
+        try:
+            breaker.check()      # lets the half-open probe through
+        except DatabaseUnavailable:
+            return _unavailable_response()
+        return None
+
+    @flask_app.errorhandler(DatabaseUnavailable)
+    def _database_unavailable(error):
+        return _unavailable_response()
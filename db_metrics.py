@@ -0,0 +1,220 @@
+# db_metrics.py
+"""
+MongoDB command instrumentation.
+
+A pymongo CommandListener that attributes every command issued while a Flask
+request is being handled to that request.  At the end of the request it
+emits:
+
+  * a `Server-Timing` header (visible in the browser dev-tools), e.g.
+        Server-Timing: db;dur=41.7;desc="37 cmds, 812 docs"
+  * one line in the request log with the command count, DB time and
+    documents returned
+  * a warning when the request issued more than MONGO_N_PLUS_ONE_THRESHOLD
+    commands of the same shape (same command, collection and filter keys) –
+    the classic N+1 pattern of the per-medication aggregations in reports().
+  * a warning for every find on MONGO_PROJECTED_COLLECTIONS sent without a
+    projection (full documents nobody displays).  With
+    MONGO_PROJECTION_CHECK=strict the request fails instead, so a test or
+    smoke run that hits such a query goes red; =off disables the check.
+
+These lines go to the 'db_metrics' logger at MONGO_METRICS_LOG_LEVEL
+(default INFO; WARNING keeps only the N+1 and projection warnings).  Flask's
+own logger shows WARNING and above only, so unless logging is already
+configured init_db_metrics() gives it a stderr handler (gunicorn's error
+log) of its own.
+
+Usage (app.py):
+
+    from db_metrics import init_db_metrics, command_listener
+    init_db_metrics(app)
+    MongoClient(uri, event_listeners=[command_listener])
+"""
+
+import os
+import logging
+from collections import Counter
+from pymongo import monitoring
+from flask import g, has_request_context, request
+
+# --------------------------------------------------------------------------- #
+# Configuration
+# --------------------------------------------------------------------------- #
+N_PLUS_ONE_THRESHOLD = int(os.getenv('MONGO_N_PLUS_ONE_THRESHOLD', '25'))
+PROJECTION_CHECK = os.getenv('MONGO_PROJECTION_CHECK', 'warn')        # off / warn / strict
+PROJECTED_COLLECTIONS = set(os.getenv('MONGO_PROJECTED_COLLECTIONS', 'transactions,medications').split(','))
+LOG_LEVEL = os.getenv('MONGO_METRICS_LOG_LEVEL', 'INFO').upper()
+
+logger = logging.getLogger('db_metrics')
+
+# Commands whose first value is not a collection name
+_NON_COLLECTION_COMMANDS = {'getMore', 'killCursors', 'endSessions', 'ping',
+                            'hello', 'isMaster', 'ismaster', 'buildInfo'}
+
+
+class UnprojectedQueryError(RuntimeError):
+    """A find without a projection ran while MONGO_PROJECTION_CHECK=strict."""
+
+
+# --------------------------------------------------------------------------- #
+# Per-request statistics
+# --------------------------------------------------------------------------- #
+class RequestDbStats:
+    """Counters for the commands issued during one request."""
+
+    __slots__ = ('commands', 'duration_micros', 'documents', 'shapes', 'unprojected')
+
+    def __init__(self):
+        self.commands = 0
+        self.duration_micros = 0
+        self.documents = 0
+        self.shapes = Counter()
+        self.unprojected = Counter()
+
+    @property
+    def duration_ms(self):
+        return self.duration_micros / 1000.0
+
+    def suspicious_shapes(self, threshold=None):
+        """Command shapes repeated more often than the N+1 threshold."""
+        limit = N_PLUS_ONE_THRESHOLD if threshold is None else threshold
+        return [(shape, n) for shape, n in self.shapes.most_common() if n > limit]
+
+
+def current_stats():
+    """Stats object of the request being handled, or None outside a request."""
+    if not has_request_context():
+        return None
+    return g.get('db_stats')
+
+
+def _command_shape(command_name, command):
+    """Describe a command without its values, so repeated look-ups group together."""
+    if command_name in _NON_COLLECTION_COMMANDS:
+        return None
+    collection = command.get(command_name)
+    if not isinstance(collection, str):
+        collection = '?'
+    if command_name == 'find':
+        keys = tuple(sorted((command.get('filter') or {}).keys()))
+    elif command_name == 'aggregate':
+        pipeline = command.get('pipeline') or []
+        first = pipeline[0] if pipeline else {}
+        keys = tuple(sorted((first.get('$match') or {}).keys()))
+    elif command_name in ('update', 'delete'):
+        ops = command.get('updates') or command.get('deletes') or []
+        keys = tuple(sorted((ops[0].get('q') or {}).keys())) if ops else ()
+    else:
+        keys = ()
+    return (command_name, collection, keys)
+
+
+def _needs_projection(command_name, command):
+    if PROJECTION_CHECK == 'off' or command_name != 'find':
+        return False
+    return command.get('find') in PROJECTED_COLLECTIONS and not command.get('projection')
+
+
+def _documents_returned(reply):
+    cursor = reply.get('cursor') if isinstance(reply, dict) else None
+    if not cursor:
+        return 0
+    batch = cursor.get('firstBatch', cursor.get('nextBatch', []))
+    return len(batch)
+
+
+# --------------------------------------------------------------------------- #
+# pymongo listener
+# --------------------------------------------------------------------------- #
+class RequestCommandListener(monitoring.CommandListener):
+    """Adds each command to the stats of the current Flask request (if any).
+
+    pymongo publishes command events synchronously in the thread that runs
+    the command, so the request context is available here.
+    """
+
+    def started(self, event):
+        stats = current_stats()
+        if stats is None:
+            return
+        stats.commands += 1
+        shape = _command_shape(event.command_name, event.command)
+        if shape is not None:
+            stats.shapes[shape] += 1
+            if _needs_projection(event.command_name, event.command):
+                stats.unprojected[shape] += 1
+
+    def succeeded(self, event):
+        stats = current_stats()
+        if stats is None:
+            return
+        stats.duration_micros += event.duration_micros
+        stats.documents += _documents_returned(event.reply)
+
+    def failed(self, event):
+        stats = current_stats()
+        if stats is None:
+            return
+        stats.duration_micros += event.duration_micros
+
+
+command_listener = RequestCommandListener()
+
+
+def _format_shape(shape):
+    command_name, collection, keys = shape
+    return f"{command_name} on {collection} by ({', '.join(keys) or '-'})"
+
+
+# --------------------------------------------------------------------------- #
+# Flask registration
+# --------------------------------------------------------------------------- #
+def _configure_logger():
+    """Level from MONGO_METRICS_LOG_LEVEL; a stderr handler unless logging is set up already."""
+    logger.setLevel(LOG_LEVEL)
+    if not logger.handlers and not logging.getLogger().handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s [%(process)d] [%(levelname)s] %(name)s: %(message)s'))
+        logger.addHandler(handler)
+
+
+def init_db_metrics(flask_app):
+    """Call this once with your Flask `app` object."""
+    _configure_logger()
+
+    @flask_app.before_request
+    def _start_db_stats():
+        g.db_stats = RequestDbStats()
+
+    @flask_app.after_request
+    def _emit_db_stats(response):
+        stats = g.pop('db_stats', None)
+        if stats is None:
+            return response
+
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={stats.duration_ms:.1f};desc="{stats.commands} cmds, {stats.documents} docs"'
+        )
+        logger.info(
+            "%s %s – %d MongoDB commands, %.1f ms DB time, %d docs returned",
+            request.method, request.path, stats.commands, stats.duration_ms, stats.documents
+        )
+        for shape, count in stats.suspicious_shapes():
+            logger.warning(
+                "Possible N+1 query pattern: %d similar commands (%s) during %s %s",
+                count, _format_shape(shape), request.method, request.path
+            )
+        for shape, count in stats.unprojected.items():
+            logger.warning(
+                "Query without projection: %d× %s during %s %s",
+                count, _format_shape(shape), request.method, request.path
+            )
+        if stats.unprojected and PROJECTION_CHECK == 'strict':
+            raise UnprojectedQueryError(
+                f"{request.method} {request.path} ran finds without a projection: "
+                + '; '.join(_format_shape(shape) for shape in stats.unprojected)
+            )
+        return response
+
+    logger.info("MongoDB command instrumentation enabled.")
@@ -1,8 +1,7 @@
 # error_logger.py
 """
 Separate error-logging module.
-Place this file in the project root and add the following line at the very top of app.py
-(after the imports but before any routes are defined):
+app.py attaches it in create_app(), before the first request is served:
 
     from error_logger import init_error_logging
     init_error_logging(app)
@@ -14,25 +13,19 @@ import logging
 import traceback
 from datetime import datetime
 from logging.handlers import TimedRotatingFileHandler
-from flask import request, jsonify, render_template_string
-from pymongo import MongoClient
+from flask import request, jsonify, render_template_string, current_app
 from pymongo.errors import ServerSelectionTimeoutError
+from db import get_client
 
 # --------------------------------------------------------------------------- #
 # Configuration (adjust if you keep the file elsewhere)
 # --------------------------------------------------------------------------- #
 LOG_FILE = "errors.log"                     # will be created in the root folder
-MONGO_URI = None                            # will be read from env, fallback to app config
 ERROR_COLLECTION = "error_logs"
 
 # --------------------------------------------------------------------------- #
 # Internal helpers
 # --------------------------------------------------------------------------- #
-def _get_mongo_client(app):
-    """Lazy MongoDB client – re-uses the same connection logic as the main app."""
-    uri = MONGO_URI or app.config.get("MONGODB_URI") or "mongodb://localhost:27017/"
-    return MongoClient(uri, serverSelectionTimeoutMS=36000)
-
 def _log_to_file(logger, exc_info):
     """Write a nicely formatted traceback to the rotating log file."""
     logger.error(
@@ -71,25 +64,24 @@ def _log_to_mongo(db, exc_info):
         }
         db[ERROR_COLLECTION].insert_one(error_doc)
     except Exception as mongo_err:   # never let a logging error crash the app
-        app.logger.warning(f"Failed to write error to MongoDB: {mongo_err}")
+        current_app.logger.warning(f"Failed to write error to MongoDB: {mongo_err}")
 
 # --------------------------------------------------------------------------- #
 # Flask error-handler registration
 # --------------------------------------------------------------------------- #
 def init_error_logging(flask_app):
     """Call this once with your Flask `app` object."""
-    global app
-    app = flask_app
-
     # ---- 1. File logger (daily rotation, keep 30 days) ----
-    file_handler = TimedRotatingFileHandler(LOG_FILE, when="midnight", backupCount=30)
-    file_handler.setLevel(logging.ERROR)
-    file_handler.setFormatter(
-        logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
-    )
+    # The file is opened on the first error, not at startup; one handler per process.
     logger = logging.getLogger("error_logger")
     logger.setLevel(logging.ERROR)
-    logger.addHandler(file_handler)
+    if not any(isinstance(h, TimedRotatingFileHandler) for h in logger.handlers):
+        file_handler = TimedRotatingFileHandler(LOG_FILE, when="midnight", backupCount=30, delay=True)
+        file_handler.setLevel(logging.ERROR)
+        file_handler.setFormatter(
+            logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
+        )
+        logger.addHandler(file_handler)
 
     # ---- 2. Flask 500 handler ----
     @flask_app.errorhandler(Exception)
@@ -104,18 +96,12 @@ def init_error_logging(flask_app):
         # Log to file
         _log_to_file(logger, (exc_type, exc_value, exc_tb))
 
-        # Log to MongoDB (fire-and-forget)
+        # Log to MongoDB (fire-and-forget) – shared, thread-safe client from db.py
         try:
-            client = _get_mongo_client(flask_app)
-            db = client["pharmacy_db"]
+            db = get_client()["pharmacy_db"]
             _log_to_mongo(db, (exc_type, exc_value, exc_tb))
         except ServerSelectionTimeoutError:
             logger.warning("MongoDB unavailable while logging error.")
-        finally:
-            try:
-                client.close()
-            except Exception:
-                pass
 
         # ---- 3. User-friendly response ----
         if request.path.startswith("/api/") or request.headers.get("Accept") == "application/json":
@@ -0,0 +1,220 @@
+# forecast.py
+"""
+Consumption forecasts for the inventory report's order quantities.
+
+amount_to_order divides what was dispensed in the selected period by its
+length, so one busy week inflates the order and a slow week starves it.
+This module keeps a fitted daily-consumption model per medication instead:
+
+    level    simple exponential smoothing of units dispensed per UTC day
+             (FORECAST_ALPHA)
+    window   the last FORECAST_WINDOW_DAYS daily totals, for the moving average
+
+Both are computed for ALL medications at once over a (medications x days)
+NumPy matrix built from one `$group` on the dispense history, and stored
+in `forecast_state` (one document per medication).  After that only the
+days completed since the last fit are folded in – the first report of a
+day does a few small array updates, every other request reads the cached
+state.  Today's (incomplete) dispenses are never part of the fit.
+
+    forecast demand  = daily forecast * (review period + lead time)
+    suggested order  = forecast demand - current balance, rounded up, never below 0
+
+Edits to old dispenses are not folded back in; refit from scratch with
+
+    python migrations.py forecast
+
+(the refit is published under the 'forecast' namespace of cache_versions.py,
+so the running workers reload the new state).
+
+Configuration (environment):
+
+    FORECAST_METHOD         ses (default) | ma – which daily forecast is used
+    FORECAST_ALPHA          smoothing factor 0 < alpha <= 1, default 0.3
+    FORECAST_WINDOW_DAYS    moving-average window, default 28
+    FORECAST_HISTORY_DAYS   history used by a full fit, default 365
+"""
+
+import os
+import logging
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from pymongo import ReplaceOne
+from schema import day_start
+from archive import aggregate_transactions
+from cache_versions import publish, subscribe
+
+COLLECTION = 'forecast_state'
+METHOD = os.getenv('FORECAST_METHOD', 'ses')
+ALPHA = float(os.getenv('FORECAST_ALPHA', '0.3'))
+WINDOW_DAYS = int(os.getenv('FORECAST_WINDOW_DAYS', '28'))
+HISTORY_DAYS = int(os.getenv('FORECAST_HISTORY_DAYS', '365'))
+
+logger = logging.getLogger('forecast')
+
+# Fitted state of this process: names, index, level, window, through (exclusive day start)
+_state = {'through': None}
+_lock = threading.Lock()
+
+
+# --------------------------------------------------------------------------- #
+# Series and fitting – vectorized across medications
+# --------------------------------------------------------------------------- #
+def daily_series(transactions, names, start, end):
+    """(len(names) x days) matrix of units dispensed per medication and UTC day in [start, end)."""
+    days = (end - start).days
+    series = np.zeros((len(names), max(days, 0)))
+    if days <= 0 or not names:
+        return series
+    index = {name: i for i, name in enumerate(names)}
+    rows = aggregate_transactions(transactions, [
+        {'$match': {'type': 'dispense', 'timestamp': {'$gte': start, '$lt': end}}},
+        {'$group': {
+            '_id': {'med': '$med_name', 'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$timestamp'}}},
+            'units': {'$sum': '$quantity'},
+        }},
+    ], start=start, allowDiskUse=True)
+    for row in rows:
+        i = index.get(row['_id']['med'])
+        if i is None:
+            continue                # medication no longer in the catalog
+        day = (datetime.strptime(row['_id']['day'], '%Y-%m-%d') - start).days
+        series[i, day] += row['units']
+    return series
+
+
+def smooth(series, level, alpha=ALPHA):
+    """Fold the days of `series` into the smoothed `level` (one array op per day)."""
+    for t in range(series.shape[1]):
+        level = alpha * series[:, t] + (1.0 - alpha) * level
+    return level
+
+
+def slide(window, series):
+    """Last WINDOW_DAYS daily totals after appending `series`."""
+    return np.concatenate([window, series], axis=1)[:, -WINDOW_DAYS:]
+
+
+def fit(series, alpha=ALPHA):
+    """(level, window) from scratch; the level starts at the mean of the first window."""
+    level = series[:, :WINDOW_DAYS].mean(axis=1) if series.shape[1] else np.zeros(series.shape[0])
+    window = np.zeros((series.shape[0], 0))
+    return smooth(series, level, alpha), slide(window, series)
+
+
+# --------------------------------------------------------------------------- #
+# Stored state
+# --------------------------------------------------------------------------- #
+def _forget_state(events):
+    # Called from another worker's request path: no _lock (a fit may hold it), the next read reloads
+    _state['through'] = None
+
+
+subscribe('forecast', _forget_state)
+
+
+def _load(db):
+    docs = list(db[COLLECTION].find({}, {'level': 1, 'window': 1, 'through': 1}))
+    if not docs:
+        return None
+    names = [doc['_id'] for doc in docs]
+    window = np.zeros((len(docs), WINDOW_DAYS))
+    for i, doc in enumerate(docs):
+        values = (doc.get('window') or [])[-WINDOW_DAYS:]
+        if values:
+            window[i, -len(values):] = values
+    return {
+        'names': names,
+        'index': {name: i for i, name in enumerate(names)},
+        'level': np.array([doc.get('level', 0.0) for doc in docs], dtype=float),
+        'window': window,
+        'through': min(doc['through'] for doc in docs),
+    }
+
+
+def _save(db, state):
+    if not state['names']:
+        return                  # empty catalog (fresh install): nothing to store
+    db[COLLECTION].bulk_write([ReplaceOne(
+        {'_id': name},
+        {'level': float(state['level'][i]), 'window': state['window'][i].tolist(), 'through': state['through']},
+        upsert=True
+    ) for i, name in enumerate(state['names'])], ordered=False)
+
+
+def _catalog(db):
+    return [m['name'] for m in db['medications'].find({}, {'_id': 0, 'name': 1}).sort('name', 1)]
+
+
+def _full_fit(db, today):
+    names = _catalog(db)
+    start = today - timedelta(days=HISTORY_DAYS)
+    level, window = fit(daily_series(db['transactions'], names, start, today))
+    return {'names': names, 'index': {n: i for i, n in enumerate(names)},
+            'level': level, 'window': window, 'through': today}
+
+
+def _advance(db, state, today):
+    """Add new medications (no history yet) and fold in the days completed since `through`."""
+    new = [name for name in _catalog(db) if name not in state['index']]
+    if new:
+        state['names'] = state['names'] + new
+        state['index'] = {n: i for i, n in enumerate(state['names'])}
+        state['level'] = np.concatenate([state['level'], np.zeros(len(new))])
+        state['window'] = np.concatenate([state['window'], np.zeros((len(new), state['window'].shape[1]))])
+    series = daily_series(db['transactions'], state['names'], state['through'], today)
+    state['level'] = smooth(series, state['level'])
+    state['window'] = slide(state['window'], series)
+    state['through'] = today
+    return state
+
+
+def current_state(db, today=None):
+    """The fitted state through the end of yesterday (UTC), updating it if needed."""
+    today = today or day_start(datetime.utcnow())
+    with _lock:
+        if _state['through'] == today:
+            return _state
+        state = _load(db)
+        if state is None or (today - state['through']).days > HISTORY_DAYS:
+            state = _full_fit(db, today)
+            _save(db, state)
+        elif state['through'] < today:
+            state = _advance(db, state, today)
+            _save(db, state)
+        _state.clear()
+        _state.update(state)
+        return _state
+
+
+def refit(db):
+    """Drop the stored state and fit again from the full history (migrations.py forecast)."""
+    with _lock:
+        _state.clear()
+        _state['through'] = None
+        db[COLLECTION].delete_many({})
+    fitted = len(current_state(db)['names'])
+    publish('forecast')
+    return fitted
+
+
+# --------------------------------------------------------------------------- #
+# Forecasts
+# --------------------------------------------------------------------------- #
+def daily_forecast(db, names, method=METHOD):
+    """Forecast units per day for `names` (0 for medications the model has not seen)."""
+    if not names:
+        return np.zeros(0)
+    state = current_state(db)
+    fitted = state['window'].mean(axis=1) if method == 'ma' else state['level']
+    if not state['window'].shape[1]:
+        fitted = state['level']
+    rows = np.fromiter((state['index'].get(name, -1) for name in names), dtype=np.int64, count=len(names))
+    return np.where(rows >= 0, fitted[np.maximum(rows, 0)] if len(fitted) else 0.0, 0.0)
+
+
+def suggested_order(current, daily, horizon_days):
+    """(forecast demand over the horizon, whole units to order) arrays."""
+    demand = daily * horizon_days
+    return np.round(demand, 2), np.maximum(0, np.ceil(demand - current)).astype(np.int64)
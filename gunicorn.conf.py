@@ -1,3 +1,70 @@
 # gunicorn.conf.py
-timeout = 300  # increase timeout to 2 minutes
-workers = 4    # optional: add more workers
+#
+# Every setting can be overridden from the environment, e.g.
+#
+#   GUNICORN_WORKER_CLASS=gthread GUNICORN_THREADS=8 gunicorn
+#
+# The app is built by the factory, app:create_app() (wsgi_app below).  Each
+# worker imports app.py (routes only) and attaches error logging, DB metrics,
+# the breaker, the API and the audit trail once; `gunicorn app:app` still
+# works – post_worker_init runs the factory.  Measure worker start-up with
+#
+#   python bench_startup.py --spawn
+#
+# GUNICORN_PRELOAD=1 loads the app in the master instead and builds the
+# read-only catalog there (diagnosis index, compiled page templates), then
+# gc.freeze()s it so the forked workers share those pages instead of each
+# holding a copy – see catalog.py.  Code changes then need a full restart
+# (not HUP).  Compare per-worker memory with
+#
+#   python bench_startup.py --memory --workers 4
+#
+# Suggested starting point for the clinic (dispensing while reports run) –
+# reasoned from the workload, not measured; no loadtest.py figures back it yet:
+#
+#   GUNICORN_WORKERS=4 GUNICORN_WORKER_CLASS=gthread GUNICORN_THREADS=8
+#   MONGO_MAX_POOL_SIZE=20
+#
+# 4 processes x 8 threads allow 32 requests in flight instead of 4, so a
+# request waiting on a long report query need not hold up the dispense
+# screen.  The app keeps no per-request module state and shares one
+# thread-safe MongoClient per process (db.py), so it is safe under gthread
+# and gevent.  With gevent (`pip install gevent`) use
+# GUNICORN_WORKER_CLASS=gevent and size GUNICORN_WORKER_CONNECTIONS instead
+# of threads.
+#
+# Before adopting it, compare it with the default sync workers on the
+# target host with the bundled load generator (seeded database required)
+# and keep whichever gives the better throughput and p95 latency:
+#
+#   python loadtest.py --spawn --worker-classes sync,gthread,gevent --threads 8
+#
+# Keep MONGO_MAX_POOL_SIZE >= GUNICORN_THREADS (or the share of
+# GUNICORN_WORKER_CONNECTIONS that talks to MongoDB at once), otherwise
+# threads queue for a connection.
+import os
+
+if os.getenv('GUNICORN_BIND') or os.getenv('PORT'):
+    bind = os.getenv('GUNICORN_BIND') or f"0.0.0.0:{os.getenv('PORT')}"
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+threads = int(os.getenv('GUNICORN_THREADS', '1'))                    # used by gthread
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))  # used by gevent/eventlet
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '300'))                  # long reports can also run as background jobs
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+wsgi_app = 'app:create_app()'
+preload_app = os.getenv('GUNICORN_PRELOAD', '0').lower() in ('1', 'true', 'yes')
+
+
+def post_worker_init(worker):
+    # Started as `gunicorn app:app`: initialise before the first request (no-op after create_app())
+    from app import create_app
+    create_app()
+
+
+def when_ready(server):
+    # Preload: the app is already loaded in the master – build and freeze the shared catalog before forking
+    if server.cfg.preload_app:
+        from app import preload_catalog
+        server.log.info("Shared catalog frozen in the master (%d objects)", preload_catalog())
@@ -0,0 +1,180 @@
+# invoice_import.py
+"""
+Bulk receiving from a supplier invoice CSV.
+
+A delivery used to mean one /receive form submission per line.  The
+invoice upload takes a CSV with one row per invoice line
+
+    med_name,quantity,batch,price,expiry,schedule
+    "Amoxicillin Caps, 500 mg",200,AMX2291,0.35,2027-04-30,not controlled
+
+plus the supplier / order / invoice / receiver fields shared by every line.
+All lines are validated in one pass; if any line is invalid nothing is
+booked.  Otherwise the whole invoice is applied with three bulk_writes
+(medication balances, receive transactions, lots) and a per-line summary
+is returned.
+"""
+
+import csv
+import io
+from datetime import datetime
+from pymongo import UpdateOne, InsertOne
+from schema import parse_expiry
+from lots import COLLECTION as LOTS, add_lot_op
+
+MAX_LINES = 1000
+REQUIRED_COLUMNS = ('med_name', 'quantity', 'batch', 'price', 'expiry', 'schedule')
+COLUMN_ALIASES = {'expiry_date': 'expiry', 'medication': 'med_name', 'qty': 'quantity'}
+SCHEDULES = ('controlled', 'not controlled')
+SHARED_FIELDS = ('stock_receiver', 'order_number', 'supplier', 'invoice_number')
+
+
+class InvoiceError(ValueError):
+    """The upload as a whole cannot be read (no file, wrong columns, too many lines)."""
+
+
+# --------------------------------------------------------------------------- #
+# Parsing / validation
+# --------------------------------------------------------------------------- #
+def _column(name):
+    key = (name or '').strip().lower().replace(' ', '_')
+    return COLUMN_ALIASES.get(key, key)
+
+
+def _validate(row):
+    """(clean line dict, None) or (None, error message) for one CSV row."""
+    errors = []
+    med_name = (row.get('med_name') or '').strip()
+    if not med_name:
+        errors.append('medication is missing')
+    try:
+        quantity = int((row.get('quantity') or '').strip())
+        if quantity <= 0:
+            errors.append('quantity must be positive')
+    except ValueError:
+        quantity = None
+        errors.append(f"quantity {row.get('quantity')!r} is not a whole number")
+    batch = (row.get('batch') or '').strip()
+    if not batch:
+        errors.append('batch is missing')
+    try:
+        price = float((row.get('price') or '').strip().lstrip('$'))
+        if price < 0:
+            errors.append('price cannot be negative')
+    except ValueError:
+        price = None
+        errors.append(f"price {row.get('price')!r} is not a number")
+    expiry = parse_expiry((row.get('expiry') or '').strip())
+    if expiry is None:
+        errors.append(f"expiry {row.get('expiry')!r} is not a YYYY-MM-DD date")
+    schedule = ' '.join((row.get('schedule') or '').lower().replace('-', ' ').split())
+    if schedule not in SCHEDULES:
+        errors.append(f"schedule must be one of: {', '.join(SCHEDULES)}")
+    if errors:
+        return None, '; '.join(errors)
+    return {
+        'med_name': med_name,
+        'quantity': quantity,
+        'batch': batch,
+        'price': price,
+        'expiry_date': expiry.strftime('%Y-%m-%d'),
+        'expiry': expiry,
+        'schedule': schedule,
+    }, None
+
+
+def parse_invoice(text):
+    """Validate every line of an invoice CSV.
+
+    Returns a list of {'line', 'data', 'error', 'raw'} dicts (line numbers
+    as in the file, header = 1); raises InvoiceError if the file itself is
+    unusable.
+    """
+    reader = csv.DictReader(io.StringIO(text.lstrip('\ufeff')))
+    if not reader.fieldnames:
+        raise InvoiceError('The file is empty.')
+    reader.fieldnames = [_column(f) for f in reader.fieldnames]
+    missing = [c for c in REQUIRED_COLUMNS if c not in reader.fieldnames]
+    if missing:
+        raise InvoiceError(f"Missing column(s): {', '.join(missing)}.")
+    lines = []
+    for row in reader:
+        if not any((v or '').strip() for v in row.values() if isinstance(v, str)):
+            continue                      # blank line
+        if len(lines) >= MAX_LINES:
+            raise InvoiceError(f'An invoice can have at most {MAX_LINES} lines.')
+        data, error = _validate(row)
+        lines.append({'line': reader.line_num, 'data': data, 'error': error, 'raw': row})
+    if not lines:
+        raise InvoiceError('The file has no invoice lines.')
+    return lines
+
+
+# --------------------------------------------------------------------------- #
+# Booking
+# --------------------------------------------------------------------------- #
+def apply_invoice(db, lines, shared, user):
+    """Book a fully valid invoice with one bulk_write per collection.
+
+    `shared` holds SHARED_FIELDS.  Lines for the same medication become one
+    balance `$inc` (the last line's batch / price / expiry go on the
+    medication, as if the lines had been received one after another), and
+    lines for the same batch one lot update.  Returns (summary rows, names
+    of medications created by the upload).
+    """
+    now = datetime.utcnow()
+    per_med, per_lot = {}, {}
+    for entry in lines:
+        line = entry['data']
+        med = per_med.setdefault(line['med_name'], {'quantity': 0})
+        med['quantity'] += line['quantity']
+        med['last'] = line
+        lot = per_lot.setdefault((line['med_name'], line['batch']), {'quantity': 0})
+        lot['quantity'] += line['quantity']
+        lot['last'] = line
+
+    med_names = list(per_med)
+    med_ops = [UpdateOne(
+        {'name': name},
+        {'$inc': {'balance': per_med[name]['quantity']},
+         '$set': {
+             'batch': per_med[name]['last']['batch'],
+             'price': per_med[name]['last']['price'],
+             'expiry_date': per_med[name]['last']['expiry_date'],
+             'expiry': per_med[name]['last']['expiry'],
+             'schedule': per_med[name]['last']['schedule'],
+             **shared,
+         }},
+        upsert=True
+    ) for name in med_names]
+    result = db['medications'].bulk_write(med_ops, ordered=False)
+    created = {med_names[i] for i in result.upserted_ids}
+
+    db['transactions'].bulk_write([InsertOne({
+        'type': 'receive',
+        **entry['data'],
+        **shared,
+        'user': user,
+        'timestamp': now,
+    }) for entry in lines], ordered=True)
+
+    db[LOTS].bulk_write([
+        add_lot_op(med_name, batch, lot['last']['expiry_date'], lot['quantity'], lot['last']['price'])
+        for (med_name, batch), lot in per_lot.items()
+    ], ordered=False)
+
+    summary = [{
+        'line': entry['line'],
+        'med_name': entry['data']['med_name'],
+        'quantity': entry['data']['quantity'],
+        'batch': entry['data']['batch'],
+        'status': 'received (new medication)' if entry['data']['med_name'] in created else 'received',
+    } for entry in lines]
+    return summary, sorted(created)
+
+
+def already_received(db, supplier, invoice_number):
+    """True if receive transactions for this supplier invoice exist already."""
+    return db['transactions'].find_one(
+        {'type': 'receive', 'invoice_number': invoice_number, 'supplier': supplier}, {'_id': 1}
+    ) is not None
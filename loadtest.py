@@ -0,0 +1,322 @@
+# loadtest.py
+"""
+Load-test harness for mixed clinic traffic ("morning rush").
+
+Several virtual users log in and replay a weighted mix of:
+
+    dispense_post   POST /dispense with 1-3 medication lines
+    dispense_list   GET  /dispense
+    receive_list    GET  /receive
+    autocomplete    GET  /api/diagnoses?query=...
+    report          POST /reports  (stock_on_hand as of today)
+    inventory       POST /reports  (inventory over the last 30 days)
+
+and report throughput, p50/p95/p99 latency and error rate per route.
+
+Run it against an instance you started yourself:
+
+    python loadtest.py --url http://127.0.0.1:8000 --users 8 --duration 60
+
+or let it start gunicorn for each worker class in turn (same seeded DB):
+
+    python loadtest.py --spawn --worker-classes sync,gthread,gevent --threads 4
+
+(the gevent worker class needs `pip install gevent`).
+
+Seed the database first (seed_pharmacy.py); the seeded users all share the
+password 'password'.  Medication names for dispense POSTs are read from the
+database given by --uri.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+import subprocess
+from collections import defaultdict
+from datetime import datetime, timedelta
+import requests
+from pymongo import MongoClient
+
+DEFAULT_MIX = 'dispense_post=4,dispense_list=3,receive_list=1,autocomplete=8,report=1,inventory=1'
+DIAGNOSIS_QUERIES = ['ma', 'hyp', 'ur', 'inf', 'pa', 'de', 'as', 'gast', 'co', 'ten']
+
+
+# --------------------------------------------------------------------------- #
+# Traffic
+# --------------------------------------------------------------------------- #
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        if part.strip():
+            name, weight = part.split('=')
+            mix[name.strip()] = float(weight)
+    unknown = set(mix) - set(ACTIONS)
+    if unknown:
+        raise ValueError(f"Unknown actions in mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def _dispense_form(rng, med_names):
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    meds = rng.sample(med_names, min(len(med_names), rng.randint(1, 3)))
+    return {
+        'transaction_id': '',
+        'patient': f'Load Patient {rng.randrange(10 ** 5):05d}',
+        'company': rng.choice(['BLW', 'Consulmet', 'Enaex', 'LD', 'MINOPEX']),
+        'position': rng.choice(['Artisan', 'Drivers', 'General Worker', 'IT']),
+        'age_group': rng.choice(['18-24', '25-34', '35-45', '45-54']),
+        'gender': rng.choice(['Male', 'Female']),
+        'prescriber': 'Locum',
+        'dispenser': 'Locum',
+        'date': today,
+        'sick_leave_days': str(rng.choice([0, 0, 1, 2])),
+        'diagnoses': ['Malaria'],
+        'med_names': meds,
+        'quantities': [str(rng.randint(1, 3)) for _ in meds],
+    }
+
+
+def _dispense_post(session, base, rng, med_names):
+    return session.post(f'{base}/dispense', data=_dispense_form(rng, med_names))
+
+
+def _dispense_list(session, base, rng, med_names):
+    return session.get(f'{base}/dispense')
+
+
+def _receive_list(session, base, rng, med_names):
+    return session.get(f'{base}/receive')
+
+
+def _autocomplete(session, base, rng, med_names):
+    return session.get(f'{base}/api/diagnoses', params={'query': rng.choice(DIAGNOSIS_QUERIES)})
+
+
+def _report(session, base, rng, med_names):
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    return session.post(f'{base}/reports', data={'report_type': 'stock_on_hand', 'end_date': today})
+
+
+def _inventory(session, base, rng, med_names):
+    today = datetime.utcnow()
+    return session.post(f'{base}/reports', data={
+        'report_type': 'inventory',
+        'start_date': (today - timedelta(days=30)).strftime('%Y-%m-%d'),
+        'end_date': today.strftime('%Y-%m-%d'),
+    })
+
+
+ACTIONS = {
+    'dispense_post': _dispense_post,
+    'dispense_list': _dispense_list,
+    'receive_list': _receive_list,
+    'autocomplete': _autocomplete,
+    'report': _report,
+    'inventory': _inventory,
+}
+
+
+# --------------------------------------------------------------------------- #
+# Runner
+# --------------------------------------------------------------------------- #
+class Recorder:
+    """Thread-safe latency / error collection per action."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, action, seconds, ok):
+        with self._lock:
+            self.latencies[action].append(seconds * 1000.0)
+            if not ok:
+                self.errors[action] += 1
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return round(sorted_values[index], 2)
+
+
+def login(base, username, password):
+    session = requests.Session()
+    response = session.post(f'{base}/login', data={'username': username, 'password': password},
+                            allow_redirects=False)
+    if response.status_code != 302 or response.headers.get('Location', '').endswith('/login'):
+        raise RuntimeError(f"Login failed for '{username}' – seed the database first (seed_pharmacy.py).")
+    return session
+
+
+def virtual_user(base, session, mix, med_names, deadline, recorder, seed):
+    rng = random.Random(seed)
+    actions, weights = list(mix), list(mix.values())
+    while time.monotonic() < deadline:
+        action = rng.choices(actions, weights=weights)[0]
+        started = time.perf_counter()
+        try:
+            response = ACTIONS[action](session, base, rng, med_names)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        recorder.record(action, time.perf_counter() - started, ok)
+
+
+def run_load(base, users, duration, mix, med_names, username, password, label=None):
+    sessions = [login(base, username, password) for _ in range(users)]
+    recorder = Recorder()
+    deadline = time.monotonic() + duration
+    threads = [
+        threading.Thread(target=virtual_user,
+                         args=(base, s, mix, med_names, deadline, recorder, i), daemon=True)
+        for i, s in enumerate(sessions)
+    ]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+
+    routes = {}
+    for action in sorted(recorder.latencies):
+        values = sorted(recorder.latencies[action])
+        routes[action] = {
+            'requests': len(values),
+            'throughput_rps': round(len(values) / elapsed, 2),
+            'p50_ms': _percentile(values, 50),
+            'p95_ms': _percentile(values, 95),
+            'p99_ms': _percentile(values, 99),
+            'error_rate': round(recorder.errors[action] / len(values), 4),
+        }
+    total = sum(r['requests'] for r in routes.values())
+    return {
+        'label': label,
+        'url': base,
+        'users': users,
+        'duration_s': round(elapsed, 2),
+        'total_requests': total,
+        'throughput_rps': round(total / elapsed, 2) if elapsed else 0,
+        'error_rate': round(sum(recorder.errors.values()) / total, 4) if total else 0,
+        'routes': routes,
+    }
+
+
+def print_summary(result, stream=sys.stderr):
+    print(f"\n== {result['label'] or result['url']} – {result['users']} users, "
+          f"{result['duration_s']} s, {result['throughput_rps']} req/s, "
+          f"errors {result['error_rate']:.2%}", file=stream)
+    print(f"{'route':<15}{'reqs':>7}{'req/s':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'err':>8}", file=stream)
+    for action, r in result['routes'].items():
+        print(f"{action:<15}{r['requests']:>7}{r['throughput_rps']:>9}{r['p50_ms']:>10}"
+              f"{r['p95_ms']:>10}{r['p99_ms']:>10}{r['error_rate']:>8.2%}", file=stream)
+
+
+# --------------------------------------------------------------------------- #
+# gunicorn management (--spawn)
+# --------------------------------------------------------------------------- #
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(worker_class, workers, threads, port):
+    cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+           '--bind', f'127.0.0.1:{port}', '--worker-class', worker_class]
+    if workers:
+        cmd += ['--workers', str(workers)]
+    if threads and worker_class == 'gthread':
+        cmd += ['--threads', str(threads)]
+    cmd.append('app:create_app()')
+    proc = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)))
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'gunicorn ({worker_class}) exited with code {proc.returncode}')
+        try:
+            requests.get(f'http://127.0.0.1:{port}/login', timeout=1)
+            return proc
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f'gunicorn ({worker_class}) did not start within 30 s')
+
+
+def stop_gunicorn(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def load_med_names(uri, limit):
+    client = MongoClient(uri, serverSelectionTimeoutMS=5000)
+    try:
+        cursor = client['pharmacy_db']['medications'].find(
+            {'balance': {'$gt': 100}}, {'_id': 0, 'name': 1}).sort('balance', -1).limit(limit)
+        return [m['name'] for m in cursor]
+    finally:
+        client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay mixed clinic traffic and report latency per route.')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='target when not using --spawn')
+    parser.add_argument('--uri', default=os.getenv('MONGODB_URI', 'mongodb://localhost:27017/'),
+                        help='database used to pick medication names for dispense POSTs')
+    parser.add_argument('--users', type=int, default=8, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=60, help='seconds per run')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='action=weight,... (default: %(default)s)')
+    parser.add_argument('--username', default='bench_admin')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--spawn', action='store_true', help='start gunicorn for every worker class')
+    parser.add_argument('--worker-classes', default='sync,gthread', help='used with --spawn')
+    parser.add_argument('--workers', type=int, default=0, help='override gunicorn worker count')
+    parser.add_argument('--threads', type=int, default=4, help='threads per gthread worker')
+    parser.add_argument('--output', help='append JSON results here')
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    med_names = load_med_names(args.uri, 50) if 'dispense_post' in mix else []
+    if 'dispense_post' in mix and not med_names:
+        parser.error('No medications with stock found – seed the database first.')
+
+    results = []
+    if args.spawn:
+        for worker_class in [w.strip() for w in args.worker_classes.split(',') if w.strip()]:
+            port = _free_port()
+            proc = start_gunicorn(worker_class, args.workers, args.threads, port)
+            try:
+                result = run_load(f'http://127.0.0.1:{port}', args.users, args.duration, mix,
+                                  med_names, args.username, args.password, label=worker_class)
+            finally:
+                stop_gunicorn(proc)
+            print_summary(result)
+            results.append(result)
+    else:
+        result = run_load(args.url.rstrip('/'), args.users, args.duration, mix,
+                          med_names, args.username, args.password)
+        print_summary(result)
+        results.append(result)
+
+    stamp = datetime.utcnow().isoformat() + 'Z'
+    lines = [json.dumps(dict(r, run_at=stamp, mix=mix)) for r in results]
+    if args.output:
+        with open(args.output, 'a') as fh:
+            fh.write('\n'.join(lines) + '\n')
+    else:
+        print('\n'.join(lines))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
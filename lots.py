@@ -0,0 +1,298 @@
+# lots.py
+"""
+Lot / batch-level inventory.
+
+Receiving used to overwrite the single `batch` / `expiry_date` on the
+medication document, so older lots were lost.  Every received batch now
+also lives in the `lots` collection:
+
+    {med_name, batch, expiry (date), expiry_date (as typed), price,
+     quantity (remaining), received (total), received_at, last_draw}
+
+indexed by (med_name, expiry) for first-expiry-first-out dispensing and by
+expiry for the expiry reports.  Every dispense line records the batches it
+was drawn from in `batch` (a list), so a supplier recall is one indexed
+lookup on (batch, med_name) – see recall().  The medication `balance` stays the
+authoritative total (it is still updated atomically); lots record where
+those units are.
+
+Existing stock is turned into one lot per medication with
+
+    python migrations.py lots
+
+Until then – and for any part of a balance no lot accounts for – the
+expiry reports list a medication under its own batch and expiry_date.
+"""
+
+import logging
+from uuid import uuid4
+from bson import ObjectId
+from datetime import datetime
+from pymongo import UpdateOne, ReturnDocument
+from schema import parse_expiry, day_start
+from archive import find_transactions, aggregate_transactions
+
+COLLECTION = 'lots'
+
+logger = logging.getLogger('lots')
+
+
+def add_lot_op(med_name, batch, expiry_date, quantity, price=None):
+    """UpdateOne booking `quantity` units of a received batch (for bulk_write)."""
+    return UpdateOne(
+        {'med_name': med_name, 'batch': batch},
+        {'$inc': {'quantity': quantity, 'received': quantity},
+         '$set': {'expiry': parse_expiry(expiry_date), 'expiry_date': expiry_date, 'price': price},
+         '$setOnInsert': {'received_at': datetime.utcnow()}},
+        upsert=True
+    )
+
+
+def add_lot(db, med_name, batch, expiry_date, quantity, price=None):
+    """Book `quantity` units of a received batch (merged with an existing lot of the same batch)."""
+    db[COLLECTION].bulk_write([add_lot_op(med_name, batch, expiry_date, quantity, price)])
+
+
+def remove_from_lot(db, med_name, batch, quantity):
+    """Take back a receive (edit / delete): lower the lot, never below zero."""
+    db[COLLECTION].update_one(
+        {'med_name': med_name, 'batch': batch},
+        [{'$set': {
+            'quantity': {'$max': [0, {'$subtract': ['$quantity', quantity]}]},
+            'received': {'$max': [0, {'$subtract': ['$received', quantity]}]},
+        }}]
+    )
+
+
+def adjust_lots(db, med_name, batch, expiry_date, price, delta):
+    """Carry a medication edit (edit_medication) over to its lots.
+
+    The lot of `batch` takes the edited expiry and price.  A balance raised
+    by `delta` units books them to that lot (created if missing); a balance
+    lowered takes them from that lot first, then first-expiry-first-out from
+    the others, never below zero.  Units no lot holds are left alone.
+    """
+    coll = db[COLLECTION]
+    fields = {'expiry': parse_expiry(expiry_date), 'expiry_date': expiry_date, 'price': price}
+    if batch and delta > 0:
+        coll.update_one({'med_name': med_name, 'batch': batch},
+                        {'$inc': {'quantity': delta}, '$set': fields,
+                         '$setOnInsert': {'received': 0, 'received_at': datetime.utcnow()}},
+                        upsert=True)
+        return
+    if batch:
+        coll.update_one({'med_name': med_name, 'batch': batch}, {'$set': fields})
+    if delta < 0:
+        lots = sorted(_open_lots(db, med_name), key=lambda lot: lot.get('batch') != batch)
+        allocations, _ = _plan(lots, -delta)
+        if allocations:
+            coll.bulk_write([
+                UpdateOne({'_id': a['lot_id']},
+                          [{'$set': {'quantity': {'$max': [0, {'$subtract': ['$quantity', a['quantity']]}]}}}])
+                for a in allocations
+            ], ordered=False)
+
+
+def _plan(lots, quantity):
+    allocations, remaining = [], quantity
+    for lot in lots:
+        if remaining <= 0:
+            break
+        take = min(lot['quantity'], remaining)
+        allocations.append({'lot_id': lot['_id'], 'batch': lot.get('batch'),
+                            'expiry': lot.get('expiry'), 'quantity': take})
+        remaining -= take
+    return allocations, remaining
+
+
+def _fefo_key(today):
+    # Earliest expiry first; lots without an expiry after dated ones and
+    # already-expired lots only once nothing else is left
+    def key(lot):
+        expiry = lot.get('expiry')
+        expired = expiry is not None and expiry < today
+        return (expired, expiry is None, expiry or datetime.max, lot.get('received_at') or datetime.min)
+    return key
+
+
+def _open_lots(db, med_name, exclude=()):
+    query = {'med_name': med_name, 'quantity': {'$gt': 0}}
+    if exclude:
+        query['_id'] = {'$nin': list(exclude)}
+    lots = list(db[COLLECTION].find(query, {'batch': 1, 'expiry': 1, 'quantity': 1, 'received_at': 1}))
+    return sorted(lots, key=_fefo_key(day_start(datetime.utcnow())))
+
+
+def consume_fefo(db, med_name, quantity, fallback_batch=None):
+    """Draw `quantity` units first-expiry-first-out and return the allocations.
+
+    The whole draw is ONE bulk_write of guarded `$inc`s.  If a concurrent
+    dispense emptied one of the planned lots first, the missing part is
+    re-planned against the remaining lots one atomic update at a time.
+    Units not covered by any lot (stock that predates lot tracking) are
+    returned as an allocation without `lot_id`, labelled `fallback_batch`.
+    """
+    allocations, remaining = _plan(_open_lots(db, med_name), quantity)
+    if allocations:
+        token = uuid4().hex
+        result = db[COLLECTION].bulk_write([
+            UpdateOne({'_id': a['lot_id'], 'quantity': {'$gte': a['quantity']}},
+                      {'$inc': {'quantity': -a['quantity']}, '$set': {'last_draw': token}})
+            for a in allocations
+        ], ordered=False)
+        if result.modified_count < len(allocations):
+            applied = {d['_id'] for d in db[COLLECTION].find(
+                {'_id': {'$in': [a['lot_id'] for a in allocations]}, 'last_draw': token}, {'_id': 1})}
+            missed = sum(a['quantity'] for a in allocations if a['lot_id'] not in applied)
+            allocations = [a for a in allocations if a['lot_id'] in applied]
+            remaining += missed
+            tried = set(applied)
+            while remaining > 0:
+                lots = _open_lots(db, med_name, exclude=tried)
+                if not lots:
+                    break
+                lot = lots[0]
+                tried.add(lot['_id'])
+                take = min(lot['quantity'], remaining)
+                updated = db[COLLECTION].find_one_and_update(
+                    {'_id': lot['_id'], 'quantity': {'$gte': take}},
+                    {'$inc': {'quantity': -take}},
+                    return_document=ReturnDocument.AFTER
+                )
+                if updated is not None:
+                    allocations.append({'lot_id': lot['_id'], 'batch': lot.get('batch'),
+                                        'expiry': lot.get('expiry'), 'quantity': take})
+                    remaining -= take
+    if remaining > 0:
+        logger.warning("No lot covers %d unit(s) of '%s' – recorded against batch %r.",
+                       remaining, med_name, fallback_batch)
+        allocations.append({'lot_id': None, 'batch': fallback_batch, 'expiry': None, 'quantity': remaining})
+    return allocations
+
+
+def release(db, allocations):
+    """Return dispensed units to their lots (dispense edit / delete)."""
+    ops = [UpdateOne({'_id': a['lot_id']}, {'$inc': {'quantity': a['quantity']}})
+           for a in allocations or [] if a.get('lot_id') is not None]
+    if ops:
+        db[COLLECTION].bulk_write(ops, ordered=False)
+
+
+def batches_of(allocations):
+    """Distinct batch labels of a dispense line, in draw order (the line's `batch` field)."""
+    return list(dict.fromkeys(a['batch'] for a in allocations if a.get('batch')))
+
+
+def has_lots(db):
+    return db[COLLECTION].estimated_document_count() > 0
+
+
+def lot_totals(db, med_names=None):
+    """{med_name: units left in its lots}; the rest of a balance predates lot tracking."""
+    match = {'quantity': {'$gt': 0}}
+    if med_names is not None:
+        match['med_name'] = {'$in': list(med_names)}
+    return {row['_id']: row['quantity'] for row in db[COLLECTION].aggregate([
+        {'$match': match},
+        {'$group': {'_id': '$med_name', 'quantity': {'$sum': '$quantity'}}},
+    ])}
+
+
+def expiring_lots(db, before=None, from_date=None, through=None, search=None):
+    """Lots with stock left whose expiry falls in the window (index on `expiry`)."""
+    window = {}
+    if from_date is not None:
+        window['$gte'] = day_start(from_date)
+    if before is not None:
+        window['$lt'] = day_start(before)
+    if through is not None:
+        window['$lte'] = day_start(through)
+    query = {'expiry': window, 'quantity': {'$gt': 0}}
+    if search:
+        query['med_name'] = {'$regex': search, '$options': 'i'}
+    return list(db[COLLECTION].find(query, {'_id': 0, 'last_draw': 0})
+                .sort([('med_name', 1), ('expiry', 1)]))
+
+
+# --------------------------------------------------------------------------- #
+# Batch recall
+# --------------------------------------------------------------------------- #
+RECALL_FIELDS = {'transaction_id': 1, 'patient': 1, 'company': 1, 'position': 1, 'date': 1,
+                 'med_name': 1, 'quantity': 1, 'lots': 1, 'batch': 1, 'batch_inferred': 1,
+                 'prescriber': 1, 'dispenser': 1, 'timestamp': 1}
+
+
+def _units_from_batch(line, batch):
+    lots = line.get('lots')
+    if isinstance(lots, list):
+        return sum(a['quantity'] for a in lots if a.get('batch') == batch)
+    return line.get('quantity', 0)
+
+
+def encode_cursor(line):
+    return f"{line['timestamp'].isoformat()}|{line['_id']}"
+
+
+def decode_cursor(cursor):
+    """(timestamp, _id) from a recall page cursor; ValueError if malformed."""
+    ts, _, raw_id = cursor.partition('|')
+    if not raw_id:
+        raise ValueError('malformed cursor')
+    return datetime.fromisoformat(ts), ObjectId(raw_id) if ObjectId.is_valid(raw_id) else raw_id
+
+
+def recall(db, batch, med_name=None, after=None, limit=100):
+    """One page of dispense lines drawn from `batch`, newest first.
+
+    Keyset pagination on (timestamp, _id) over the (batch, med_name,
+    timestamp) index, so every page costs the same however much history
+    there is.  Returns (lines, next_cursor); next_cursor is None on the
+    last page.
+    """
+    query = {'type': 'dispense', 'batch': batch}
+    if med_name:
+        query['med_name'] = med_name
+    if after:
+        ts, last_id = decode_cursor(after)
+        query['$or'] = [{'timestamp': {'$lt': ts}}, {'timestamp': ts, '_id': {'$lt': last_id}}]
+    lines = list(find_transactions(db['transactions'], query, RECALL_FIELDS,
+                                   [('timestamp', -1), ('_id', -1)], limit + 1))
+    more = len(lines) > limit
+    lines = lines[:limit]
+    for line in lines:
+        line['batch_quantity'] = _units_from_batch(line, batch)
+    return lines, (encode_cursor(lines[-1]) if more else None)
+
+
+def recall_patients(db, batch, med_name=None):
+    """Every patient who received `batch`: units, lines and first / last dispense."""
+    match = {'type': 'dispense', 'batch': batch}
+    if med_name:
+        match['med_name'] = med_name
+    per_batch = {'$cond': [
+        {'$isArray': '$lots'},
+        {'$sum': {'$map': {'input': {'$filter': {'input': '$lots', 'cond': {'$eq': ['$$this.batch', batch]}}},
+                           'in': '$$this.quantity'}}},
+        '$quantity',
+    ]}
+    return list(aggregate_transactions(db['transactions'], [
+        {'$match': match},
+        {'$group': {
+            '_id': {'patient': '$patient', 'company': '$company'},
+            'units': {'$sum': per_batch},
+            'lines': {'$sum': 1},
+            'medications': {'$addToSet': '$med_name'},
+            'first_dispensed': {'$min': '$timestamp'},
+            'last_dispensed': {'$max': '$timestamp'},
+        }},
+        {'$sort': {'last_dispensed': -1}},
+    ]))
+
+
+def recall_stock(db, batch, med_name=None):
+    """What is still on the shelf of `batch` (to quarantine), per medication."""
+    query = {'batch': batch}
+    if med_name:
+        query['med_name'] = med_name
+    return list(db[COLLECTION].find(query, {'_id': 0, 'med_name': 1, 'quantity': 1,
+                                            'received': 1, 'expiry_date': 1}))
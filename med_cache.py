@@ -0,0 +1,128 @@
+# med_cache.py
+"""
+Read-through cache of medication metadata for dispense validation.
+
+Every dispense line read its medication with find_one() only to learn that
+it exists, whether it is controlled and its fallback batch.  These lookups
+now go through a per-worker cache of
+
+    name, schedule, batch, price
+
+bounded by MED_CACHE_SIZE entries (least recently used evicted first) and
+MED_CACHE_TTL_SECONDS (older entries are re-read).  The balance is NEVER
+cached: stock is still checked and taken by the guarded `$inc` in MongoDB,
+so a stale entry cannot oversell.  Missing medications are not cached either,
+so a medication added elsewhere is found at once.
+
+Routes that change those fields call forget(names).  It drops the entries
+in this worker and publishes the names under the 'medications' namespace of
+cache_versions.py, so the other workers drop them on their next check.  A
+lookup that started before a forget() does not store its (possibly old)
+result.
+
+stats() – hits, misses, expired, evicted, size, hit_ratio – is served at
+GET /api/v1/medication-cache (api_v1.py).
+
+Configuration (environment):
+
+    MED_CACHE_SIZE          max entries per worker, default 2048 (0 disables the cache)
+    MED_CACHE_TTL_SECONDS   max age of an entry, default 300
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from cache_versions import publish, subscribe
+
+NAMESPACE = 'medications'       # cache_versions namespace
+FIELDS = {'_id': 0, 'name': 1, 'schedule': 1, 'batch': 1, 'price': 1}
+
+
+class MedicationCache:
+    """Name -> metadata, LRU-bounded with a TTL; thread-safe."""
+
+    def __init__(self, max_entries=2048, ttl_seconds=300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()       # name -> (doc, expires_at)
+        self._generation = 0                # bumped by every forget() / clear()
+        self._counts = dict.fromkeys(('hits', 'misses', 'expired', 'evicted'), 0)
+        self._lock = threading.Lock()
+
+    def get(self, db, name):
+        """The medication's cached fields (a copy), or None if it does not exist."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(name)
+                    self._counts['hits'] += 1
+                    return dict(entry[0])
+                del self._entries[name]
+                self._counts['expired'] += 1
+            self._counts['misses'] += 1
+            generation = self._generation
+        doc = db['medications'].find_one({'name': name}, FIELDS)
+        if doc is not None and self.max_entries > 0:
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[name] = (doc, now + self.ttl_seconds)
+                    self._entries.move_to_end(name)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self._counts['evicted'] += 1
+        return dict(doc) if doc is not None else None
+
+    def forget(self, names):
+        with self._lock:
+            self._generation += 1
+            for name in names:
+                self._entries.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counts['hits'] + self._counts['misses']
+            return dict(self._counts, size=len(self._entries), max_entries=self.max_entries,
+                        ttl_seconds=self.ttl_seconds,
+                        hit_ratio=round(self._counts['hits'] / lookups, 4) if lookups else None)
+
+
+_cache = MedicationCache(int(os.getenv('MED_CACHE_SIZE', '2048')),
+                         float(os.getenv('MED_CACHE_TTL_SECONDS', '300')))
+
+
+def get_medication(db, name):
+    """Shortcut used by the routes in app.py."""
+    return _cache.get(db, name)
+
+
+def forget(names):
+    """A write changed these medications: drop them here and in the other workers."""
+    names = [name for name in names if name]
+    if not names:
+        return
+    _cache.forget(names)
+    publish(NAMESPACE, {'names': names})
+
+
+def stats():
+    return _cache.stats()
+
+
+def _replay(events):
+    """Forgets published by other workers (cache_versions.py); None = too many missed."""
+    if events is None:
+        _cache.clear()
+        return
+    for event in events:
+        _cache.forget(event.get('names') or [])
+
+
+subscribe(NAMESPACE, _replay)
@@ -0,0 +1,176 @@
+# migrations.py
+"""
+One-off data migrations for pharmacy_db.
+
+    python migrations.py indexes     # create the indexes listed in schema.INDEXES
+    python migrations.py expiry      # backfill typed `expiry` from `expiry_date`
+    python migrations.py lots        # open one lot per medication for its current stock
+    python migrations.py batches     # record the batch on dispense lines that lack it
+    python migrations.py counters    # rebuild the dashboard's daily counters
+    python migrations.py forecast    # refit the consumption forecasts from the full history
+    python migrations.py cube        # rebuild the dispensing cube
+    python migrations.py all         # everything above, in order
+
+Every migration is idempotent and works in batches, so it can be stopped
+and re-run at any time.
+"""
+
+import sys
+import argparse
+from bisect import bisect_right
+from datetime import datetime
+from pymongo import UpdateOne
+from db import get_db
+from schema import ensure_indexes, parse_expiry
+from lots import COLLECTION as LOTS, batches_of
+from dashboard import rebuild_counters
+from forecast import refit
+from cube import rebuild_cube
+
+BATCH_SIZE = 1000
+
+
+def migrate_indexes(db):
+    ensure_indexes(db)
+    print("Indexes ensured.")
+
+
+def migrate_expiry(db):
+    """Set `expiry` on medications and receive transactions that lack it.
+
+    Unparseable strings get `expiry: None` (treated as "no expiry", exactly
+    like the reports always did) so they are not revisited.
+    """
+    for collection, query in (('medications', {}), ('transactions', {'type': 'receive'})):
+        coll = db[collection]
+        todo = dict(query, expiry={'$exists': False}, expiry_date={'$exists': True})
+        updated = invalid = 0
+        while True:
+            batch = list(coll.find(todo, {'_id': 1, 'expiry_date': 1}).limit(BATCH_SIZE))
+            if not batch:
+                break
+            ops = []
+            for doc in batch:
+                typed = parse_expiry(doc.get('expiry_date'))
+                if typed is None and doc.get('expiry_date'):
+                    invalid += 1
+                ops.append(UpdateOne({'_id': doc['_id']}, {'$set': {'expiry': typed}}))
+            coll.bulk_write(ops, ordered=False)
+            updated += len(ops)
+        print(f"{collection}: {updated} documents backfilled ({invalid} with an unparseable expiry_date).")
+
+
+def migrate_lots(db):
+    """Create a lot for every medication that has stock but no lot yet.
+
+    The medication's current batch / expiry / price describe its stock best;
+    older receipts may already have been dispensed, so they are not replayed.
+    """
+    with_lots = set(db[LOTS].distinct('med_name'))
+    created = 0
+    ops = []
+    for med in db['medications'].find({'balance': {'$gt': 0}},
+                                      {'name': 1, 'balance': 1, 'batch': 1, 'expiry_date': 1, 'price': 1}):
+        if med['name'] in with_lots:
+            continue
+        ops.append(UpdateOne(
+            {'med_name': med['name'], 'batch': med.get('batch') or None},
+            {'$setOnInsert': {
+                'quantity': med['balance'],
+                'received': med['balance'],
+                'expiry': parse_expiry(med.get('expiry_date')),
+                'expiry_date': med.get('expiry_date'),
+                'price': med.get('price'),
+                'received_at': datetime.utcnow(),
+            }},
+            upsert=True
+        ))
+        if len(ops) >= BATCH_SIZE:
+            created += db[LOTS].bulk_write(ops, ordered=False).upserted_count
+            ops = []
+    if ops:
+        created += db[LOTS].bulk_write(ops, ordered=False).upserted_count
+    print(f"lots: {created} opening lots created.")
+
+
+def migrate_dispense_batches(db):
+    """Set `batch` (a list) on dispense lines written before it was recorded.
+
+    Lines with lot allocations take their batches from them.  Older lines
+    never knew their batch: they get the batch of the last receipt of that
+    medication before the dispense (or the medication's current batch) and
+    are flagged `batch_inferred: True`, so a recall can tell the two apart.
+    """
+    transactions = db['transactions']
+    receipts = {}
+    for rx in transactions.find({'type': 'receive'}, {'med_name': 1, 'batch': 1, 'timestamp': 1}).sort('timestamp', 1):
+        if rx.get('batch') and rx.get('timestamp'):
+            times, batches = receipts.setdefault(rx['med_name'], ([], []))
+            times.append(rx['timestamp'])
+            batches.append(rx['batch'])
+    current = {m['name']: m.get('batch') for m in db['medications'].find({}, {'name': 1, 'batch': 1})}
+
+    def inferred(line):
+        times, batches = receipts.get(line.get('med_name'), ((), ()))
+        i = bisect_right(times, line['timestamp']) if line.get('timestamp') else 0
+        batch = batches[i - 1] if i else current.get(line.get('med_name'))
+        return [batch] if batch else []
+
+    todo = {'type': 'dispense', 'batch': {'$exists': False}}
+    updated = guessed = 0
+    while True:
+        batch = list(transactions.find(todo, {'med_name': 1, 'lots': 1, 'timestamp': 1}).limit(BATCH_SIZE))
+        if not batch:
+            break
+        ops = []
+        for line in batch:
+            if line.get('lots'):
+                fields = {'batch': batches_of(line['lots'])}
+            else:
+                fields = {'batch': inferred(line), 'batch_inferred': True}
+                guessed += 1
+            ops.append(UpdateOne({'_id': line['_id']}, {'$set': fields}))
+        transactions.bulk_write(ops, ordered=False)
+        updated += len(ops)
+    print(f"transactions: {updated} dispense lines given a batch ({guessed} inferred from receipts).")
+
+
+def migrate_counters(db):
+    days = rebuild_counters(db)
+    print(f"daily_counters: {days} days rebuilt.")
+
+
+def migrate_forecast(db):
+    meds = refit(db)
+    print(f"forecast_state: {meds} medications fitted.")
+
+
+def migrate_cube(db):
+    cells = rebuild_cube(db)
+    print(f"dispense_cube: {cells} cells rebuilt.")
+
+
+MIGRATIONS = {
+    'indexes': migrate_indexes,
+    'expiry': migrate_expiry,
+    'lots': migrate_lots,
+    'batches': migrate_dispense_batches,
+    'counters': migrate_counters,
+    'forecast': migrate_forecast,
+    'cube': migrate_cube,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run pharmacy_db data migrations.')
+    parser.add_argument('migration', choices=list(MIGRATIONS) + ['all'])
+    args = parser.parse_args(argv)
+    db = get_db()
+    names = list(MIGRATIONS) if args.migration == 'all' else [args.migration]
+    for name in names:
+        MIGRATIONS[name](db)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
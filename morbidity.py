@@ -0,0 +1,133 @@
+# morbidity.py
+"""
+Morbidity report: how often each diagnosis was seen, by period and by
+company / age group / gender.
+
+A dispense is stored as one transaction document per medication line, all
+sharing the visit's transaction_id and diagnoses.  Counting diagnoses over
+the lines would count a visit with three medications three times, so the
+report runs ONE aggregation that first collapses the lines of a visit
+(`$group` on transaction_id), then `$unwind`s the diagnoses and counts
+cases per (diagnosis, period, dimension value).  The `$match` is served by
+the (type, timestamp) index, or (type, diagnoses, timestamp) /
+(type, company, timestamp) when drilling down.
+
+    top-N      the N diagnoses with the most cases in the range
+    drill-down one diagnosis, broken down by company / age group / gender
+"""
+
+from datetime import datetime, timedelta
+from archive import aggregate_transactions
+
+DIMENSIONS = ('company', 'age_group', 'gender')
+PERIODS = {'week': '%G-W%V', 'month': '%Y-%m', 'year': '%Y'}
+DEFAULT_TOP = 10
+MAX_TOP = 100
+
+
+def report_range(args, today=None):
+    """(start_date, end_date, start, end) from the query string; end is exclusive.
+
+    Default: the twelve calendar months up to and including today.
+    """
+    today = today or datetime.utcnow().date()
+    end_date = args.get('end_date') or today.strftime('%Y-%m-%d')
+    first_month = today.year * 12 + today.month - 12
+    start_date = args.get('start_date') or f'{first_month // 12:04d}-{first_month % 12 + 1:02d}-01'
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
+    if end <= start:
+        raise ValueError('End date must not be before start date.')
+    return start_date, end_date, start, end
+
+
+def visits(fields):
+    """`$group` stage collapsing dispense lines into one document per visit, keeping `fields`.
+
+    Older lines without a transaction_id count as a visit on their own.
+    """
+    return {'$group': {'_id': {'$ifNull': ['$transaction_id', '$_id']},
+                       **{field: {'$first': f'${field}'} for field in fields}}}
+
+
+def parse_params(args, today=None):
+    """Report parameters from the query string; ValueError if invalid.
+
+    Defaults: the last twelve months, by month, top 10.
+    """
+    start_date, end_date, start, end = report_range(args, today)
+    period = args.get('period') or 'month'
+    if period not in PERIODS:
+        raise ValueError(f"Period must be one of: {', '.join(PERIODS)}.")
+    by = args.get('by') or None
+    if by is not None and by not in DIMENSIONS:
+        raise ValueError(f"Breakdown must be one of: {', '.join(DIMENSIONS)}.")
+    top = int(args.get('top') or DEFAULT_TOP)
+    if not 1 <= top <= MAX_TOP:
+        raise ValueError(f'Top must be between 1 and {MAX_TOP}.')
+    diagnosis = (args.get('diagnosis') or '').strip() or None
+    if diagnosis and by is None:
+        by = 'company'
+    filters = {dim: args.get(dim).strip() for dim in DIMENSIONS if (args.get(dim) or '').strip()}
+    return {
+        'start_date': start_date, 'end_date': end_date, 'start': start, 'end': end,
+        'period': period, 'by': by, 'top': top, 'diagnosis': diagnosis, 'filters': filters,
+    }
+
+
+def cache_search(params):
+    """The non-date parameters as one string – the `search` part of the report cache key."""
+    parts = [f"period={params['period']}", f"by={params['by'] or ''}", f"top={params['top']}",
+             f"diagnosis={params['diagnosis'] or ''}"]
+    parts += [f'{dim}={value}' for dim, value in sorted(params['filters'].items())]
+    return '|'.join(parts)
+
+
+def morbidity(db, start, end, period='month', by=None, top=DEFAULT_TOP, diagnosis=None, filters=None):
+    """Diagnosis case counts for dispenses in [start, end).
+
+    Returns {'visits', 'cases', 'top': [(diagnosis, cases)], 'periods',
+    'rows': [{'diagnosis', 'value', 'cases', 'by_period'}]} – one row per
+    top diagnosis, or per (diagnosis, `by` value) with a breakdown.
+    """
+    match = {'type': 'dispense', 'timestamp': {'$gte': start, '$lt': end}}
+    match.update(filters or {})
+    if diagnosis:
+        match['diagnoses'] = diagnosis
+    count = [{'$unwind': '$diagnoses'}]
+    if diagnosis:
+        count.append({'$match': {'diagnoses': diagnosis}})
+    count.append({'$group': {
+        '_id': {
+            'diagnosis': '$diagnoses',
+            'period': {'$dateToString': {'format': PERIODS[period], 'date': '$timestamp'}},
+            'value': f'${by}' if by else None,
+        },
+        'cases': {'$sum': 1},
+    }})
+    result = next(aggregate_transactions(db['transactions'], [
+        {'$match': match},
+        visits(['diagnoses', 'timestamp'] + ([by] if by else [])),
+        {'$facet': {'visits': [{'$count': 'n'}], 'counts': count}},
+    ], start=start, allowDiskUse=True), {'visits': [], 'counts': []})
+
+    totals, rows = {}, {}
+    for entry in result['counts']:
+        key = entry['_id']
+        name = key['diagnosis']
+        totals[name] = totals.get(name, 0) + entry['cases']
+        row = rows.setdefault((name, key.get('value')), {
+            'diagnosis': name, 'value': key.get('value'), 'cases': 0, 'by_period': {}})
+        row['cases'] += entry['cases']
+        row['by_period'][key['period']] = row['by_period'].get(key['period'], 0) + entry['cases']
+    ranked = sorted(totals.items(), key=lambda item: (-item[1], str(item[0])))[:top]
+    rank = {name: i for i, (name, _) in enumerate(ranked)}
+    selected = sorted((row for row in rows.values() if row['diagnosis'] in rank),
+                      key=lambda row: (rank[row['diagnosis']], -row['cases'], str(row['value'])))
+    return {
+        'visits': result['visits'][0]['n'] if result['visits'] else 0,
+        'cases': sum(totals.values()),
+        'top': ranked,
+        'periods': sorted({p for row in selected for p in row['by_period']}),
+        'rows': selected,
+    }
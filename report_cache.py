@@ -0,0 +1,362 @@
+# report_cache.py
+"""
+Report result cache with write-driven invalidation.
+
+Results of compute_report() are cached under
+(report_type, start_date, end_date, search).  Two backends are available:
+
+  * lru  – in-process, bounded by REPORT_CACHE_SIZE entries (per worker)
+  * disk – one SQLite file shared by all gunicorn workers on the host
+
+Configuration (environment):
+
+    REPORT_CACHE_BACKEND   lru (default) | disk | none
+    REPORT_CACHE_SIZE      max entries, default 128
+    REPORT_CACHE_PATH      SQLite file for the disk backend, default report_cache.sqlite3
+    REPORT_CACHE_TTL_SECONDS  max age of an entry; default: the replication lag
+                           reports may see (db.report_staleness_seconds()),
+                           i.e. no TTL when reports read the primary
+
+Writes call invalidate_reports(kind, med_names, timestamps) and only the
+entries whose numbers can change are dropped:
+
+  * stock reports (balance as of end_date) – writes dated on/before end_date,
+    or direct medication edits, for medications matching the search
+  * inventory – any write to a matching medication (it shows current balance)
+  * expired_list, near_expired_list – likewise: with lots they list each
+    lot's current quantity, which a write dated after end_date changes too
+  * receive_list – receive writes dated inside the report period
+  * controlled_drug_register – any write (ending balance is the current balance)
+  * morbidity, sick_leave – dispense writes dated inside the report period
+    (their other parameters travel in the `search` part of the key)
+
+Reports read from a secondary can be computed after a write has already
+invalidated the cache but before the secondary has that write.  Such an
+entry is stale with no further write to drop it, so with secondary reads
+entries expire once they are older than the staleness bound.
+
+A write can also land while a report is being computed: it finds no entry
+to drop and the computation then stores its (stale) result.  Callers take
+generation() before computing and pass it to put(); the cache keeps its
+last INVALIDATION_LOG invalidations and put() stores nothing if one of
+those since the snapshot affects the key (or the log no longer reaches back
+that far).
+
+Each write is also published under the 'reports' namespace of
+cache_versions.py, and the other workers replay it against their own
+cache the next time they check.
+"""
+
+import os
+import re
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from cache_versions import publish, subscribe
+from db import report_staleness_seconds
+
+STOCK_REPORT_TYPES = ('stock_on_hand', 'expired_list', 'near_expired_list', 'out_of_stock_list')
+# Stock reports that list the lots' current quantities (lots.py), whatever the write's date
+LOT_REPORT_TYPES = ('expired_list', 'near_expired_list')
+# Reports over dispense records only (patients, diagnoses) – stock movements never change them
+DISPENSE_REPORT_TYPES = ('morbidity', 'sick_leave')
+
+# Kinds of write passed to invalidate()
+DISPENSE = 'dispense'
+RECEIVE = 'receive'
+MEDICATION = 'medication'
+
+NAMESPACE = 'reports'       # cache_versions namespace
+INVALIDATION_LOG = 256      # recent invalidations put() checks a computation against
+
+
+# --------------------------------------------------------------------------- #
+# Backends – both store entry dicts: payload, computed_at, compute_ms
+# --------------------------------------------------------------------------- #
+class LRUBackend:
+    """In-process LRU bounded by `max_entries`."""
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskBackend:
+    """SQLite file shared by every worker process on the host."""
+
+    def __init__(self, path='report_cache.sqlite3', max_entries=128):
+        self.path = path
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS report_cache ('
+                ' report_type TEXT, start_date TEXT, end_date TEXT, search TEXT,'
+                ' computed_at TEXT, compute_ms REAL, last_used REAL, payload BLOB,'
+                ' PRIMARY KEY (report_type, start_date, end_date, search))'
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT computed_at, compute_ms, payload FROM report_cache'
+                ' WHERE report_type=? AND start_date=? AND end_date=? AND search=?', key
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE report_cache SET last_used=julianday('now')"
+                ' WHERE report_type=? AND start_date=? AND end_date=? AND search=?', key
+            )
+        return {
+            'computed_at': datetime.fromisoformat(row[0]),
+            'compute_ms': row[1],
+            'payload': pickle.loads(row[2]),
+        }
+
+    def set(self, key, entry):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO report_cache VALUES (?, ?, ?, ?, ?, ?, julianday('now'), ?)",
+                key + (entry['computed_at'].isoformat(), entry['compute_ms'],
+                       pickle.dumps(entry['payload'], protocol=pickle.HIGHEST_PROTOCOL))
+            )
+            conn.execute(
+                'DELETE FROM report_cache WHERE rowid IN ('
+                ' SELECT rowid FROM report_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+
+    def keys(self):
+        with self._connect() as conn:
+            return [tuple(r) for r in conn.execute(
+                'SELECT report_type, start_date, end_date, search FROM report_cache')]
+
+    def delete_many(self, keys):
+        with self._connect() as conn:
+            conn.executemany(
+                'DELETE FROM report_cache'
+                ' WHERE report_type=? AND start_date=? AND end_date=? AND search=?', keys
+            )
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM report_cache')
+
+
+class NullBackend:
+    """Caching disabled."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, entry):
+        pass
+
+    def keys(self):
+        return []
+
+    def delete_many(self, keys):
+        pass
+
+    def clear(self):
+        pass
+
+
+# --------------------------------------------------------------------------- #
+# Cache
+# --------------------------------------------------------------------------- #
+def _dates(timestamps):
+    return [ts.strftime('%Y-%m-%d') for ts in (timestamps or [datetime.utcnow()])]
+
+
+def _med_matches(search, med_name):
+    """Same semantics as the reports' case-insensitive `$regex` on the name."""
+    if not search:
+        return True
+    try:
+        return re.search(search, med_name, re.IGNORECASE) is not None
+    except re.error:
+        return search.lower() in med_name.lower()
+
+
+def _affected(key, kind, med_names, dates):
+    """Can a write of `kind` touching `med_names` on `dates` change this entry?"""
+    report_type, start_date, end_date, search = key
+    if report_type == 'controlled_drug_register':
+        return True
+    if report_type in DISPENSE_REPORT_TYPES:
+        if kind != DISPENSE:
+            return False
+        return any(start_date <= d <= end_date for d in dates)
+    if report_type == 'receive_list':
+        if kind != RECEIVE:
+            return False
+        if not (start_date and end_date):
+            return True
+        return any(start_date <= d <= end_date for d in dates)
+    if med_names is not None and not any(_med_matches(search, m) for m in med_names):
+        return False
+    if report_type in LOT_REPORT_TYPES:
+        return True
+    if report_type in STOCK_REPORT_TYPES:
+        if kind == MEDICATION or not end_date:
+            return True
+        return any(d <= end_date for d in dates)
+    return True
+
+
+class ReportCache:
+    def __init__(self, backend, ttl_seconds=0):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds      # 0 = entries live until a write invalidates them
+        self._generation = 0                # bumped by every invalidation / clear()
+        self._log = deque(maxlen=INVALIDATION_LOG)      # (generation, kind, med_names, dates); kind None = clear()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(report_type, start_date, end_date, search):
+        return (report_type or '', start_date or '', end_date or '', search or '')
+
+    def get(self, report_type, start_date, end_date, search):
+        """Cached entry ({'payload', 'computed_at', 'compute_ms'}) or None."""
+        key = self.make_key(report_type, start_date, end_date, search)
+        entry = self.backend.get(key)
+        if entry is not None and self.ttl_seconds and \
+                (datetime.utcnow() - entry['computed_at']).total_seconds() > self.ttl_seconds:
+            self.backend.delete_many([key])
+            return None
+        return entry
+
+    def generation(self):
+        """Snapshot to take before computing a report and to pass to put()."""
+        with self._lock:
+            return self._generation
+
+    def _invalidated_since(self, key, generation):
+        if generation == self._generation:
+            return False
+        if not self._log or self._log[0][0] > generation + 1:
+            return True         # invalidations fell out of the log: assume the worst
+        return any(kind is None or _affected(key, kind, med_names, dates)
+                   for gen, kind, med_names, dates in self._log if gen > generation)
+
+    def put(self, report_type, start_date, end_date, search, payload, compute_ms, generation=None):
+        """Store a result; False (not stored) if a write since `generation` may have changed it."""
+        key = self.make_key(report_type, start_date, end_date, search)
+        with self._lock:
+            if generation is not None and self._invalidated_since(key, generation):
+                return False
+            self.backend.set(key, {
+                'payload': payload,
+                'computed_at': datetime.utcnow(),
+                'compute_ms': round(compute_ms, 1),
+            })
+        return True
+
+    def invalidate(self, kind, med_names=None, timestamps=None):
+        """Drop the entries a write can affect.
+
+        `med_names=None` means "any medication"; `timestamps` are the
+        transaction timestamps written or removed (default: now).
+        """
+        return self.invalidate_dates(kind, med_names, _dates(timestamps))
+
+    def invalidate_dates(self, kind, med_names, dates):
+        """invalidate() with the dates already as 'YYYY-MM-DD' strings."""
+        if med_names is not None:
+            med_names = [m for m in med_names if m]
+        with self._lock:
+            self._generation += 1
+            self._log.append((self._generation, kind, med_names, dates))
+            stale = [key for key in self.backend.keys() if _affected(key, kind, med_names, dates)]
+            if stale:
+                self.backend.delete_many(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._log.append((self._generation, None, None, None))
+            self.backend.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_report_cache():
+    """Process-wide cache, built from the environment on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                backend_name = os.getenv('REPORT_CACHE_BACKEND', 'lru').lower()
+                size = int(os.getenv('REPORT_CACHE_SIZE', '128'))
+                if backend_name == 'disk':
+                    backend = DiskBackend(os.getenv('REPORT_CACHE_PATH', 'report_cache.sqlite3'), size)
+                elif backend_name == 'none':
+                    backend = NullBackend()
+                else:
+                    backend = LRUBackend(size)
+                ttl = os.getenv('REPORT_CACHE_TTL_SECONDS')
+                _cache = ReportCache(backend, float(ttl) if ttl else report_staleness_seconds())
+    return _cache
+
+
+def invalidate_reports(kind, med_names=None, timestamps=None):
+    """Shortcut used by the write routes in app.py – this worker's cache, then the others'."""
+    cache = get_report_cache()
+    if med_names is not None:
+        med_names = [m for m in med_names if m]
+    dates = _dates(timestamps)
+    dropped = cache.invalidate_dates(kind, med_names, dates)
+    if not isinstance(cache.backend, NullBackend):
+        publish(NAMESPACE, {'kind': kind, 'med_names': med_names, 'dates': dates})
+    return dropped
+
+
+def _replay(events):
+    """Writes published by other workers (cache_versions.py); None = too many missed."""
+    cache = get_report_cache()
+    if events is None:
+        cache.clear()
+        return
+    for event in events:
+        cache.invalidate_dates(event.get('kind'), event.get('med_names'), event.get('dates') or [])
+
+
+subscribe(NAMESPACE, _replay)
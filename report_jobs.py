@@ -0,0 +1,165 @@
+# report_jobs.py
+"""
+Background execution for long-running reports.
+
+Instead of computing a large inventory / controlled-register report inside
+the request (and holding a sync gunicorn worker for minutes), the /reports
+POST can enqueue it:
+
+    job_id = submit_report_job(client_factory, compute, report_type, ...)
+
+The job runs on a small per-process thread pool and reads through
+db.reporting_db() (REPORT_READ_PREFERENCE, e.g. a secondary).  Its status, progress
+and result live in the `report_jobs` collection, so any worker can answer
+the polling requests, and a TTL index removes finished jobs after
+REPORT_JOB_TTL_SECONDS.
+
+Configuration (environment):
+
+    REPORT_JOB_WORKERS       threads per gunicorn worker, default 2
+    REPORT_JOB_TTL_SECONDS   how long results are kept, default 3600
+"""
+
+import os
+import time
+import logging
+import threading
+from uuid import uuid4
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import DocumentTooLarge, PyMongoError
+from db import reporting_db
+
+DB_NAME = 'pharmacy_db'
+COLLECTION = 'report_jobs'
+JOB_WORKERS = int(os.getenv('REPORT_JOB_WORKERS', '2'))
+JOB_TTL_SECONDS = int(os.getenv('REPORT_JOB_TTL_SECONDS', '3600'))
+PROGRESS_INTERVAL = 0.5      # seconds between progress writes
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+logger = logging.getLogger('report_jobs')
+
+# --------------------------------------------------------------------------- #
+# Per-process executor (created lazily so it is never inherited across fork)
+# --------------------------------------------------------------------------- #
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_indexed = False
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='report-job')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _jobs(client):
+    global _indexed
+    coll = client[DB_NAME][COLLECTION]
+    if not _indexed:
+        coll.create_index('expires_at', expireAfterSeconds=0)
+        _indexed = True
+    return coll
+
+
+# --------------------------------------------------------------------------- #
+# Public API
+# --------------------------------------------------------------------------- #
+def submit_report_job(client_factory, compute, report_type, start_date, end_date, search, user):
+    """Record a queued job, hand it to the pool and return its id.
+
+    `compute(db, report_type, start_date, end_date, search, progress)` must
+    return the report payload dict; `client_factory()` returns the shared MongoClient.
+    """
+    job_id = uuid4().hex
+    now = datetime.utcnow()
+    _jobs(client_factory()).insert_one({
+        '_id': job_id,
+        'status': QUEUED,
+        'report_type': report_type,
+        'start_date': start_date,
+        'end_date': end_date,
+        'search': search,
+        'user': user,
+        'progress': {'done': 0, 'total': None},
+        'created_at': now,
+        'expires_at': now + timedelta(seconds=JOB_TTL_SECONDS),
+    })
+    _get_executor().submit(_run_job, job_id, client_factory, compute,
+                           report_type, start_date, end_date, search)
+    return job_id
+
+
+def get_report_job(client, job_id):
+    """Job document (including the result once done), or None if unknown / expired."""
+    job = client[DB_NAME][COLLECTION].find_one({'_id': job_id})
+    if job and job['expires_at'] < datetime.utcnow():
+        return None
+    return job
+
+
+def job_status(job):
+    """JSON-safe summary for polling (no result payload)."""
+    return {
+        'job_id': job['_id'],
+        'status': job['status'],
+        'report_type': job['report_type'],
+        'progress': job.get('progress'),
+        'compute_ms': job.get('compute_ms'),
+        'error': job.get('error'),
+    }
+
+
+# --------------------------------------------------------------------------- #
+# Worker
+# --------------------------------------------------------------------------- #
+def _run_job(job_id, client_factory, compute, report_type, start_date, end_date, search):
+    client = client_factory()
+    jobs = client[DB_NAME][COLLECTION]
+    last_write = [0.0]
+
+    def progress(done, total):
+        now = time.monotonic()
+        if done == total or now - last_write[0] >= PROGRESS_INTERVAL:
+            last_write[0] = now
+            jobs.update_one({'_id': job_id}, {'$set': {'progress': {'done': done, 'total': total}}})
+
+    try:
+        jobs.update_one({'_id': job_id}, {'$set': {'status': RUNNING, 'started_at': datetime.utcnow()}})
+        started = time.perf_counter()
+        payload = compute(reporting_db(client), report_type, start_date, end_date, search, progress)
+        compute_ms = round((time.perf_counter() - started) * 1000.0, 1)
+        jobs.update_one({'_id': job_id}, {'$set': {
+            'status': DONE,
+            'result': payload,
+            'compute_ms': compute_ms,
+            'finished_at': datetime.utcnow(),
+        }})
+    except DocumentTooLarge:
+        jobs.update_one({'_id': job_id}, {'$set': {
+            'status': FAILED,
+            'error': 'The report is too large to store – narrow the date range or search.',
+            'finished_at': datetime.utcnow(),
+        }})
+    except ValueError as e:
+        jobs.update_one({'_id': job_id}, {'$set': {
+            'status': FAILED, 'error': f'Invalid input: {e}', 'finished_at': datetime.utcnow(),
+        }})
+    except Exception as e:
+        if isinstance(e, PyMongoError) and e.timeout:
+            # REPORT_JOB_MAX_TIME_MS ran out (maxTimeMS on the server or the client-side deadline)
+            error = 'The report exceeded its time budget – narrow the date range or search.'
+        else:
+            logger.exception("Report job %s failed", job_id)
+            error = str(e)
+        try:
+            jobs.update_one({'_id': job_id}, {'$set': {
+                'status': FAILED, 'error': error, 'finished_at': datetime.utcnow(),
+            }})
+        except PyMongoError:
+            pass
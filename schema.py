@@ -0,0 +1,108 @@
+# schema.py
+"""
+Document-shape helpers and index definitions for pharmacy_db.
+
+`expiry_date` has always been stored as the free-form string typed into the
+forms ('2026-03-31' or '2026-03-31T00:00:00.000Z').  Alongside it every
+medication and receive transaction now carries `expiry`, a real date
+(naive UTC midnight), so expiry filtering can run as an indexed range query
+inside MongoDB.  Existing documents are backfilled with
+
+    python migrations.py expiry
+"""
+
+import logging
+from datetime import datetime, date
+
+logger = logging.getLogger('schema')
+
+# (collection, keys, options) – created by ensure_indexes()
+INDEXES = [
+    ('medications', [('name', 1)], {}),
+    ('medications', [('expiry', 1)], {}),
+    ('medications', [('balance', 1)], {}),
+    # covers the controlled-drug list (name + balance straight from the index)
+    ('medications', [('schedule', 1), ('name', 1), ('balance', 1)], {}),
+    ('transactions', [('type', 1), ('timestamp', -1)], {}),
+    ('transactions', [('batch', 1), ('med_name', 1), ('timestamp', -1)], {}),
+    ('transactions', [('transaction_id', 1)], {}),
+    # archival job walks the hot collection oldest first
+    ('transactions', [('timestamp', 1)], {}),
+    # morbidity drill-down by diagnosis / company
+    ('transactions', [('type', 1), ('diagnoses', 1), ('timestamp', -1)], {}),
+    ('transactions', [('type', 1), ('company', 1), ('timestamp', -1)], {}),
+    ('users', [('username', 1)], {}),
+    # one document per cube cell; the month prefix serves month ranges
+    ('dispense_cube', [('month', 1), ('company', 1), ('med_name', 1), ('diagnosis', 1), ('age_group', 1), ('gender', 1)],
+     {'unique': True}),
+    ('transactions_archive', [('type', 1), ('timestamp', -1)], {}),
+    ('transactions_archive', [('batch', 1), ('med_name', 1), ('timestamp', -1)], {}),
+    ('transactions_archive', [('transaction_id', 1)], {}),
+    ('lots', [('med_name', 1), ('expiry', 1)], {}),
+    ('lots', [('med_name', 1), ('batch', 1)], {'unique': True}),
+    ('lots', [('expiry', 1)], {}),
+]
+
+
+def parse_expiry(value):
+    """Typed expiry (datetime at midnight) from a form / legacy value, or None.
+
+    Accepts a plain 'YYYY-MM-DD' date, a full ISO datetime (only the date
+    part is kept), a date or a datetime.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    text = str(value).strip()
+    if 'T' in text:
+        text = text.split('T')[0]
+    try:
+        return datetime.strptime(text, '%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def expiry_of(doc):
+    """Expiry of a medication / transaction as a date, typed field first."""
+    typed = doc.get('expiry')
+    if isinstance(typed, datetime):
+        return typed.date()
+    raw = doc.get('expiry_date')
+    if raw and 'expiry' not in doc:
+        parsed = parse_expiry(raw)
+        if parsed is None:
+            logger.warning("Invalid expiry_date '%s' for '%s' – treating as no expiry.",
+                           raw, doc.get('name', doc.get('med_name', 'unknown')))
+        return parsed.date() if parsed else None
+    return None
+
+
+def day_start(d):
+    """Naive UTC midnight of a date – the form `expiry` is stored in."""
+    return datetime(d.year, d.month, d.day)
+
+
+def expiry_range_filter(gte=None, lt=None, lte=None):
+    """Filter on the typed expiry that still matches documents not yet backfilled.
+
+    Backfilled documents are selected by the index on `expiry`; documents
+    without the field (pre-migration) are returned too and classified in
+    Python from their `expiry_date` string.
+    """
+    bounds = {}
+    if gte is not None:
+        bounds['$gte'] = day_start(gte)
+    if lt is not None:
+        bounds['$lt'] = day_start(lt)
+    if lte is not None:
+        bounds['$lte'] = day_start(lte)
+    return {'$or': [{'expiry': bounds}, {'expiry': {'$exists': False}}]}
+
+
+def ensure_indexes(db):
+    """Create every index the app relies on (idempotent)."""
+    for collection, keys, options in INDEXES:
+        db[collection].create_index(keys, **options)
@@ -0,0 +1,241 @@
+# seed_pharmacy.py
+"""
+Synthetic pharmacy dataset generator.
+
+Seeds a (local!) MongoDB with medications (and their open lots), controlled
+drugs, users and multi-line dispense / receive transactions spread over N years, using the
+same schema the app writes and the real DIAGNOSES_OPTIONS.
+
+    python seed_pharmacy.py --medications 800 --controlled 25 \\
+        --dispenses 50000 --receipts 6000 --years 3 --drop
+
+The generator is deterministic for a given --seed, so benchmark runs over
+the same size are comparable.  It refuses to write into a database that
+already holds transactions unless --drop is given.
+"""
+
+import os
+import sys
+import random
+import argparse
+from datetime import datetime, timedelta
+from uuid import uuid4
+from pymongo import MongoClient
+from werkzeug.security import generate_password_hash
+from schema import parse_expiry
+from dashboard import rebuild_counters
+from cube import rebuild_cube
+
+DB_NAME = 'pharmacy_db'
+
+# Values offered by the dispense form (DISPENSE_TEMPLATE)
+COMPANIES = ['BLW', 'BUSY BEE', 'CMS', 'Consulmet', 'Enaex', 'Eminence', 'ER24',
+             'Government', 'IFS', 'LD', 'LISELO', 'LMPS', 'Mendi', 'MGC', 'MINOPEX',
+             'NMC', 'Other', 'PLATO', 'Public', 'THOLO', 'TOMRA', 'UL4', 'UNITRANS']
+POSITIONS = ['Administration', 'Artisan', 'Blasting', 'Boiler Maker', 'Chef', 'Cleaner',
+             'Drilling', 'Drivers', 'Electricians', 'Fitters', 'General Worker',
+             'Geologist', 'Housekeeping', 'IT', 'Security', 'Operator']
+AGE_GROUPS = ['18-24', '25-34', '35-45', '45-54', '54-65']
+GENDERS = ['Male', 'Female']
+PRESCRIBERS = ['Dr. T. Khothatso', 'Locum', 'Malesoetsa Leohla', 'Mamosa Seetsa',
+               'Mamosaase Nqosa', 'Mapalo Mapesela', 'Mathuto Kutoane', 'Thapelo Mphole']
+DISPENSERS = ['Letlotlo Hlaoli', 'Locum', 'Malesoetsa Leohla', 'Mamosa Seetsa',
+              'Mamosaase Nqosa', 'Mapalo Mapesela', 'Mathuto Kutoane', 'Thapelo Mphole']
+SUPPLIERS = ['Medi-Core', 'Pharma Direct', 'NDSO', 'Lesotho Pharma Supplies']
+STRENGTHS = ['5 mg', '10 mg', '25 mg', '50 mg', '100 mg', '250 mg', '500 mg', '5 ml', '100 ml']
+
+BATCH_SIZE = 5000
+
+
+def _diagnoses():
+    # Imported lazily: importing app builds the Flask app
+    from app import DIAGNOSES_OPTIONS
+    return DIAGNOSES_OPTIONS
+
+
+def _expiry_string(rng, dt):
+    """Real data holds both plain dates and full ISO datetimes – mimic that."""
+    if rng.random() < 0.2:
+        return dt.strftime('%Y-%m-%dT00:00:00.000Z')
+    return dt.strftime('%Y-%m-%d')
+
+
+def _insert_batched(coll, docs):
+    for i in range(0, len(docs), BATCH_SIZE):
+        coll.insert_many(docs[i:i + BATCH_SIZE], ordered=False)
+
+
+def seed(db, medications=500, controlled=20, users=10, dispenses=20000,
+         receipts=3000, years=3, max_lines=4, seed_value=42, password='password',
+         now=None):
+    """Populate `db` and return a dict with the number of documents written."""
+    rng = random.Random(seed_value)
+    now = now or datetime.utcnow()
+    start = now - timedelta(days=365 * years)
+    span_seconds = int((now - start).total_seconds())
+    diagnoses = _diagnoses()
+
+    def random_ts():
+        return start + timedelta(seconds=rng.randrange(span_seconds))
+
+    # ---- medications ----
+    med_docs = []
+    for i in range(medications + controlled):
+        is_controlled = i >= medications
+        prefix = 'Controlled Drug' if is_controlled else 'Synthetic Med'
+        med_docs.append({
+            'name': f'{prefix} {i:05d}, {rng.choice(STRENGTHS)}',
+            'balance': 0,
+            'batch': f'B{rng.randrange(10 ** 6):06d}',
+            'price': round(rng.uniform(0.5, 250.0), 2),
+            'expiry_date': _expiry_string(rng, now + timedelta(days=rng.randrange(-120, 900))),
+            'schedule': 'controlled' if is_controlled else 'not controlled',
+            'stock_receiver': rng.choice(DISPENSERS),
+            'order_number': f'PO{rng.randrange(10 ** 5):05d}',
+            'supplier': rng.choice(SUPPLIERS),
+            'invoice_number': f'INV{rng.randrange(10 ** 6):06d}',
+        })
+    names = [m['name'] for m in med_docs]
+    batch_of = {m['name']: m['batch'] for m in med_docs}
+    # A few popular items carry most of the volume, as in a real clinic
+    weights = [1.0 / (rank + 1) for rank in range(len(names))]
+    received_qty = dict.fromkeys(names, 0)
+    dispensed_qty = dict.fromkeys(names, 0)
+
+    # ---- users ----
+    password_hash = generate_password_hash(password)
+    user_docs = [{'username': 'bench_admin', 'password_hash': password_hash,
+                  'name': 'Bench Admin', 'role': 'admin'}]
+    for i in range(users):
+        user_docs.append({'username': f'user{i:03d}', 'password_hash': password_hash,
+                          'name': f'Synthetic User {i:03d}',
+                          'role': rng.choice(['employee', 'employee', 'viewer'])})
+
+    # ---- receive transactions ----
+    tx_docs = []
+    for _ in range(receipts):
+        med = med_docs[rng.randrange(len(med_docs))]
+        qty = rng.randrange(50, 1000)
+        received_qty[med['name']] += qty
+        ts = random_ts()
+        tx_docs.append({
+            'type': 'receive',
+            'med_name': med['name'],
+            'quantity': qty,
+            'batch': f'B{rng.randrange(10 ** 6):06d}',
+            'price': med['price'],
+            'expiry_date': _expiry_string(rng, ts + timedelta(days=rng.randrange(90, 1100))),
+            'schedule': med['schedule'],
+            'stock_receiver': rng.choice(DISPENSERS),
+            'order_number': f'PO{rng.randrange(10 ** 5):05d}',
+            'supplier': rng.choice(SUPPLIERS),
+            'invoice_number': f'INV{rng.randrange(10 ** 6):06d}',
+            'user': rng.choice(user_docs)['name'],
+            'timestamp': ts,
+        })
+
+    # ---- dispense transactions (one document per medication line) ----
+    for _ in range(dispenses):
+        tx_id = str(uuid4())
+        ts = random_ts()
+        common = {
+            'type': 'dispense',
+            'transaction_id': tx_id,
+            'patient': f'Patient {rng.randrange(10 ** 5):05d}',
+            'company': rng.choice(COMPANIES),
+            'position': rng.choice(POSITIONS),
+            'age_group': rng.choice(AGE_GROUPS),
+            'gender': rng.choice(GENDERS),
+            'sick_leave_days': rng.choice([0, 0, 0, 1, 2, 3, 5]),
+            'diagnoses': rng.sample(diagnoses, rng.randint(1, 3)),
+            'prescriber': rng.choice(PRESCRIBERS),
+            'dispenser': rng.choice(DISPENSERS),
+            'user': rng.choice(user_docs)['name'],
+            'date': ts.strftime('%Y-%m-%d'),
+        }
+        lines = rng.randint(1, max_lines)
+        for med_name in dict.fromkeys(rng.choices(names, weights=weights, k=lines)):
+            qty = rng.randint(1, 30)
+            dispensed_qty[med_name] += qty
+            line = dict(common)
+            line.update({'med_name': med_name, 'quantity': qty, 'batch': [batch_of[med_name]],
+                         'timestamp': ts})
+            tx_docs.append(line)
+
+    # Current balance = opening stock + received - dispensed, never negative
+    for med in med_docs:
+        net = received_qty[med['name']] - dispensed_qty[med['name']]
+        opening = max(0, -net) + rng.choice([0, 0, rng.randrange(10, 400)])
+        med['balance'] = opening + net
+
+    # Typed expiry, as written by the app since the expiry migration
+    for doc in med_docs + [t for t in tx_docs if t['type'] == 'receive']:
+        doc['expiry'] = parse_expiry(doc['expiry_date'])
+
+    # One open lot per medication holding its current stock (see lots.py)
+    lot_docs = [{
+        'med_name': m['name'], 'batch': m['batch'], 'quantity': m['balance'], 'received': m['balance'],
+        'expiry': m['expiry'], 'expiry_date': m['expiry_date'], 'price': m['price'], 'received_at': now,
+    } for m in med_docs if m['balance'] > 0]
+
+    db['medications'].insert_many(med_docs)
+    db['users'].insert_many(user_docs)
+    _insert_batched(db['transactions'], tx_docs)
+    if lot_docs:
+        db['lots'].insert_many(lot_docs)
+    rebuild_counters(db)
+    rebuild_cube(db)
+    return {
+        'medications': len(med_docs),
+        'lots': len(lot_docs),
+        'users': len(user_docs),
+        'transactions': len(tx_docs),
+        'dispenses': dispenses,
+        'receipts': receipts,
+    }
+
+
+def reset(db):
+    """Drop every collection the seeder writes, and the archive of the previous dataset."""
+    for name in ('medications', 'users', 'transactions', 'lots', 'daily_counters', 'forecast_state', 'dispense_cube',
+                 'transactions_archive', 'archive_state'):
+        db.drop_collection(name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seed a local MongoDB with a synthetic pharmacy dataset.')
+    parser.add_argument('--uri', default=os.getenv('MONGODB_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--medications', type=int, default=500)
+    parser.add_argument('--controlled', type=int, default=20, help='additional controlled drugs')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--dispenses', type=int, default=20000, help='dispense transactions (multi-line)')
+    parser.add_argument('--receipts', type=int, default=3000)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--max-lines', type=int, default=4, help='max medication lines per dispense')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--password', default='password', help='password for every seeded user')
+    parser.add_argument('--drop', action='store_true', help='drop existing data first')
+    args = parser.parse_args(argv)
+
+    client = MongoClient(args.uri, serverSelectionTimeoutMS=5000)
+    try:
+        db = client[args.db]
+        if args.drop:
+            reset(db)
+        elif db['transactions'].estimated_document_count():
+            print(f"Database '{args.db}' already has transactions – re-run with --drop to replace them.",
+                  file=sys.stderr)
+            return 1
+        counts = seed(db, medications=args.medications, controlled=args.controlled,
+                      users=args.users, dispenses=args.dispenses, receipts=args.receipts,
+                      years=args.years, max_lines=args.max_lines, seed_value=args.seed,
+                      password=args.password)
+        print(', '.join(f'{k}={v}' for k, v in counts.items()))
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
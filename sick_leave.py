@@ -0,0 +1,81 @@
+# sick_leave.py
+"""
+Sick-leave totals per company, month and diagnosis – what the companies we
+bill ask for every month.
+
+sick_leave_days is entered once per visit but copied onto every medication
+line of the dispense, so summing it over the lines counts a three-line
+visit three times.  The report runs ONE aggregation that collapses the
+lines of each visit by transaction_id (as the morbidity report does) before
+summing.  A visit with several diagnoses is booked under its first
+(primary) diagnosis, so the diagnosis rows of a company-month add up to its
+total.
+
+Results are cached through the report cache like the other reports.
+"""
+
+from morbidity import report_range, visits
+from archive import aggregate_transactions
+
+UNSPECIFIED = '(no diagnosis)'
+
+
+def parse_params(args, today=None):
+    """Date range plus optional exact company / primary diagnosis filters; ValueError if invalid."""
+    start_date, end_date, start, end = report_range(args, today)
+    return {
+        'start_date': start_date, 'end_date': end_date, 'start': start, 'end': end,
+        'company': (args.get('company') or '').strip() or None,
+        'diagnosis': (args.get('diagnosis') or '').strip() or None,
+    }
+
+
+def cache_search(params):
+    """The filters as the `search` part of the report cache key."""
+    return f"company={params['company'] or ''}|diagnosis={params['diagnosis'] or ''}"
+
+
+def sick_leave(db, start, end, company=None, diagnosis=None):
+    """Sick leave for dispenses in [start, end), each visit counted once.
+
+    Returns {'rows': [{'company', 'month', 'diagnosis', 'visits',
+    'leave_visits', 'days'}], 'subtotals': {(company, month): {...}},
+    'companies': {company: {...}}, 'total': {...}}.
+    """
+    match = {'type': 'dispense', 'timestamp': {'$gte': start, '$lt': end}}
+    if company:
+        match['company'] = company
+    if diagnosis:
+        match['diagnoses.0'] = diagnosis
+    rows = aggregate_transactions(db['transactions'], [
+        {'$match': match},
+        visits(['company', 'timestamp', 'diagnoses', 'sick_leave_days']),
+        {'$group': {
+            '_id': {
+                'company': '$company',
+                'month': {'$dateToString': {'format': '%Y-%m', 'date': '$timestamp'}},
+                'diagnosis': {'$ifNull': [{'$arrayElemAt': ['$diagnoses', 0]}, UNSPECIFIED]},
+            },
+            'visits': {'$sum': 1},
+            'leave_visits': {'$sum': {'$cond': [{'$gt': ['$sick_leave_days', 0]}, 1, 0]}},
+            'days': {'$sum': {'$ifNull': ['$sick_leave_days', 0]}},
+        }},
+        {'$sort': {'_id.company': 1, '_id.month': 1, 'days': -1}},
+    ], start=start, allowDiskUse=True)
+
+    def empty():
+        return {'visits': 0, 'leave_visits': 0, 'days': 0}
+
+    def add(total, row):
+        for field in ('visits', 'leave_visits', 'days'):
+            total[field] += row[field]
+
+    result = {'rows': [], 'subtotals': {}, 'companies': {}, 'total': empty()}
+    for row in rows:
+        key = row.pop('_id')
+        row.update(company=key.get('company') or '', month=key['month'], diagnosis=key['diagnosis'])
+        result['rows'].append(row)
+        add(result['subtotals'].setdefault((row['company'], row['month']), empty()), row)
+        add(result['companies'].setdefault(row['company'], empty()), row)
+        add(result['total'], row)
+    return result
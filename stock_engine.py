@@ -0,0 +1,146 @@
+# stock_engine.py
+"""
+Vectorized stock-status and reorder calculations for the reports.
+
+The stock and inventory reports used to run one aggregation per medication
+and then classify / compute order quantities row by row.  They now fetch
+the movements of the whole catalog with ONE `$group` and do the arithmetic
+over NumPy column arrays:
+
+    status           out-of-stock / expired / close-to-expire / normal,
+                     with expiry compared as datetime64[D]
+    amount_to_order  average_daily * (review_period + lead_time) - balance,
+                     never below zero
+
+Planning parameters can be set per medication (blank = default):
+
+    lead_time_days        REORDER_LEAD_TIME_DAYS, default 14
+    review_period_days    REORDER_REVIEW_PERIOD_DAYS, default 30
+    near_expiry_days      NEAR_EXPIRY_DAYS, default 30
+"""
+
+import os
+import numpy as np
+from archive import aggregate_transactions
+
+DEFAULT_LEAD_TIME_DAYS = int(os.getenv('REORDER_LEAD_TIME_DAYS', '14'))
+DEFAULT_REVIEW_PERIOD_DAYS = int(os.getenv('REORDER_REVIEW_PERIOD_DAYS', '30'))
+DEFAULT_NEAR_EXPIRY_DAYS = int(os.getenv('NEAR_EXPIRY_DAYS', '30'))
+
+PLANNING_FIELDS = {
+    'lead_time_days': DEFAULT_LEAD_TIME_DAYS,
+    'review_period_days': DEFAULT_REVIEW_PERIOD_DAYS,
+    'near_expiry_days': DEFAULT_NEAR_EXPIRY_DAYS,
+}
+PLANNING_PROJECTION = dict.fromkeys(PLANNING_FIELDS, 1)
+
+OUT_OF_STOCK, EXPIRED, CLOSE_TO_EXPIRE, NORMAL = 'out-of-stock', 'expired', 'close-to-expire', 'normal'
+
+
+# --------------------------------------------------------------------------- #
+# Per-medication planning parameters
+# --------------------------------------------------------------------------- #
+def planning_column(meds, field):
+    """int array of `field` for each medication, the default where unset."""
+    default = PLANNING_FIELDS[field]
+    return np.fromiter((default if m.get(field) is None else m[field] for m in meds), dtype=np.int64, count=len(meds))
+
+
+def planning_update(form):
+    """($set, $unset) for the planning fields of a medication form; ValueError if invalid."""
+    to_set, to_unset = {}, {}
+    for field in PLANNING_FIELDS:
+        raw = (form.get(field) or '').strip()
+        if not raw:
+            to_unset[field] = ''
+            continue
+        value = int(raw)
+        if value < 0:
+            raise ValueError(f"{field.replace('_', ' ')} cannot be negative")
+        to_set[field] = value
+    return to_set, to_unset
+
+
+def near_expiry_overrides(medications):
+    """{name: days} for medications with their own near-expiry threshold."""
+    return {m['name']: m['near_expiry_days'] for m in medications.find(
+        {'near_expiry_days': {'$exists': True}}, {'_id': 0, 'name': 1, 'near_expiry_days': 1})}
+
+
+def widest_near_expiry(overrides):
+    return max([DEFAULT_NEAR_EXPIRY_DAYS, *overrides.values()])
+
+
+# --------------------------------------------------------------------------- #
+# Movements – one aggregation for the whole catalog
+# --------------------------------------------------------------------------- #
+def movements_by_med(transactions, timestamp=None, med_names=None):
+    """{med_name: (dispensed, received)} for transactions matching the `timestamp` condition.
+
+    With `med_names` None every medication is included.
+    """
+    match = {'type': {'$in': ['dispense', 'receive']}}
+    if timestamp:
+        match['timestamp'] = timestamp
+    if med_names is not None:
+        match['med_name'] = {'$in': list(med_names)}
+    start = (timestamp or {}).get('$gte', (timestamp or {}).get('$gt'))
+    rows = aggregate_transactions(transactions, [
+        {'$match': match},
+        {'$group': {
+            '_id': '$med_name',
+            'dispensed': {'$sum': {'$cond': [{'$eq': ['$type', 'dispense']}, '$quantity', 0]}},
+            'received': {'$sum': {'$cond': [{'$eq': ['$type', 'receive']}, '$quantity', 0]}},
+        }},
+    ], start=start, allowDiskUse=True)
+    return {row['_id']: (row['dispensed'], row['received']) for row in rows}
+
+
+def movement_columns(names, movements):
+    """(dispensed, received) int arrays aligned with `names`."""
+    dispensed = np.fromiter((movements.get(n, (0, 0))[0] for n in names), dtype=np.int64, count=len(names))
+    received = np.fromiter((movements.get(n, (0, 0))[1] for n in names), dtype=np.int64, count=len(names))
+    return dispensed, received
+
+
+# --------------------------------------------------------------------------- #
+# Vectorized calculations
+# --------------------------------------------------------------------------- #
+def expiry_column(expiries):
+    """datetime64[D] array from dates / datetimes / None (None -> NaT)."""
+    return np.array([np.datetime64(e, 'D') if e is not None else np.datetime64('NaT') for e in expiries],
+                    dtype='datetime64[D]')
+
+
+def stock_status(balance, expiry, report_date, near_expiry_days):
+    """Status for every row: out-of-stock beats expired beats close-to-expire.
+
+    `balance` int array, `expiry` datetime64[D] array (NaT = no expiry),
+    `near_expiry_days` int array or scalar.
+    """
+    day = np.datetime64(report_date, 'D')
+    threshold = day + np.asarray(near_expiry_days).astype('timedelta64[D]')
+    has_expiry = ~np.isnat(expiry)
+    return np.select(
+        [balance == 0, has_expiry & (expiry < day), has_expiry & (expiry <= threshold)],
+        [OUT_OF_STOCK, EXPIRED, CLOSE_TO_EXPIRE],
+        default=NORMAL,
+    )
+
+
+def balances_as_of(current, dispensed_after, received_after):
+    """Balance at the report date from the current balance and later movements (never negative)."""
+    return np.maximum(0, current - received_after + dispensed_after)
+
+
+def reorder(current, dispensed, days_in_period, lead_time_days, review_period_days):
+    """(average_daily, amount_to_order) arrays for the inventory report."""
+    average_daily = dispensed / float(max(1, days_in_period))
+    amount = np.maximum(0.0, average_daily * (review_period_days + lead_time_days) - current)
+    return average_daily, np.round(amount, 2)
+
+
+def as_number(value):
+    """Plain int where whole, else float – keeps the report output as before."""
+    value = float(value)
+    return int(value) if value.is_integer() else value
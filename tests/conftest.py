@@ -0,0 +1,42 @@
+# tests/conftest.py
+"""
+Fixtures: the Flask app (create_app()) on an in-memory mongomock database.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+
+import os
+import sys
+
+import mongomock
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module            # noqa: E402
+import audit_logger                 # noqa: E402
+import cache_versions               # noqa: E402
+import db                           # noqa: E402
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(db, 'get_client', lambda: client)
+    monkeypatch.setattr(app_module, 'get_client', lambda: client)
+    monkeypatch.setattr(audit_logger, 'get_client', lambda: client)
+    monkeypatch.setattr(cache_versions, 'get_db', lambda: client['pharmacy_db'])
+    return client['pharmacy_db']
+
+
+@pytest.fixture
+def client(mongo):
+    flask_app = app_module.create_app()
+    flask_app.config['TESTING'] = True
+    return flask_app.test_client()
+
+
+def login(client, role='admin'):
+    with client.session_transaction() as sess:
+        sess['user'] = {'login': 'tester', 'name': 'Tester', 'role': role}
@@ -0,0 +1,74 @@
+# tests/test_archive.py
+"""Hot / cold archival (archive.py)."""
+
+from datetime import datetime
+
+import mongomock
+import pytest
+
+import archive
+from conftest import login
+
+NOW = datetime(2026, 10, 1)
+OLD = datetime(2023, 1, 10)
+
+
+@pytest.fixture(autouse=True)
+def fresh_cutoff(monkeypatch):
+    monkeypatch.setattr(archive, '_cutoff', {'value': None, 'at': None})
+
+
+@pytest.fixture
+def history(mongo):
+    mongo['transactions'].insert_many([
+        {'type': 'receive', 'med_name': 'Amoxicillin, 500 mg', 'quantity': 100, 'batch': 'B1', 'timestamp': OLD},
+        {'type': 'receive', 'med_name': 'Paracetamol, 500 mg', 'quantity': 50, 'batch': 'P1', 'timestamp': OLD},
+    ])
+    return mongo
+
+
+def edit_while_copying(monkeypatch, mongo, update):
+    """Apply `update` to the Amoxicillin receipt right after the batch is copied."""
+    original = mongomock.collection.Collection.bulk_write
+
+    def bulk_write(self, requests, *args, **kwargs):
+        result = original(self, requests, *args, **kwargs)
+        if self.name == archive.ARCHIVE:
+            mongo['transactions'].update_one({'med_name': 'Amoxicillin, 500 mg'}, update)
+        return result
+    monkeypatch.setattr(mongomock.collection.Collection, 'bulk_write', bulk_write)
+
+
+def test_archival_moves_old_transactions(history):
+    moved, _ = archive.archive_transactions(history, days=730, now=NOW)
+    assert moved == 2
+    assert history['transactions'].count_documents({}) == 0
+    assert history[archive.ARCHIVE].count_documents({}) == 2
+
+
+def test_edit_during_archival_is_copied_again(monkeypatch, history):
+    edit_while_copying(monkeypatch, history, {'$set': {'quantity': 90}})
+    archive.archive_transactions(history, days=730, now=NOW)
+    assert history['transactions'].count_documents({}) == 0
+    assert history[archive.ARCHIVE].find_one({'med_name': 'Amoxicillin, 500 mg'})['quantity'] == 90
+
+
+def test_edit_past_the_cutoff_stays_hot(monkeypatch, history):
+    edit_while_copying(monkeypatch, history, {'$set': {'quantity': 90, 'timestamp': NOW}})
+    archive.archive_transactions(history, days=730, now=NOW)
+    assert history['transactions'].find_one({}, {'_id': 0, 'med_name': 1, 'quantity': 1}) == \
+        {'med_name': 'Amoxicillin, 500 mg', 'quantity': 90}
+    assert [doc['med_name'] for doc in history[archive.ARCHIVE].find({}, {'med_name': 1})] == ['Paracetamol, 500 mg']
+
+
+def test_api_pages_stay_on_the_hot_collection(client, mongo):
+    mongo[archive.STATE].insert_one({'_id': 'transactions', 'cutoff': datetime(2024, 10, 1)})
+    mongo['transactions'].insert_many([
+        {'type': 'dispense', 'transaction_id': f'tx-{day}', 'med_name': 'Amoxicillin, 500 mg', 'quantity': 1,
+         'timestamp': datetime(2026, 9, day)} for day in range(1, 6)])
+    login(client)
+    # mongomock has no $unionWith: reaching for the archive would fail the request
+    first = client.get('/api/v1/dispenses?limit=2&fields=transaction_id').get_json()
+    assert [row['transaction_id'] for row in first['data']] == ['tx-5', 'tx-4']
+    second = client.get(f"/api/v1/dispenses?limit=2&fields=transaction_id&after={first['next']}").get_json()
+    assert [row['transaction_id'] for row in second['data']] == ['tx-3', 'tx-2']
@@ -0,0 +1,78 @@
+# tests/test_audit.py
+"""Audit trail (audit_logger.py): only completed edits and deletes are recorded."""
+
+from datetime import datetime
+
+import pytest
+
+from conftest import login
+
+
+@pytest.fixture
+def stocked(mongo):
+    mongo['medications'].insert_one({'name': 'Amoxicillin, 500 mg', 'balance': 100, 'batch': 'B1',
+                                     'price': 1.5, 'expiry_date': '2030-01-01', 'schedule': 'not controlled'})
+    return mongo
+
+
+def dispense_form(quantities, transaction_id=None):
+    form = {
+        'patient': 'P1', 'company': 'Enaex', 'position': 'Driver', 'age_group': '20-29',
+        'gender': 'Male', 'prescriber': 'Dr A', 'dispenser': 'Nurse B',
+        'date': datetime.utcnow().strftime('%Y-%m-%d'), 'sick_leave_days': '0',
+        'diagnoses': ['Malaria'],
+        'med_names': ['Amoxicillin, 500 mg'] * len(quantities), 'quantities': quantities,
+    }
+    if transaction_id:
+        form['transaction_id'] = transaction_id
+    return form
+
+
+def dispensed(client, mongo):
+    login(client)
+    response = client.post('/dispense', data=dispense_form(['10']))
+    assert response.status_code == 200
+    return mongo['transactions'].find_one({'type': 'dispense'})['transaction_id']
+
+
+def test_edit_with_blank_quantity_is_not_a_server_error(client, stocked):
+    tx_id = dispensed(client, stocked)
+    response = client.post('/dispense', data=dispense_form(['10', ''], transaction_id=tx_id))
+    assert response.status_code == 200
+    assert b'valid medication and quantity' in response.data
+    assert stocked['audit_log'].count_documents({}) == 0
+
+
+def test_successful_edit_is_audited_with_stored_lines(client, stocked):
+    tx_id = dispensed(client, stocked)
+    response = client.post('/dispense', data=dispense_form(['4'], transaction_id=tx_id))
+    assert b'Updated successfully' in response.data
+    entry = stocked['audit_log'].find_one({'action': 'UPDATE', 'target_type': 'dispense'})
+    assert entry['target_id'] == tx_id
+    assert entry['changes']['old_meds'] == [{'med_name': 'Amoxicillin, 500 mg', 'quantity': 10}]
+    assert entry['changes']['new_meds'] == [{'med_name': 'Amoxicillin, 500 mg', 'quantity': 4}]
+
+
+def test_refused_delete_is_not_audited(client, stocked):
+    tx_id = dispensed(client, stocked)
+    login(client, role='employee')
+    client.post('/delete-dispense', data={'transaction_id': tx_id})
+    assert stocked['transactions'].count_documents({'transaction_id': tx_id}) == 1
+    assert stocked['audit_log'].count_documents({}) == 0
+
+
+def test_delete_is_audited(client, stocked):
+    tx_id = dispensed(client, stocked)
+    client.post('/delete-dispense', data={'transaction_id': tx_id})
+    entry = stocked['audit_log'].find_one({'action': 'DELETE', 'target_type': 'dispense'})
+    assert entry['changes']['removed_meds'] == [{'med_name': 'Amoxicillin, 500 mg', 'quantity': 10}]
+
+
+def test_medication_delete_is_audited_only_when_it_happens(client, stocked):
+    login(client, role='employee')
+    client.post('/delete-medication', data={'med_name': 'Amoxicillin, 500 mg'})
+    assert stocked['audit_log'].count_documents({}) == 0
+    login(client)
+    client.post('/delete-medication', data={'med_name': 'Amoxicillin, 500 mg'})
+    entry = stocked['audit_log'].find_one({'action': 'DELETE', 'target_type': 'medication'})
+    assert entry['changes']['snapshot']['balance'] == 100
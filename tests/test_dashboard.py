@@ -0,0 +1,32 @@
+# tests/test_dashboard.py
+"""Dashboard gauges (dashboard.py) agree with the reports."""
+
+from datetime import datetime, timedelta
+
+import app as app_module
+import dashboard
+from lots import add_lot
+from schema import day_start
+
+TODAY = day_start(datetime.utcnow())
+
+
+def medication(mongo, name, balance, expires_in, **fields):
+    expiry = TODAY + timedelta(days=expires_in)
+    mongo['medications'].insert_one({'name': name, 'balance': balance, 'batch': name[:2], 'price': 1.0,
+                                     'expiry_date': expiry.strftime('%Y-%m-%d'), 'expiry': expiry,
+                                     'schedule': 'not controlled', **fields})
+
+
+def test_near_expiry_gauge_matches_the_near_expired_report(mongo):
+    medication(mongo, 'Amoxicillin, 500 mg', 10, 60, near_expiry_days=90)     # own, wider window
+    medication(mongo, 'Paracetamol, 500 mg', 10, 60)                           # outside the default window
+    medication(mongo, 'Ibuprofen, 400 mg', 10, 200)
+    add_lot(mongo, 'Ibuprofen, 400 mg', 'I1', (TODAY + timedelta(days=10)).strftime('%Y-%m-%d'), 10)
+    medication(mongo, 'Cetirizine, 10 mg', 10, 10)                             # all of it in a later lot
+    add_lot(mongo, 'Cetirizine, 10 mg', 'C1', (TODAY + timedelta(days=300)).strftime('%Y-%m-%d'), 10)
+    dashboard.invalidate()
+
+    rows = app_module.compute_report(mongo, 'near_expired_list', end_date=TODAY.strftime('%Y-%m-%d'))['stock_data']
+    assert {row['name'] for row in rows} == {'Amoxicillin, 500 mg', 'Ibuprofen, 400 mg'}
+    assert dashboard.snapshot(mongo)['near_expiry'] == 2
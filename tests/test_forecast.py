@@ -0,0 +1,24 @@
+# tests/test_forecast.py
+"""Demand forecast (forecast.py) on a fresh install."""
+
+import pytest
+
+import forecast
+from conftest import login
+
+
+@pytest.fixture(autouse=True)
+def unfitted(monkeypatch):
+    monkeypatch.setattr(forecast, '_state', {'through': None})
+
+
+def test_forecast_with_an_empty_catalog(mongo):
+    assert forecast.daily_forecast(mongo, []).tolist() == []
+    assert forecast.daily_forecast(mongo, ['Amoxicillin, 500 mg']).tolist() == [0.0]
+
+
+def test_inventory_report_with_an_empty_catalog(client, mongo):
+    login(client)
+    response = client.post('/reports', data={'report_type': 'inventory', 'start_date': '2026-09-01',
+                                             'end_date': '2026-09-30', 'search': ''})
+    assert response.status_code == 200
@@ -0,0 +1,81 @@
+# tests/test_lots.py
+"""Lot-level inventory (lots.py) next to medications that have no lots yet."""
+
+from datetime import datetime
+
+import pytest
+
+import app as app_module
+from conftest import login
+from lots import add_lot
+
+END = '2026-06-30'
+
+
+def medication(mongo, name, balance, batch, expiry_date):
+    mongo['medications'].insert_one({'name': name, 'balance': balance, 'batch': batch, 'price': 1.0,
+                                     'expiry_date': expiry_date, 'expiry': datetime.strptime(expiry_date, '%Y-%m-%d'),
+                                     'schedule': 'not controlled'})
+
+
+@pytest.fixture
+def mixed(mongo):
+    # Tracked in lots: one expired lot, one good lot
+    medication(mongo, 'Amoxicillin, 500 mg', 30, 'A2', '2027-01-01')
+    add_lot(mongo, 'Amoxicillin, 500 mg', 'A1', '2026-01-01', 10)
+    add_lot(mongo, 'Amoxicillin, 500 mg', 'A2', '2027-01-01', 20)
+    # Received before lots were migrated
+    medication(mongo, 'Paracetamol, 500 mg', 50, 'P1', '2026-02-01')
+    # 15 units in a lot, 25 outside any lot
+    medication(mongo, 'Ibuprofen, 400 mg', 40, 'I1', '2026-03-01')
+    add_lot(mongo, 'Ibuprofen, 400 mg', 'I2', '2027-01-01', 15)
+    return mongo
+
+
+def test_expired_list_covers_medications_without_lots(mixed):
+    rows = app_module.compute_report(mixed, 'expired_list', end_date=END)['stock_data']
+    assert [(r['name'], r['batch'], r['balance']) for r in rows] == [
+        ('Amoxicillin, 500 mg', 'A1', 10),
+        ('Ibuprofen, 400 mg', 'I1', 25),
+        ('Paracetamol, 500 mg', 'P1', 50),
+    ]
+    assert {r['status'] for r in rows} == {'expired'}
+
+
+def test_near_expired_list_covers_medications_without_lots(mixed):
+    rows = app_module.compute_report(mixed, 'near_expired_list', end_date='2025-12-15')['stock_data']
+    assert [(r['name'], r['batch']) for r in rows] == [('Amoxicillin, 500 mg', 'A1')]
+    rows = app_module.compute_report(mixed, 'near_expired_list', end_date='2026-01-15')['stock_data']
+    assert [(r['name'], r['batch']) for r in rows] == [('Paracetamol, 500 mg', 'P1')]
+
+
+def edit(client, name, **fields):
+    login(client)
+    form = {'balance': '30', 'batch': 'A2', 'price': '1.0', 'expiry_date': '2027-01-01',
+            'schedule': 'not controlled', **fields}
+    response = client.post(f'/edit-medication/{name}', data=form)
+    assert b'updated successfully' in response.data
+
+
+def lot(mongo, batch):
+    return mongo['lots'].find_one({'batch': batch}, {'_id': 0, 'quantity': 1, 'expiry_date': 1})
+
+
+def test_medication_edit_corrects_the_lot_expiry(client, mixed):
+    edit(client, 'Amoxicillin, 500 mg', expiry_date='2026-12-01')
+    assert lot(mixed, 'A2') == {'quantity': 20, 'expiry_date': '2026-12-01'}
+    rows = app_module.compute_report(mixed, 'near_expired_list', end_date='2026-11-15')['stock_data']
+    assert [(r['name'], r['batch']) for r in rows] == [('Amoxicillin, 500 mg', 'A2')]
+
+
+def test_medication_edit_books_a_raised_balance_to_the_lot(client, mixed):
+    edit(client, 'Amoxicillin, 500 mg', balance='35')
+    assert lot(mixed, 'A2')['quantity'] == 25
+    edit(client, 'Paracetamol, 500 mg', balance='60', batch='P1', expiry_date='2026-02-01')
+    assert lot(mixed, 'P1')['quantity'] == 10
+
+
+def test_medication_edit_takes_a_lowered_balance_from_the_lots(client, mixed):
+    edit(client, 'Amoxicillin, 500 mg', balance='5')
+    assert lot(mixed, 'A2')['quantity'] == 0
+    assert lot(mixed, 'A1')['quantity'] == 5
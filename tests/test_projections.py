@@ -0,0 +1,83 @@
+# tests/test_projections.py
+"""Every find on transactions / medications behind the list pages names its fields (user-039).
+
+mongomock sends no command events, so its find() (and find_one(), which
+calls it) is wrapped to hand each query to db_metrics.command_listener as a
+`find` command – the same path a real MongoClient takes.  With MONGO_PROJECTION_CHECK=strict a request that
+ran an unprojected find fails in db_metrics' after_request hook.
+"""
+
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import mongomock
+import pytest
+
+import db_metrics
+from conftest import login
+
+TODAY = datetime.utcnow()
+START = (TODAY - timedelta(days=30)).strftime('%Y-%m-%d')
+END = TODAY.strftime('%Y-%m-%d')
+
+LIST_PAGES = [
+    ('GET', '/dispense', None),
+    ('GET', f'/dispense?start_date={START}&end_date={END}&search=Amox', None),
+    ('GET', '/dispense?edit=tx-1', None),
+    ('GET', '/receive', None),
+    ('GET', f'/receive?start_date={START}&end_date={END}&search=Amox', None),
+    ('GET', '/edit-medication/Amoxicillin, 500 mg', None),
+    ('GET', '/api/v1/dispenses', None),
+    ('GET', '/api/v1/receipts', None),
+    ('GET', '/api/v1/medications', None),
+    ('POST', '/reports', {'report_type': 'stock_on_hand', 'end_date': END, 'search': ''}),
+    ('POST', '/reports', {'report_type': 'out_of_stock_list', 'end_date': END, 'search': ''}),
+    ('POST', '/reports', {'report_type': 'receive_list', 'start_date': START, 'end_date': END, 'search': ''}),
+]
+
+
+@pytest.fixture
+def finds(monkeypatch, mongo):
+    """Wrap mongomock's find(); returns the (collection, projection) of every call."""
+    monkeypatch.setattr(db_metrics, 'PROJECTION_CHECK', 'strict')
+    calls = []
+    original = mongomock.collection.Collection.find
+
+    def find(self, filter=None, projection=None, *args, **kwargs):
+        caller = sys._getframe(1)
+        if caller.f_globals['__name__'].startswith('mongomock') and caller.f_code.co_name != 'find_one':
+            # mongomock's aggregate() etc. scan with find(); a server runs those as their own commands
+            return original(self, filter, projection, *args, **kwargs)
+        calls.append((self.name, projection))
+        command = {'find': self.name, 'filter': filter or {}}
+        if projection:
+            command['projection'] = projection
+        db_metrics.command_listener.started(SimpleNamespace(command_name='find', command=command))
+        return original(self, filter, projection, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'find', find)
+    return calls
+
+
+@pytest.fixture
+def seeded(mongo):
+    mongo['medications'].insert_one({'name': 'Amoxicillin, 500 mg', 'balance': 90, 'batch': 'B1', 'price': 1.5,
+                                     'expiry_date': '2030-01-01', 'schedule': 'not controlled'})
+    mongo['transactions'].insert_many([
+        {'type': 'receive', 'med_name': 'Amoxicillin, 500 mg', 'quantity': 100, 'batch': 'B1', 'price': 1.5,
+         'expiry_date': '2030-01-01', 'user': 'Tester', 'timestamp': TODAY - timedelta(days=5)},
+        {'type': 'dispense', 'transaction_id': 'tx-1', 'patient': 'P1', 'company': 'Enaex', 'diagnoses': ['Malaria'],
+         'med_name': 'Amoxicillin, 500 mg', 'quantity': 10, 'date': END, 'timestamp': TODAY - timedelta(days=1)},
+    ])
+    return mongo
+
+
+@pytest.mark.parametrize('method,url,form', LIST_PAGES)
+def test_list_queries_are_projected(client, seeded, finds, method, url, form):
+    login(client)
+    response = client.open(url, method=method, data=form)
+    unprojected = [name for name, projection in finds
+                   if name in db_metrics.PROJECTED_COLLECTIONS and not projection]
+    assert not unprojected, f'{method} {url}: find without projection on {unprojected}'
+    assert response.status_code < 500
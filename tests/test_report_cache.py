@@ -0,0 +1,47 @@
+# tests/test_report_cache.py
+"""Report cache (report_cache.py): a write during a computation keeps its result out of the cache."""
+
+import pytest
+
+import app as app_module
+import report_cache
+from report_cache import ReportCache, LRUBackend, DISPENSE, invalidate_reports
+
+KEY = ('stock_on_hand', '', '2030-01-01', 'Amox')
+
+
+@pytest.fixture
+def cache(monkeypatch, mongo):
+    cache = ReportCache(LRUBackend())
+    monkeypatch.setattr(report_cache, '_cache', cache)
+    return cache
+
+
+def computing(write):
+    """compute_report() stand-in that runs `write` half-way."""
+    def compute_report(db, report_type, start_date, end_date, search, progress):
+        write()
+        return {'report_title': 'Stock on hand'}
+    return compute_report
+
+
+def test_write_during_computation_is_a_cache_miss(monkeypatch, cache):
+    monkeypatch.setattr(app_module, 'compute_report',
+                        computing(lambda: invalidate_reports(DISPENSE, ['Amoxicillin, 500 mg'])))
+    app_module.compute_and_cache_report(None, *KEY)
+    assert cache.get(*KEY) is None
+
+
+def test_unrelated_write_during_computation_is_cached(monkeypatch, cache):
+    monkeypatch.setattr(app_module, 'compute_report',
+                        computing(lambda: invalidate_reports(DISPENSE, ['Paracetamol, 500 mg'])))
+    app_module.compute_and_cache_report(None, *KEY)
+    assert cache.get(*KEY)['payload'] == {'report_title': 'Stock on hand'}
+
+
+def test_put_without_a_log_back_to_the_snapshot_is_refused(cache):
+    generation = cache.generation()
+    for _ in range(report_cache.INVALIDATION_LOG + 1):
+        cache.invalidate(DISPENSE, ['Paracetamol, 500 mg'])
+    assert not cache.put(*KEY, {}, 1.0, generation)
+    assert cache.put(*KEY, {}, 1.0, cache.generation())